@@ -37,7 +37,7 @@ class AMASS(base_dataset.BaseMotionData):
 
     def __getitem__(self, idx):
         idx_ = self.valid_idx[idx]
-        motion = self.motion_flattened[idx_:idx_+self.rollout]
+        motion = np.array(self.motion_flattened[idx_:idx_+self.rollout]) # copy out of the read-only memory map
         return  motion
 
 
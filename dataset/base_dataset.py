@@ -1,4 +1,6 @@
+import os
 import os.path as osp
+import time
 import numpy as np
 import torch
 import torch.optim as optim
@@ -11,6 +13,10 @@ from dataset.util.skeleton_info import skel_dict
 import dataset.util.unit as unit_util
 import dataset.util.bvh as bvh_util
 import dataset.util.geo as geo_util
+import dataset.util.kinematics as kinematics_util
+import dataset.util.motion_cache as motion_cache_util
+import dataset.util.preprocess as preprocess_util
+import dataset.util.normalizer as normalizer_util
 
 class BaseMotionData(data.Dataset):
     # For a directory contains multiple identical file type
@@ -49,8 +55,16 @@ class BaseMotionData(data.Dataset):
         # if true, load data, if not only load stats for normalization(std avg)
         self.load_full_data = config["data"].get('load_full_data',True)
 
-        # if true, when loading data, load cached data.npz, if not load motion file directly
+        # if true, when loading data, load the cached motion shards, if not load motion file directly
         self.load_cache = config["data"].get('load_cache',True)
+        self.motion_cache = motion_cache_util.MotionCache(osp.join(self.path,'cache'))
+        # max frames per cache shard, shards are memory mapped and shared between processes
+        self.cache_shard_frames = config["data"].get('cache_shard_frames',1000000)
+        # process_data outputs are cached per file and only recomputed for new or modified files
+        self.file_cache = preprocess_util.FileCache(osp.join(self.path,'cache','files'), 
+                                                    preprocess_util.get_config_hash(config["data"], type(self).__name__))
+        # number of processes running process_data on a cache miss, 0 or 1 runs in the main process
+        self.preprocess_workers = config["data"].get('preprocess_workers', os.cpu_count())
 
         self.data_rot_rpr = config["data"].get("data_rot_rpr","6d") #6d, expmap, aa, quat
         self.data_root_rot_rpr = config["data"].get("data_root_rot_rpr","angle") # angle, rot
@@ -98,6 +112,8 @@ class BaseMotionData(data.Dataset):
         self.file_lst = list()
         self.joint_offset = list()
         self.test_ref_clips = list()  
+        self._pt_cache = dict() # device copies of the joint offsets
+        self._normalizer = None
 
         if osp.exists(osp.join(self.path,'stats.npz')):
             with np.load(osp.join(self.path,'stats.npz')) as stats:
@@ -127,37 +143,37 @@ class BaseMotionData(data.Dataset):
                 self.frame_dim = stats['frame_dim']
 
         if self.load_full_data:
-            if osp.exists(osp.join(self.path,'data.npz')) and self.load_cache:
+            load_start_time = time.time()
+            if self.load_cache and not self.motion_cache.exists() and osp.exists(osp.join(self.path,'data.npz')):
+                # convert the former single file cache once, dropping what is left of a broken cache
+                self.motion_cache.clear()
                 with np.load(osp.join(self.path,'data.npz')) as data:
-                    self.motion_flattened = data['motion_flattened']
-                    self.valid_range = data['valid_range']
-                    self.file_lst = data['file_lst']
-                
-                if 'labels' in data.keys():
-                    self.labels= data['labels']
+                    clips = [data['motion_flattened'][st:ed] for st, ed in data['valid_range']]
+                    labels = data['labels'] if 'labels' in data.keys() else None
+                    self.motion_cache.append(clips, data['file_lst'], labels, self.cache_shard_frames)
+
+            if self.motion_cache.exists() and self.load_cache:
+                self.motion_flattened, self.valid_range, self.file_lst, self.labels = self.motion_cache.load()
                 
             else:
                 file_paths = self.get_motion_fpaths()
                 
                 self.total_len = 0
-                self.motion_struct = None
+                self.joint_offset = list()
                 
-                for i, fname in enumerate(tqdm.tqdm(file_paths)):
-                    ret = self.process_data(fname)
-                    if ret is None:
+                entries = preprocess_util.process_files(self, file_paths, self.file_cache, self.preprocess_workers)
+                stats = (0, 0.0, 0.0)
+                for fname, entry in zip(file_paths, entries):
+                    if not entry['valid']:
                         continue
-                    elif type(ret) is not tuple:
-                        motion = ret
-                    else:
-                        motion, motion_struct = ret
-                        if self.motion_struct is None:
-                            self.motion_struct = motion_struct
-
-                        if self.use_offset is None:
-                            self.joint_offset =  motion_struct._skeleton.get_joint_offset()
-                        else:
-                            offset = motion_struct._skeleton.get_joint_offset()
-                            self.joint_offset.append(offset)
+                    motion = entry['motion']
+
+                    if 'joint_offset' in entry:
+                        if self.links is None:
+                            self.links = entry['links'].tolist()
+                        if self.joint_names is None:
+                            self.joint_names = entry['joint_names'].tolist()
+                        self.joint_offset.append(entry['joint_offset'])
 
                     length = len(motion)
 
@@ -175,35 +191,34 @@ class BaseMotionData(data.Dataset):
                     
                     self.total_len += length
                     self.motion_flattened.append(motion)
-
-                # Num frames x Dim feature
-                self.motion_flattened = np.concatenate(self.motion_flattened,axis=0)
+                    stats = preprocess_util.merge_stats(stats, (int(entry['count']), entry['mean'], entry['m2']))
                 
                 # skeleton joint offset
                 self.joint_offset = np.array(self.joint_offset)
 
-                # skeleton joint connection
-                self.links = self.motion_struct._skeleton.get_links() if self.links is None else self.links
-
-                # skeleton joint names
-                self.joint_names = [x._name for x in self.motion_struct._skeleton._joint_lst] if self.joint_names is None else self.joint_names
                 self.num_jnt = len(self.joint_names)
 
                 # boundry of mocap clips
                 self.valid_range = np.array(self.valid_range)
                 
-                # calculate norm states given frames
-                self.motion_flattened, self.normalization = self.create_norm(self.motion_flattened, 'zscore')
-                self.std = self.normalization['std']
-                self.avg = self.normalization['avg']
+                # norm states merged from the per file statistics, then every clip is normalized before concatenation
+                self.avg, self.std = preprocess_util.finalize_stats(stats, self.motion_flattened[0].dtype)
+                self.normalization = {
+                    'mode': 'zscore',
+                    'std': self.std,
+                    'avg': self.avg
+                }
+                # Num frames x Dim feature
+                self.motion_flattened = np.concatenate([self.norm_data(motion) for motion in self.motion_flattened],axis=0)
                 
                 self.frame_dim = self.motion_flattened.shape[-1]
 
                 #reorder and create joint index limits, for retrieval specific element in the feature in the future
                 self.motion_flattened, self.std, self.avg = self.transform_data_flattened(self.motion_flattened, self.std, self.avg)
 
-                np.savez(osp.join(self.path,'data.npz'), 
-                        motion_flattened = self.motion_flattened, file_lst= self.file_lst, valid_range = self.valid_range, labels = self.labels)
+                self.motion_cache.clear()
+                clips = [self.motion_flattened[st:ed] for st, ed in self.valid_range]
+                self.motion_cache.append(clips, self.file_lst, self.labels, self.cache_shard_frames)
                 np.savez(osp.join(self.path,'stats.npz'), 
                             std = self.std, avg = self.avg, frame_dim = self.frame_dim, 
                             joint_offset = self.joint_offset, joint_names= self.joint_names, links = self.links, 
@@ -217,6 +232,8 @@ class BaseMotionData(data.Dataset):
                             
                             
                         )
+                # continue from the memory mapped shards instead of the in-memory copy
+                self.motion_flattened, self.valid_range, self.file_lst, self.labels = self.motion_cache.load()
             
     
             
@@ -232,10 +249,28 @@ class BaseMotionData(data.Dataset):
             self.test_valid_idx = np.array(self.test_valid_idx_full)[::skip_num]
             self.test_ref_clips = np.array([self.motion_flattened[idx:idx+self.test_num_steps] for idx in self.test_valid_idx])
 
-            print('data shape:{}'.format(self.motion_flattened.shape))
+            print('data shape:{}, loaded in {:.2f}s, rss {:.0f}MB'.format(self.motion_flattened.shape, 
+                                                                     time.time() - load_start_time, motion_cache_util.get_rss_mb()))
         
         self.joint_offset = unit_util.unit_conver_scale(self.unit) *  np.array(self.joint_offset)
         self.joint_parent = bvh_util.get_parent_from_link(self.links)
+        self.fk = kinematics_util.ForwardKinematics(self.joint_parent)
+
+    def append_to_cache(self, file_paths):
+        # normalized with the current stats and written as new shards, existing shards are left untouched,
+        # the clips show up the next time the dataset is built
+        clips, file_lst, labels = [], [], []
+        for fname in file_paths:
+            ret = self.process_data(fname)
+            if ret is None:
+                continue
+            motion = ret[0] if type(ret) is tuple else ret
+            clips.append(self.transform_new_data(self.norm_data(motion)))
+            file_lst.append(fname)
+            if self.use_cond:
+                labels.extend(self.process_label(fname))
+        self.motion_cache.append(clips, file_lst, labels, self.cache_shard_frames)
+        return len(clips)
 
     def load_new_data(self, path):
         x = self.process_data(path)
@@ -406,51 +441,30 @@ class BaseMotionData(data.Dataset):
         
         return mocap_data, normalization
 
-    def denorm_data(self,t,device='cpu'):
-        
-        normalization = self.normalization
-        if normalization['mode'] == 'minmax':
-            data_max = normalization['max']
-            data_min = normalization['min']
-            if device !='cpu':
-                data_min = torch.tensor(data_min).to(device)
-                data_max = torch.tensor(data_max).to(device)
-            t = (t + 1) * (data_max - data_min) / 2 + data_min
-        
-        elif normalization['mode'] == 'zscore':
-            data_avg = normalization['avg']
-            data_std = normalization['std']
-            if device !='cpu':
-                data_avg = torch.tensor(data_avg).type(t.dtype).to(device)
-                data_std = torch.tensor(data_std).type(t.dtype).to(device)
-            
-            t = t * data_std + data_avg
-
-        else:
-            raise ValueError("Unknown normalization mode")
-        return t
-
-    def norm_data(self,t,device='cpu'):
-        normalization = self.normalization
-        if normalization['mode'] == 'minmax':
-            data_max = normalization['max']
-            data_min = normalization['min']
-            if device !='cpu':
-                data_min = torch.tensor(data_min).to(device)
-                data_max = torch.tensor(data_max).to(device)
-            t = 2 * (t - data_min) / (data_max - data_min) - 1
-        
-        elif normalization['mode'] == 'zscore':
-            data_avg = normalization['avg']
-            data_std = normalization['std']
-            if device !='cpu':
-                data_avg = torch.tensor(data_avg).type(t.dtype).to(device)
-                data_std = torch.tensor(data_std).type(t.dtype).to(device)
-            t = (t - data_avg) / data_std
-
-        else:
-            raise ValueError("Unknown normalization mode")
-        return t
+    def get_normalizer(self):
+        # follows self.normalization, rebuilt whenever its stats are replaced
+        if self._normalizer is None or not self._normalizer.is_built_from(self.normalization):
+            self._normalizer = normalizer_util.Normalizer(self.normalization)
+        return self._normalizer
+
+    def get_root_cols(self):
+        # feature columns holding the root planar velocity and heading change, all columns if unknown
+        st, ed = self.dxdydr_dim_lst
+        return slice(int(st), int(ed)) if ed > st else slice(None)
+
+    def denorm_data(self, t, device='cpu', cols=None):
+        # device and dtype follow t, cols restricts t and the stats to a column subset
+        return self.get_normalizer().denorm(t, cols)
+
+    def get_array_pt(self, arr, device, dtype):
+        # device copy of a constant numpy array, made once instead of on every call
+        key = (id(arr), str(device), dtype)
+        if key not in self._pt_cache or self._pt_cache[key][0] is not arr:
+            self._pt_cache[key] = (arr, torch.tensor(np.asarray(arr), device=device, dtype=dtype))
+        return self._pt_cache[key][1]
+
+    def norm_data(self, t, device='cpu', cols=None):
+        return self.get_normalizer().norm(t, cols)
     
     def from_6d_to_rpr(self, rotation6d):
         if self.data_rot_rpr == 'aa':
@@ -533,23 +547,28 @@ class BaseMotionData(data.Dataset):
         return new_frame
 
     def angle_frame_pt(self, frame):
-        joint_orientations = torch.zeros((frame.shape[0], self.num_jnt, 3, 3), device=frame.device, dtype=frame.dtype)
-        joint_positions = torch.zeros((frame.shape[0], self.num_jnt,3), device=frame.device, dtype=frame.dtype)
-
-        joint_offset_pt = torch.tensor(self.joint_offset, device = frame.device, requires_grad=False, dtype=frame.dtype)
-        rotation_rpr = frame[:, self.angle_dim_lst[0]:self.angle_dim_lst[1]].view(-1, self.num_jnt, self.data_rot_dim)
-        for i in range(self.num_jnt):
-            
-            local_rotation = self.from_rpr_to_rotmat(rotation_rpr[..., i, :])
-            if self.joint_parent[i] == -1: #root
-                joint_orientations[:,i] = local_rotation 
-            else:                
-                joint_orientations[:,i] = torch.matmul(joint_orientations[:,self.joint_parent[i]].clone(), local_rotation)
-                joint_positions[:,i] = joint_positions[:,self.joint_parent[i]] + torch.matmul(joint_orientations[:,self.joint_parent[i]].clone(), joint_offset_pt[i])
+        # frame: [..., frame_dim], any leading batch dims
+        rotation_rpr = frame[..., self.angle_dim_lst[0]:self.angle_dim_lst[1]]
+        rotation_rpr = rotation_rpr.reshape(frame.shape[:-1] + (self.num_jnt, self.data_rot_dim))
+        joint_positions = self.fk.forward(self.from_rpr_to_rotmat(rotation_rpr), self.joint_offset)
         joint_positions[...,1] += frame[..., None, self.height_index]
         return joint_positions
 
 
+    def fk_local_frame_pt(self, frame):
+        # frame: denormalized tensor [..., frame_dim], computed on its own device
+        # returns joint positions [..., num_jnt, 3] in the heading frame of every frame, root height included
+        rotation_rpr = frame[..., self.angle_dim_lst[0]:self.angle_dim_lst[1]]
+        rotation_rpr = rotation_rpr.reshape(frame.shape[:-1] + (self.num_jnt, self.data_rot_dim))
+        if self.use_offset:
+            joint_offset = frame[..., self.offset_dim_lst[0]:self.offset_dim_lst[1]].reshape(frame.shape[:-1] + (self.num_jnt, 3))
+        else:
+            joint_offset = self.get_array_pt(self.joint_offset, frame.device, frame.dtype)
+        joint_positions = self.fk.forward(self.from_rpr_to_rotmat(rotation_rpr), joint_offset)
+        joint_positions[..., 1] += frame[..., None, self.height_index]
+        return joint_positions
+
+
     def vel_frame_pt(self, last_frame, frame):
         vel = frame[...,self.vel_dim_lst[0]:self.vel_dim_lst[1]]
         last_pos = last_frame[...,self.joint_dim_lst[0]:self.joint_dim_lst[1]]
@@ -565,42 +584,22 @@ class BaseMotionData(data.Dataset):
 
 
     def fk_local_rot_pt(self, rotation_rpr):
-        joint_orientations = torch.zeros((self.num_jnt, 3, 3), device=rotation_rpr.device, dtype=rotation_rpr.dtype)
-        joint_positions = torch.zeros((self.num_jnt, 3), device=rotation_rpr.device, dtype=rotation_rpr.dtype)
-
-        joint_offset_pt = torch.tensor(self.joint_offset, device = rotation_rpr.device, requires_grad=False, dtype=rotation_rpr.dtype)
-        for i in range(self.num_jnt):
-            local_rotation = self.from_rpr_to_rotmat(rotation_rpr[..., i,:])
-            if self.joint_parent[i] == -1: #root
-                joint_orientations[i,:,:] = local_rotation 
-            else:                
-                joint_orientations[i] = torch.matmul(joint_orientations[self.joint_parent[i]].clone(), local_rotation)
-                joint_positions[i] = joint_positions[self.joint_parent[i]] + torch.matmul(joint_orientations[self.joint_parent[i]].clone(), joint_offset_pt[i])
-        
-        return joint_positions#.view(-1)
+        # rotation_rpr: [..., num_jnt, data_rot_dim]
+        return self.fk.forward(self.from_rpr_to_rotmat(rotation_rpr), self.joint_offset)
 
 
     def fk_local_seq(self, frames):
-        dtype = frames.dtype
-        num_frames = len(frames)
-        ang_frames = frames[:,self.angle_dim_lst[0]:self.angle_dim_lst[1]]
-        joint_positions = np.zeros((num_frames, self.num_jnt, 3), dtype=dtype)
-        joint_orientations = np.zeros((num_frames, self.num_jnt, 3, 3), dtype=dtype)
+        # frames: numpy [..., frame_dim], any leading batch dims
+        ang_frames = frames[...,self.angle_dim_lst[0]:self.angle_dim_lst[1]]
+        ang_frames = ang_frames.reshape(frames.shape[:-1] + (self.num_jnt, self.data_rot_dim))
        
         if self.use_offset:
-            joint_offset = frames[0,self.offset_dim_lst[0]:].reshape(-1,3)
+            joint_offset = frames.reshape(-1, frames.shape[-1])[0,self.offset_dim_lst[0]:].reshape(-1,3)
         else:
             joint_offset = self.joint_offset
-        #joint_offset = joint_offset[None,...].repeat(joint_orientations.shape[0],0)
         
-        for i in range(self.num_jnt):
-            local_rotation = ang_frames[:, self.data_rot_dim*i: self.data_rot_dim*(i+1)]
-            local_rotation = self.from_rpr_to_rotmat(torch.tensor(local_rotation)).numpy()
-            if self.joint_parent[i] == -1: #root
-                joint_orientations[:,i,:,:] = local_rotation 
-            else:                
-                joint_orientations[:,i] = np.matmul(joint_orientations[:,self.joint_parent[i]], local_rotation)
-                joint_positions[:,i] = joint_positions[:,self.joint_parent[i]] + np.matmul(joint_orientations[:,self.joint_parent[i]], joint_offset[i])
+        local_rotation = self.from_rpr_to_rotmat(torch.tensor(ang_frames))
+        joint_positions = self.fk.forward(local_rotation, joint_offset).numpy()
         
         joint_positions[..., 1] += frames[..., [self.height_index]] #height
         return  joint_positions
@@ -624,27 +623,44 @@ class BaseMotionData(data.Dataset):
         jnts = jnts.reshape(-1,self.num_jnt,3)
         return jnts
 
-    def x_to_rotation(self, x, mode):
+    def get_root_dxdy_dr(self, x):
         dxdy = x[...,:self.data_root_linear_dim] 
         if self.data_root_rot_dim>1:
             m6d = self.from_rpr_to_rotmat(x[...,self.data_root_linear_dim:self.data_root_dim])
             dr, _ = geo_util.sepr_rot_heading(m6d)
         else:
             dr = x[...,self.data_root_linear_dim]
+        return dxdy, dr
+
+    def integrate_root_stream(self, x, state=None):
+        """
+        kinematics_util.integrate_root for a motion fed chunk by chunk
+        x: [n, F] denormalized frames following the ones integrated into state, None for the first chunk
+        returns the yaws [n], root positions [n, 3] and the state after the last frame
+        """
+        dxdy, dr = self.get_root_dxdy_dr(x)
+        if state is None:
+            yaws, root_pos = kinematics_util.integrate_root(dxdy, dr)
+        else:
+            last_yaw, last_pos = state
+            yaws = last_yaw + np.cumsum(dr, axis=-1)
+            disp = np.stack([dxdy[...,0], np.zeros_like(dxdy[...,0]), dxdy[...,1]], axis=-1)
+            root_pos = last_pos + np.cumsum(kinematics_util.rotate_yaw(disp, yaws), axis=-2)
+        return yaws, root_pos, (yaws[-1], root_pos[-1])
+
+    def get_bvh_root_stream(self, x, state=None):
+        # bvh root position and heading of every frame, the integrated root positions and the root state after the last one
+        yaws, root_pos, new_state = self.integrate_root_stream(x, state)
+        # the bvh root of frame i sits where frame i-1 ended up, frame 0 keeps the identity heading
+        last_pos = root_pos[:1] if state is None else state[1][None]
+        dpm_lst = np.concatenate([last_pos, root_pos[:-1]], axis=0)
+        rot_headings = geo_util.yaw_to_matrix(yaws).reshape(-1,3,3)
+        if state is None:
+            rot_headings[0] = np.eye(3)
+        return dpm_lst, rot_headings, root_pos, new_state
 
-        dpm = np.array([[0.0,0.0,0.0]])
-        dpm_lst = np.zeros((dxdy.shape[0],3))
-        yaws = np.cumsum(dr)
-        yaws = yaws - (yaws//(np.pi*2))*(np.pi*2)
-        rot_headings = np.zeros((dxdy.shape[0],3,3))
-        rot_headings[0] = np.eye(3)
-        for i in range(1, yaws.shape[0]):
-            cur_pos = np.zeros((1,3))
-            cur_pos[0,0] = dxdy[i,0]
-            cur_pos[0,2] = dxdy[i,1]
-            dpm_lst[i,:] = copy.deepcopy(dpm)
-            dpm += np.dot(cur_pos, geo_util.rot_yaw(yaws[i]))
-            rot_headings[i,:] = geo_util.rot_yaw(yaws[i])
+    def x_to_rotation(self, x, mode):
+        dpm_lst, rot_headings, _, _ = self.get_bvh_root_stream(x)
            
         #root_rotmat_no_heading = torch.tensor(root_rotmat_no_heading)
         if mode == 'position':
@@ -664,6 +680,17 @@ class BaseMotionData(data.Dataset):
             rotation = self.ik_seq(x[0],x[1:])
             rotation = np.concatenate([rotation_0, rotation], axis = 0)
 
+        return self.to_bvh_pose(x, dpm_lst, rot_headings, rotation)
+
+    def x_to_rotation_stream(self, x, state=None):
+        # x_to_rotation(x, 'angle') of a motion fed chunk by chunk, state carries the root between chunks
+        dpm_lst, rot_headings, root_pos, state = self.get_bvh_root_stream(x, state)
+        rotation = x[..., self.angle_dim_lst[0]:self.angle_dim_lst[1]]
+        rotation = rotation.reshape((-1, self.num_jnt, self.data_rot_dim))
+        dpm_lst, rotation = self.to_bvh_pose(x, dpm_lst, rot_headings, rotation)
+        return dpm_lst, rotation, root_pos, state
+
+    def to_bvh_pose(self, x, dpm_lst, rot_headings, rotation):
         rotation = self.from_rpr_to_rotmat(torch.tensor(rotation)).cpu().numpy()
         rotation[:,0,...] = np.matmul(rot_headings.transpose(0,2,1),rotation[:,0,...])
         rotation = geo_util.rotation_matrix_to_euler(rotation, self.rotate_order)/np.pi*180
@@ -672,12 +699,7 @@ class BaseMotionData(data.Dataset):
         return dpm_lst, rotation
     
     def x_to_jnts(self, x, mode):
-        dxdy = x[...,:self.data_root_linear_dim] 
-        if self.data_root_rot_dim>1:
-            m6d = self.from_rpr_to_rotmat(x[...,self.data_root_linear_dim:self.data_root_dim])
-            dr, _ = geo_util.sepr_rot_heading(m6d)
-        else:
-            dr = x[...,self.data_root_linear_dim]
+        dxdy, dr = self.get_root_dxdy_dr(x)
        
         if mode == 'angle':
             jnts = self.fk_local_seq(x) 
@@ -696,39 +718,16 @@ class BaseMotionData(data.Dataset):
             x[..., [self.joint_dim_lst[0],self.joint_dim_lst[0]+2]] *= 0
             jnts = self.jnts_step_seq(x)
         
-        dpm = np.array([[0.0,0.0,0.0]])
-        dpm_lst = np.zeros((dxdy.shape[0],3))
-        yaws = np.cumsum(dr)
-        yaws = yaws - (yaws//(np.pi*2))*(np.pi*2)
-        for i in range(1, jnts.shape[0]):
-            cur_pos = np.zeros((1,3))
-            cur_pos[0,0] = dxdy[i,0]
-            cur_pos[0,2] = dxdy[i,1]
-            dpm += np.dot(cur_pos, geo_util.rot_yaw(yaws[i]))
-            dpm_lst[i,:] = copy.deepcopy(dpm)
-            jnts[i,:,:] = np.dot(jnts[i,:,:], geo_util.rot_yaw(yaws[i])) + copy.deepcopy(dpm)
+        yaws, root_pos = kinematics_util.integrate_root(dxdy, dr)
+        jnts[...,1:,:,:] = kinematics_util.rotate_yaw(jnts[...,1:,:,:], yaws[...,1:,None]) + root_pos[...,1:,None,:]
         return jnts
         
     def x_to_trajs(self,x):
-        dxdy = x[...,:self.data_root_linear_dim] 
-        if self.data_root_rot_dim>1:
-            m6d = self.from_rpr_to_rotmat(x[...,self.data_root_linear_dim:self.data_root_dim])
-            dr, _ = geo_util.sepr_rot_heading(m6d)
-        else:
-            dr = x[...,self.data_root_linear_dim]
+        dxdy, dr = self.get_root_dxdy_dr(x)
 
         #jnts = np.reshape(x[...,3:69],(-1,self.num_jnt,3))
-        dpm = np.array([[0.0,0.0,0.0]])
-        dpm_lst = np.zeros((dxdy.shape[0],3))
-        yaws = np.cumsum(dr)
-        yaws = yaws - (yaws//(np.pi*2))*(np.pi*2)
-        for i in range(1, x.shape[0]):
-           cur_pos = np.zeros((1,3))
-           cur_pos[0,0] = dxdy[i,0]
-           cur_pos[0,2] = dxdy[i,1]
-           dpm += np.dot(cur_pos,geo_util.rot_yaw(yaws[i]))
-           dpm_lst[i,:] = copy.deepcopy(dpm)
-        return dpm_lst[...,[0,2]]
+        _, root_pos = kinematics_util.integrate_root(dxdy, dr)
+        return root_pos[...,[0,2]]
     
 
     def save_bvh(self, out_path, xs):
@@ -737,6 +736,18 @@ class BaseMotionData(data.Dataset):
         joint_offset = self.joint_offset * 1 / unit_util.unit_conver_scale(self.unit)
         bvh_util.output_as_bvh(out_path+'.bvh', xyzs_seq, euler_angle, self.rotate_order,
                             self.joint_names, self.joint_parent, joint_offset, self.fps) 
+
+    def open_bvh_stream(self, out_path):
+        # save_bvh for a motion still being generated, frames are added with append_bvh_stream
+        joint_offset = self.joint_offset * 1 / unit_util.unit_conver_scale(self.unit)
+        return bvh_util.BVHWriter(out_path+'.bvh', self.rotate_order, self.joint_names, self.joint_parent, joint_offset, self.fps)
+
+    def append_bvh_stream(self, writer, xs, state=None):
+        # appends the denormalized frames xs, returns their integrated root positions [n, 3]
+        # and the root state to pass along with the next chunk
+        xyzs_seq, euler_angle, root_pos, state = self.x_to_rotation_stream(xs, state)
+        writer.write_frames(xyzs_seq * 1/ unit_util.unit_conver_scale(self.unit), euler_angle)
+        return root_pos, state
     
 
     def __len__(self):
@@ -744,5 +755,5 @@ class BaseMotionData(data.Dataset):
 
     def __getitem__(self, idx):
         idx_ = self.valid_idx[idx]
-        motion = self.motion_flattened[idx_:idx_+self.rollout]
+        motion = np.array(self.motion_flattened[idx_:idx_+self.rollout]) # copy out of the read-only memory map
         return  motion 
\ No newline at end of file
@@ -7,6 +7,7 @@ import torch
 import dataset.lafan1_dataset as lafan1_dataset
 import dataset.util.bvh as bvh_util
 import dataset.util.geo as geo_util
+import dataset.util.kinematics as kinematics_util
 import dataset.util.plot as plot_util
 
 class LAFAN1_hetero(lafan1_dataset.LAFAN1):
@@ -146,26 +147,19 @@ class LAFAN1_hetero(lafan1_dataset.LAFAN1):
             rt = [index_offset + index_key*self.data_rot_dim, index_offset + index_key*self.data_rot_dim + self.data_rot_dim]
         return rt
     
-    def x_to_rotation(self, x, mode):
+    def get_root_dxdy_dr(self, x):
+        # per frame heading change from the 6d root rotation, frame 0 is the reference heading
         dxdy = x[...,:2] 
-        dr = geo_util.rotation_6d_to_matrix(x[...,2:8])
-        dr, _ = geo_util.sepr_rot_heading(dr)
-
-        nframe = dxdy.shape[0]
-        dpm = np.array([[0.0,0.0,0.0]])
-        dpm_lst = np.zeros((dxdy.shape[0],3))
-        
-        rot_headings = np.zeros((dxdy.shape[0],3,3))
-        rot_headings[0] = np.eye(3)
-        for i in range(1, nframe):
-            cur_pos = np.zeros((1,3))
-            cur_pos[0,0] = dxdy[i,0]
-            cur_pos[0,2] = dxdy[i,1]
-            dpm_lst[i,:] = copy.deepcopy(dpm)
-            cur_rot = np.dot(rot_headings[i-1],dr[i])
+        rot = geo_util.m6d_to_rotmat(torch.tensor(x[...,2:8])).numpy()
+        dr = np.arctan2(rot[...,0,2], rot[...,2,2])
+        dr[...,0] = 0
+        return dxdy, dr
 
-            dpm += np.dot(cur_pos, cur_rot)
-            rot_headings[i,:] = copy.deepcopy(cur_rot)
+    def x_to_rotation(self, x, mode):
+        dxdy, dr = self.get_root_dxdy_dr(x)
+        yaws, root_pos = kinematics_util.integrate_root(dxdy, dr)
+        dpm_lst = np.concatenate([root_pos[:1], root_pos[:-1]], axis=0)
+        rot_headings = geo_util.yaw_to_matrix(yaws).reshape(-1,3,3)
             
         if mode == 'position':
             rotation_0 = x[0, self.angle_dim_lst[0]:self.angle_dim_lst[1]]
@@ -194,9 +188,7 @@ class LAFAN1_hetero(lafan1_dataset.LAFAN1):
         return dpm_lst, rotation
     
     def x_to_jnts(self, x, mode):
-        dxdy = x[...,:2] 
-        dr = geo_util.rotation_6d_to_matrix(x[...,2:8])
-        dr, _ = geo_util.sepr_rot_heading(dr)
+        dxdy, dr = self.get_root_dxdy_dr(x)
         #ang_frames[:, self.data_rot_dim*i: self.data_rot_dim*i+self.data_rot_dim]
         
         if mode == 'angle':
@@ -213,41 +205,14 @@ class LAFAN1_hetero(lafan1_dataset.LAFAN1):
             x[1:, self.angle_dim_lst[0]:self.angle_dim_lst[1]] = rotations.reshape(-1,self.data_rot_dim*self.num_jnt)
             jnts = self.fk_local_seq(x)
         #return jnts
-        dpm = np.array([[0.0,0.0,0.0]])
-        dpm_lst = np.zeros((dxdy.shape[0],3))
-
-        rot_headings = np.zeros((dxdy.shape[0],3,3))
-        rot_headings[0] = np.eye(3)
-        for i in range(1, jnts.shape[0]):
-            cur_pos = np.zeros((1,3))
-            cur_pos[0,0] = dxdy[i,0]
-            cur_pos[0,2] = dxdy[i,1]
-            cur_rot = np.dot(rot_headings[i-1],dr[i])
-
-            dpm += np.dot(cur_pos, cur_rot)
-            dpm_lst[i,:] = copy.deepcopy(dpm)
-            rot_headings[i] = copy.deepcopy(cur_rot)
-            jnts[i,:,:] = np.dot(jnts[i,:,:], cur_rot) + copy.deepcopy(dpm)
+        yaws, root_pos = kinematics_util.integrate_root(dxdy, dr)
+        jnts[...,1:,:,:] = kinematics_util.rotate_yaw(jnts[...,1:,:,:], yaws[...,1:,None]) + root_pos[...,1:,None,:]
         return jnts
         
     def x_to_trajs(self,x):
-        dxdy = x[...,:2] 
-        dr = geo_util.rotation_6d_to_matrix(x[...,2:8])
-        dr, _ = geo_util.sepr_rot_heading(dr)
-        #jnts = np.reshape(x[...,3:69],(-1,self.num_jnt,3))
-        dpm = np.array([[0.0,0.0,0.0]])
-        dpm_lst = np.zeros((dxdy.shape[0],3))
-        rot_headings = np.zeros((dxdy.shape[0],3,3))
-        rot_headings[0] = np.eye(3)
-        for i in range(1, x.shape[0]):
-           cur_pos = np.zeros((1,3))
-           cur_pos[0,0] = dxdy[i,0]
-           cur_pos[0,2] = dxdy[i,1]
-           cur_rot = np.dot(rot_headings[i-1],dr[i])
-           dpm += np.dot(cur_pos,cur_rot)
-           rot_headings[i] = copy.deepcopy(cur_rot)
-           dpm_lst[i,:] = copy.deepcopy(dpm)
-        return dpm_lst[...,[0,2]]
+        dxdy, dr = self.get_root_dxdy_dr(x)
+        _, root_pos = kinematics_util.integrate_root(dxdy, dr)
+        return root_pos[...,[0,2]]
     
 
     def get_motion_fpaths(self):
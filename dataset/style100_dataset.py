@@ -88,7 +88,7 @@ class STYLE100(base_dataset.BaseMotionData):
 
     def __getitem__(self, idx):
         idx_ = self.valid_idx[idx]
-        motion = self.motion_flattened[idx_:idx_+self.rollout]
+        motion = np.array(self.motion_flattened[idx_:idx_+self.rollout]) # copy out of the read-only memory map
         return motion
     
     def plot_jnts(self, x, path=None):
@@ -1,6 +1,7 @@
 
 import os
 import os.path as osp
+import re
 import numpy as np
 import copy
 
@@ -90,10 +91,77 @@ def load_bvh_info(bvh_file_path):
     return joint_name, joint_parent, joint_offset, joint_rot_order, joint_chn_num, frame_time
 
 
-def import_bvh(bvh_file, root_joint_name=None, end_eff=False):
-    with open(bvh_file, "rb") as file:
-        items = [w.decode() for line in file for w in line.strip().split()]
-        n_items = len(items)
+def read_motion_frames(values, joint_list, num_frames, root_joint_name=None):
+    """
+    values: flat float array of the MOTION block, channels of every joint in joint_list order, frame after frame
+    returns root translation [num_frames, 3] and local rotations [num_frames, num_jnt, 3, 3],
+    the euler channels of all joints sharing a rotation order are converted in one batched call
+    """
+    num_jnt = len(joint_list)
+    num_channels = sum([joint._ndof for joint in joint_list])
+    frames = np.asarray(values[:num_frames * num_channels], dtype=np.float64).reshape(num_frames, num_channels)
+
+    rotations = np.zeros((num_frames, num_jnt, 3, 3))
+    root_trans = np.zeros((num_frames, 3))
+    order_channels = dict() # rotation order -> (joint indices, first euler channel of each joint)
+    start = 0
+    for idx_jnt, joint in enumerate(joint_list):
+        dof = joint._ndof
+        if dof == 6:
+            if joint._parent_idx is None or (root_joint_name is not None and joint._name == root_joint_name):
+                root_trans = frames[:, start:start+3]
+            order_channels.setdefault(joint._rot_axis_order, ([], []))
+            order_channels[joint._rot_axis_order][0].append(idx_jnt)
+            order_channels[joint._rot_axis_order][1].append(start+3)
+        elif 0 < dof <= 3:
+            order_channels.setdefault(joint._rot_axis_order, ([], []))
+            order_channels[joint._rot_axis_order][0].append(idx_jnt)
+            order_channels[joint._rot_axis_order][1].append(start)
+        start += dof
+
+    for rot_axis_order, (jnt_idx, chn_start) in order_channels.items():
+        chn_idx = np.array(chn_start)[:, None] + np.arange(len(rot_axis_order))[None]
+        eulers = frames[:, chn_idx].reshape(-1, len(rot_axis_order))
+        rotations[:, jnt_idx] = R.from_euler(rot_axis_order, eulers, degrees=True).as_matrix().reshape(num_frames, len(jnt_idx), 3, 3)
+    return np.array(root_trans), rotations
+
+
+def read_motion_frames_loop(items, joint_list, num_frames, root_joint_name=None):
+    # reference per frame, per joint parser of the MOTION block tokens, kept to check read_motion_frames against
+    num_jnt = len(joint_list)
+    rotations = np.zeros((num_frames, num_jnt, 3, 3))
+    root_trans = np.zeros((num_frames, 3))
+    cnt = 0
+    for idx_frame in range(num_frames):
+        for idx_jnt in range(num_jnt):
+            dof = joint_list[idx_jnt]._ndof
+            rot_axis_order = joint_list[idx_jnt]._rot_axis_order
+            vec = np.array([float(x) for x in items[cnt: cnt + dof]])
+            if dof == 6:
+                if joint_list[idx_jnt]._parent_idx is None:
+                    root_trans[idx_frame] = vec[:3]
+                    rotations[idx_frame, idx_jnt] = R.from_euler(rot_axis_order, vec[3:], degrees=True).as_matrix()               
+                else:
+                    if root_joint_name is not None and joint_list[idx_jnt]._name == root_joint_name:
+                        root_trans[idx_frame] = vec[:3]
+                    rotations[idx_frame, idx_jnt] = R.from_euler(rot_axis_order, vec[3:], degrees=True).as_matrix()
+                cnt += dof
+
+            elif 0 < dof <= 3:
+                rotations[idx_frame, idx_jnt] = R.from_euler(rot_axis_order, vec[:dof], degrees=True).as_matrix() 
+                cnt += dof
+    return root_trans, rotations
+
+
+def import_bvh(bvh_file, root_joint_name=None, end_eff=False, vectorized=True):
+    with open(bvh_file, "r") as file:
+        text = file.read()
+
+    # only the hierarchy is tokenized, the MOTION block is parsed as one float array
+    motion_match = re.search(r'^\s*MOTION\s*$', text, re.MULTILINE | re.IGNORECASE)
+    assert motion_match is not None, "no MOTION block in {}".format(bvh_file)
+    items = text[:motion_match.start()].split()
+    n_items = len(items)
 
     cnt, depth = 0, 0
     joint_stack = [None, None]
@@ -179,46 +247,20 @@ def import_bvh(bvh_file, root_joint_name=None, end_eff=False):
 
     skeleton.add_joints(joint_list)
 
-    num_jnt = len(joint_list)
     motion = Motion(skeleton)
 
     # load motion info
-    while cnt < n_items:
-        item = items[cnt].lower()
-        if item == 'motion':
-            cnt += 1
-
-        elif item == 'frames:':
-            num_frames = int(items[cnt+1])
-            cnt += 2
-
-        elif item == 'frame' and items[cnt+1].lower() == 'time:':
-            fps = round(1.0/float(items[cnt+2]))
-            motion.set_fps(fps)
-            cnt += 3
-            break
+    frame_match = re.compile(r'Frames:\s*(\d+)\s+Frame\s+Time:\s*(\S+)', re.IGNORECASE).search(text, motion_match.end())
+    num_frames = int(frame_match.group(1))
+    fps = round(1.0/float(frame_match.group(2)))
+    motion.set_fps(fps)
     
     # load motion
-    rotations = np.zeros((num_frames, num_jnt, 3, 3))
-    root_trans = np.zeros((num_frames, 3))
-    for idx_frame in range(num_frames):
-        for idx_jnt in range(num_jnt):
-            dof = joint_list[idx_jnt]._ndof
-            rot_axis_order = joint_list[idx_jnt]._rot_axis_order
-            vec = np.array([float(x) for x in items[cnt: cnt + dof]])
-            if dof == 6:
-                if joint_list[idx_jnt]._parent_idx is None:
-                    root_trans[idx_frame] = vec[:3]
-                    rotations[idx_frame, idx_jnt] = R.from_euler(rot_axis_order, vec[3:], degrees=True).as_matrix()               
-                else:
-                    if root_joint_name is not None and joint_list[idx_jnt]._name == root_joint_name:
-                        root_trans[idx_frame] = vec[:3]
-                    rotations[idx_frame, idx_jnt] = R.from_euler(rot_axis_order, vec[3:], degrees=True).as_matrix()
-                cnt += dof
-
-            elif 0 < dof <= 3:
-                rotations[idx_frame, idx_jnt] = R.from_euler(rot_axis_order, vec[:dof], degrees=True).as_matrix() 
-                cnt += dof
+    if vectorized:
+        values = np.array(text[frame_match.end():].split(), dtype=np.float64)
+        root_trans, rotations = read_motion_frames(values, joint_list, num_frames, root_joint_name)
+    else:
+        root_trans, rotations = read_motion_frames_loop(text[frame_match.end():].split(), joint_list, num_frames, root_joint_name)
 
     motion.set_motion_frames(root_trans, rotations)
     return motion
@@ -245,7 +287,7 @@ def export_bvh(file_path, motion, offset_translate=None, offset_rotate=None):
     output_as_bvh(file_path, root_xyzs, joint_eulers, joint_euler_order, joint_names, joint_parent, joint_offset, target_fps)
 
 
-def output_as_bvh(file_path, root_xyz, joint_rot_eulers, joint_rot_order, joint_names, joint_parents, joint_offset, target_fps):
+def write_bvh_hierarchy(out_file, joint_rot_order, joint_names, joint_parents, joint_offset):
     child_lst = [[] for _ in joint_names]
     root_index = 0
     for i,i_p in enumerate(joint_parents):
@@ -262,10 +304,6 @@ def output_as_bvh(file_path, root_xyz, joint_rot_eulers, joint_rot_order, joint_
     else:
         raise NotImplementedError
     
-    if osp.exists(file_path):
-        os.remove(file_path)
-    out_file = open(file_path,'w+')
-    
     out_str = 'HIERARCHY\n'
     out_str+= 'ROOT {}\n'.format(joint_names[root_index])
     out_str+= '{\n'
@@ -300,23 +338,67 @@ def output_as_bvh(file_path, root_xyz, joint_rot_eulers, joint_rot_order, joint_
 
     form_str(out_file, root_index, child_lst[root_index], 1)
     out_file.write('}\n')
-    
-    frames = joint_rot_eulers.shape[0]
-    out_str = 'MOTION\n'
-    out_str += 'Frames: {}\n'.format(frames)
-    out_str += 'Frame Time: {:6f}\n'.format(1.0/target_fps)
-    out_file.write(out_str)
 
-    for i in range(frames):
+
+def write_bvh_frames(out_file, root_xyz, joint_rot_eulers):
+    for i in range(joint_rot_eulers.shape[0]):
         out_str = ''
         out_str += '{:6f} {:6f} {:6f}'.format(root_xyz[i][0],root_xyz[i][1],root_xyz[i][2])
         for r in joint_rot_eulers[i]:
             out_str += ' {:6f} {:6f} {:6f}'.format(r[0],r[1],r[2])
         out_str += '\n'
         out_file.write(out_str)
+
+
+def output_as_bvh(file_path, root_xyz, joint_rot_eulers, joint_rot_order, joint_names, joint_parents, joint_offset, target_fps):
+    if osp.exists(file_path):
+        os.remove(file_path)
+    out_file = open(file_path,'w+')
+    write_bvh_hierarchy(out_file, joint_rot_order, joint_names, joint_parents, joint_offset)
+    
+    frames = joint_rot_eulers.shape[0]
+    out_str = 'MOTION\n'
+    out_str += 'Frames: {}\n'.format(frames)
+    out_str += 'Frame Time: {:6f}\n'.format(1.0/target_fps)
+    out_file.write(out_str)
+
+    write_bvh_frames(out_file, root_xyz, joint_rot_eulers)
     out_file.close()
 
 
+class BVHWriter():
+    """BVH file written in chunks of frames, for motions that are still being generated.
+
+    The hierarchy is written on open and frames are appended as they come. The Frames: count is
+    padded to a fixed width and patched in place after every chunk, so the file on disk is a valid BVH
+    between writes.
+    """
+    FRAMES_WIDTH = 10
+
+    def __init__(self, file_path, joint_rot_order, joint_names, joint_parents, joint_offset, target_fps):
+        self.num_frames = 0
+        self.out_file = open(file_path, 'w')
+        write_bvh_hierarchy(self.out_file, joint_rot_order, joint_names, joint_parents, joint_offset)
+        self.out_file.write('MOTION\n')
+        self.frames_pos = self.out_file.tell()
+        self.out_file.write(self.get_frames_line())
+        self.out_file.write('Frame Time: {:6f}\n'.format(1.0/target_fps))
+        self.out_file.flush()
+
+    def get_frames_line(self):
+        return 'Frames: {}\n'.format(str(self.num_frames).ljust(self.FRAMES_WIDTH))
+
+    def write_frames(self, root_xyz, joint_rot_eulers):
+        self.out_file.seek(0, os.SEEK_END)
+        write_bvh_frames(self.out_file, root_xyz, joint_rot_eulers)
+        self.num_frames += joint_rot_eulers.shape[0]
+        self.out_file.seek(self.frames_pos)
+        self.out_file.write(self.get_frames_line())
+        self.out_file.flush()
+
+    def close(self):
+        self.out_file.close()
+
 
 def read_bvh_loco(path, unit, target_fps, root_rot_offset=0, frame_start=None, frame_end=None):
     motion = import_bvh(path, end_eff=False)
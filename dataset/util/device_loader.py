@@ -0,0 +1,58 @@
+import numpy as np
+import torch
+
+
+class DeviceMotionLoader():
+    """Drop-in replacement of the training DataLoader that keeps the whole motion on the device.
+
+    motion_flattened and valid_idx are uploaded once, every batch of [B, rollout, D] windows is
+    then one gather of valid_idx[perm] + arange(rollout) rows, with no per sample python or host copies.
+    Batches follow a fresh permutation every epoch (set_epoch), shared by all ranks and split
+    between them like DistributedSampler; with replacement every batch is drawn with one randint instead,
+    from a generator seeded per rank so the ranks draw different batches.
+    """
+    def __init__(self, motion, valid_idx, rollout, batch_size, device, drop_last=True,
+                 replacement=False, num_procs=1, rank=0, seed=0):
+        self.motion = torch.as_tensor(np.asarray(motion), dtype=torch.float32, device=device)
+        self.valid_idx = torch.as_tensor(np.asarray(valid_idx), dtype=torch.long, device=device)
+        self.offsets = torch.arange(rollout, device=device)
+        self.batch_size = batch_size
+        self.device = device
+        self.drop_last = drop_last
+        self.replacement = replacement
+        self.num_procs = num_procs
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+        # windows this rank sees per epoch, the tail that does not split evenly over ranks is dropped
+        self.num_samples = len(self.valid_idx) // self.num_procs
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+    def get_batch(self, idx):
+        # [B] positions in valid_idx -> [B, rollout, D] windows
+        start = self.valid_idx[idx]
+        return self.motion[start[:, None] + self.offsets]
+
+    def __iter__(self):
+        generator = torch.Generator(device=self.device)
+
+        if self.replacement:
+            generator.manual_seed((self.seed + self.epoch) * self.num_procs + self.rank)
+            for _ in range(len(self)):
+                idx = torch.randint(len(self.valid_idx), (self.batch_size,), device=self.device, generator=generator)
+                yield self.get_batch(idx)
+            return
+
+        generator.manual_seed(self.seed + self.epoch)
+        perm = torch.randperm(len(self.valid_idx), device=self.device, generator=generator)
+        perm = perm[:self.num_samples * self.num_procs][self.rank::self.num_procs]
+        for i in range(len(self)):
+            yield self.get_batch(perm[i * self.batch_size:(i + 1) * self.batch_size])
@@ -0,0 +1,122 @@
+import numpy as np
+import torch
+
+
+def get_joint_levels(joint_parent):
+    # group joints by their depth in the tree, every joint comes after its parent's level
+    depth = [-1] * len(joint_parent)
+    def get_depth(i):
+        if depth[i] < 0:
+            depth[i] = 0 if joint_parent[i] == -1 else get_depth(joint_parent[i]) + 1
+        return depth[i]
+
+    for i in range(len(joint_parent)):
+        get_depth(i)
+
+    levels = [[] for _ in range(max(depth) + 1)]
+    for i, d in enumerate(depth):
+        levels[d].append(i)
+    return levels
+
+
+class ForwardKinematics():
+    """Batched forward kinematics for a fixed skeleton.
+
+    Joints are sorted by depth and kept joint-major internally, so every level of the tree is a
+    contiguous slice posed with one batched matmul, and the python loop runs over the depth of
+    the tree instead of over every joint. Inputs may have any leading batch dims.
+    """
+    def __init__(self, joint_parent):
+        self.joint_parent = list(joint_parent)
+        self.num_jnt = len(self.joint_parent)
+        self.levels = get_joint_levels(self.joint_parent)
+
+        # level-sorted order, the position of every joint in it, and each level's [start, end) slice
+        self.order = [j for level in self.levels for j in level]
+        sorted_idx = {j: i for i, j in enumerate(self.order)}
+        self.inv_order = [sorted_idx[j] for j in range(self.num_jnt)]
+        self.sorted_parent = [sorted_idx[self.joint_parent[j]] if self.joint_parent[j] != -1 else -1 for j in self.order]
+        self.level_bounds = []
+        start = 0
+        for level in self.levels:
+            self.level_bounds.append((start, start + len(level)))
+            start += len(level)
+        self._index_cache = dict()
+
+    def get_index(self, device):
+        if device not in self._index_cache:
+            self._index_cache[device] = {
+                'order': torch.tensor(self.order, device=device),
+                'inv_order': torch.tensor(self.inv_order, device=device),
+                'parent': torch.tensor(self.sorted_parent, device=device).clamp(min=0),
+            }
+        return self._index_cache[device]
+
+    def _forward_sorted(self, local_rotation, joint_offset):
+        index = self.get_index(local_rotation.device)
+        batch_shape = local_rotation.shape[:-3]
+
+        joint_offset = torch.as_tensor(joint_offset, device=local_rotation.device, dtype=local_rotation.dtype)
+        if joint_offset.dim() == 2:
+            joint_offset = joint_offset.view((self.num_jnt,) + (1,) * len(batch_shape) + (3,))
+        else:
+            joint_offset = joint_offset.movedim(-2, 0)
+        joint_offset = joint_offset.index_select(0, index['order'])
+
+        # [J, ..., 3, 3] in level order
+        local_rotation = local_rotation.movedim(-3, 0).index_select(0, index['order'])
+        joint_orientations = torch.empty_like(local_rotation)
+        joint_positions = local_rotation.new_zeros(local_rotation.shape[:-1])
+
+        start, end = self.level_bounds[0]
+        joint_orientations[start:end] = local_rotation[start:end]
+        for start, end in self.level_bounds[1:]:
+            parent_orientations = joint_orientations.index_select(0, index['parent'][start:end])
+            joint_orientations[start:end] = torch.matmul(parent_orientations, local_rotation[start:end])
+            joint_positions[start:end] = joint_positions.index_select(0, index['parent'][start:end]) + \
+                torch.einsum('k...ij,k...j->k...i', parent_orientations, joint_offset[start:end])
+
+        return joint_positions, joint_orientations, index['inv_order']
+
+    def forward_orient(self, local_rotation, joint_offset):
+        """
+        local_rotation: [..., J, 3, 3] local rotation matrices
+        joint_offset: [J, 3] or [..., J, 3]
+        returns joint positions [..., J, 3] with the root at the origin and global orientations [..., J, 3, 3]
+        """
+        joint_positions, joint_orientations, inv_order = self._forward_sorted(local_rotation, joint_offset)
+        return joint_positions.index_select(0, inv_order).movedim(0, -2), joint_orientations.index_select(0, inv_order).movedim(0, -3)
+
+    def forward(self, local_rotation, joint_offset):
+        joint_positions, _, inv_order = self._forward_sorted(local_rotation, joint_offset)
+        return joint_positions.index_select(0, inv_order).movedim(0, -2)
+
+
+def rotate_yaw(v, yaw):
+    # row vectors times geo_util.rot_yaw(yaw), v: [..., 3], yaw broadcastable to v[..., 0], numpy or torch
+    if torch.is_tensor(v):
+        cs, sn = torch.cos(yaw), torch.sin(yaw)
+        return torch.stack([v[...,0] * cs - v[...,2] * sn, v[...,1], v[...,0] * sn + v[...,2] * cs], dim=-1)
+    cs, sn = np.cos(yaw), np.sin(yaw)
+    return np.stack([v[...,0] * cs - v[...,2] * sn, v[...,1], v[...,0] * sn + v[...,2] * cs], axis=-1)
+
+
+def integrate_root(dxdy, dr):
+    """
+    dxdy: [..., N, 2] planar root displacement of every frame in its own heading frame
+    dr: [..., N] heading change of every frame
+    returns the heading yaws [..., N] (cumulative dr) and root positions [..., N, 3] (x, 0, z)
+    frame 0 is the reference: it stays at the origin and its displacement is not applied
+    """
+    if torch.is_tensor(dxdy):
+        yaws = torch.cumsum(dr, dim=-1)
+        disp = torch.stack([dxdy[...,0], torch.zeros_like(dxdy[...,0]), dxdy[...,1]], dim=-1)
+        disp = rotate_yaw(disp, yaws)
+        disp[...,0,:] = 0
+        return yaws, torch.cumsum(disp, dim=-2)
+    
+    yaws = np.cumsum(dr, axis=-1)
+    disp = np.stack([dxdy[...,0], np.zeros_like(dxdy[...,0]), dxdy[...,1]], axis=-1)
+    disp = rotate_yaw(disp, yaws)
+    disp[...,0,:] = 0
+    return yaws, np.cumsum(disp, axis=-2)
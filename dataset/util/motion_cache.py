@@ -0,0 +1,168 @@
+import glob
+import os
+import os.path as osp
+import pickle
+import resource
+import zipfile
+import numpy as np
+
+
+def get_rss_mb():
+    # resident set size of this process, falls back to the peak rss where /proc is not available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+class ShardedArray():
+    """Read-only array made of shards concatenated along the first axis, without copying them.
+
+    Integer and slice indexing within one shard return views of that shard, so memory-mapped
+    shards stay shared through the page cache; anything spanning shards is gathered into a new array.
+    """
+    def __init__(self, shards):
+        assert len(shards) > 0, "ShardedArray needs at least one shard"
+        self.shards = shards
+        self.offsets = np.cumsum([0] + [len(shard) for shard in shards])
+        self.shape = (int(self.offsets[-1]),) + tuple(shards[0].shape[1:])
+        self.dtype = shards[0].dtype
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        out = np.concatenate(self.shards, axis=0)
+        return out if dtype is None else out.astype(dtype)
+
+    def reshape(self, *shape):
+        return np.asarray(self).reshape(*shape)
+
+    def locate(self, idx):
+        shard_idx = np.searchsorted(self.offsets, idx, side='right') - 1
+        return shard_idx, idx - self.offsets[shard_idx]
+
+    def __getitem__(self, key):
+        rest = ()
+        if isinstance(key, tuple):
+            key, rest = key[0], key[1:]
+
+        if isinstance(key, (int, np.integer)):
+            idx = key + len(self) if key < 0 else key
+            shard_idx, local_idx = self.locate(idx)
+            return self.shards[shard_idx][(local_idx,) + rest]
+
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1 and start < stop:
+                shard_idx, local_start = self.locate(start)
+                if stop <= self.offsets[shard_idx + 1]:
+                    return self.shards[shard_idx][(slice(local_start, local_start + stop - start),) + rest]
+            key = np.arange(start, stop, step)
+
+        idx = np.asarray(key)
+        if idx.dtype == bool:
+            idx = np.nonzero(idx)[0]
+        flat_idx = idx.reshape(-1)
+        flat_idx = np.where(flat_idx < 0, flat_idx + len(self), flat_idx)
+        out = np.empty((len(flat_idx),) + self.shape[1:], dtype=self.dtype)
+        shard_ids, local_ids = self.locate(flat_idx)
+        for shard_idx in np.unique(shard_ids):
+            mask = shard_ids == shard_idx
+            out[mask] = self.shards[shard_idx][local_ids[mask]]
+        out = out.reshape(idx.shape + self.shape[1:])
+        return out[(slice(None),) * idx.ndim + rest] if len(rest) > 0 else out
+
+
+class MotionCache():
+    """Motion cache made of raw .npy shards plus a small index.npz.
+
+    Every shard holds whole clips, so a training window never spans two shards. Shards are opened
+    with mmap_mode='r' so dataloader workers and ranks share their pages, and new clips are appended
+    as new shards without touching the existing ones.
+    """
+    INDEX_FILE = 'index.npz'
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.index_path = osp.join(cache_dir, self.INDEX_FILE)
+
+    def exists(self):
+        # an unreadable index, one without shards or one missing a shard counts as no cache, it is rebuilt
+        index = self.read_index()
+        return index is not None and len(index['shard_files']) > 0 and \
+            all(osp.exists(osp.join(self.cache_dir, fname)) for fname in index['shard_files'])
+
+    def read_index(self):
+        if not osp.exists(self.index_path):
+            return None
+        try:
+            with np.load(self.index_path, allow_pickle=True) as index:
+                return {
+                    'shard_files': index['shard_files'].tolist(),
+                    'valid_range': index['valid_range'],
+                    'file_lst': index['file_lst'].tolist(),
+                    'labels': index['labels'].tolist(),
+                }
+        except (OSError, ValueError, KeyError, EOFError, pickle.UnpicklingError, zipfile.BadZipFile):
+            return None
+
+    def load_index(self):
+        index = self.read_index()
+        if index is None:
+            return {'shard_files': [], 'valid_range': np.zeros((0, 2), dtype=np.int64), 'file_lst': [], 'labels': []}
+        return index
+
+    def clear(self):
+        index = self.read_index()
+        # without a readable index every shard in the directory goes
+        shard_files = index['shard_files'] if index is not None else \
+            [osp.basename(path) for path in glob.glob(osp.join(self.cache_dir, 'motion_*.npy'))]
+        for fname in shard_files:
+            if osp.exists(osp.join(self.cache_dir, fname)):
+                os.remove(osp.join(self.cache_dir, fname))
+        if osp.exists(self.index_path):
+            os.remove(self.index_path)
+
+    def load(self, mmap_mode='r'):
+        assert self.exists(), "no motion cache in {}, rebuild it".format(self.cache_dir)
+        index = self.load_index()
+        shards = [np.load(osp.join(self.cache_dir, fname), mmap_mode=mmap_mode) for fname in index['shard_files']]
+        motion = shards[0] if len(shards) == 1 else ShardedArray(shards)
+        return motion, index['valid_range'], index['file_lst'], index['labels']
+
+    def append(self, clips, file_lst, labels=None, shard_frames=1000000):
+        """
+        clips: list of [num_frame, frame_dim] arrays, already normalized
+        writes them as new shards of at most shard_frames frames (a longer clip gets a shard of its own)
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        index = self.load_index()
+        total_len = int(index['valid_range'][-1][1]) if len(index['valid_range']) > 0 else 0
+        new_range = []
+        shard, shard_len = [], 0
+        for clip in clips:
+            if shard_len > 0 and shard_len + len(clip) > shard_frames:
+                index['shard_files'].append(self._write_shard(shard, len(index['shard_files'])))
+                shard, shard_len = [], 0
+            shard.append(clip)
+            shard_len += len(clip)
+            new_range.append([total_len, total_len + len(clip)])
+            total_len += len(clip)
+        if shard_len > 0:
+            index['shard_files'].append(self._write_shard(shard, len(index['shard_files'])))
+
+        index['valid_range'] = np.concatenate([index['valid_range'].reshape(-1, 2), np.array(new_range, dtype=np.int64).reshape(-1, 2)])
+        index['file_lst'] = index['file_lst'] + list(file_lst)
+        index['labels'] = index['labels'] + (list(labels) if labels is not None else [])
+        # the index is written last, a crash while writing shards leaves the old cache intact
+        np.savez(self.index_path + '.tmp.npz', shard_files=np.array(index['shard_files']), valid_range=index['valid_range'],
+                 file_lst=np.array(index['file_lst']), labels=np.array(index['labels'], dtype=object))
+        os.replace(self.index_path + '.tmp.npz', self.index_path)
+
+    def _write_shard(self, clips, shard_idx):
+        fname = 'motion_{:05d}.npy'.format(shard_idx)
+        np.save(osp.join(self.cache_dir, fname), np.concatenate(clips, axis=0))
+        return fname
@@ -0,0 +1,84 @@
+import numpy as np
+import torch
+
+
+class Normalizer(torch.nn.Module):
+    """Normalization of motion features, zscore or minmax, as one affine map x = t * scale + shift.
+
+    The stats are registered buffers, device / dtype copies of them (and of any column subset)
+    are made once and cached, so norm / denorm of torch tensors never copy from the host.
+    Numpy inputs are handled with the original numpy stats.
+    """
+    def __init__(self, normalization):
+        super().__init__()
+        self.normalization = dict(normalization)
+        if normalization['mode'] == 'zscore':
+            scale, shift = normalization['std'], normalization['avg']
+        elif normalization['mode'] == 'minmax':
+            scale = (normalization['max'] - normalization['min']) / 2
+            shift = normalization['min'] + scale
+        else:
+            raise ValueError("Unknown normalization mode")
+
+        self.scale_np = np.asarray(scale)
+        self.shift_np = np.asarray(shift)
+        self.register_buffer('scale', torch.as_tensor(self.scale_np))
+        self.register_buffer('shift', torch.as_tensor(self.shift_np))
+        self._cache = dict()
+
+    def is_built_from(self, normalization):
+        # rebuilt by the owner whenever the stats it holds are replaced
+        return self.normalization.keys() == normalization.keys() and \
+            all(self.normalization[k] is normalization[k] for k in normalization)
+
+    def get_stats(self, device, dtype, cols=None):
+        # scale and shift on device, restricted to the columns cols (slice or index list)
+        if isinstance(cols, slice):
+            cols_key = (cols.start, cols.stop, cols.step)
+        else:
+            cols_key = None if cols is None else tuple(np.asarray(cols).tolist())
+        key = (str(device), dtype, cols_key)
+        if key not in self._cache:
+            scale, shift = self.scale, self.shift
+            if cols is not None:
+                index = cols if isinstance(cols, slice) else torch.as_tensor(np.asarray(cols), dtype=torch.long)
+                scale, shift = scale[index], shift[index]
+            scale = scale.to(device=device, dtype=dtype)
+            shift = shift.to(device=device, dtype=dtype)
+            self._cache[key] = (scale, shift)
+        return self._cache[key]
+
+    def _apply(self, fn, *args, **kwargs):
+        # .to() / .cuda() move the buffers, the cached copies are rebuilt from them
+        self._cache = dict()
+        return super()._apply(fn, *args, **kwargs)
+
+    def denorm(self, t, cols=None, out=None):
+        """
+        t: [..., D] normalized features, or [..., len(cols)] when only the columns cols are given
+        out: optional output tensor, t itself for an in-place update
+        """
+        if not torch.is_tensor(t):
+            scale = self.scale_np if cols is None else self.scale_np[cols]
+            shift = self.shift_np if cols is None else self.shift_np[cols]
+            return t * scale + shift
+        scale, shift = self.get_stats(t.device, t.dtype, cols)
+        if out is None:
+            return torch.addcmul(shift, t, scale)
+        return torch.addcmul(shift, t, scale, out=out)
+
+    def norm(self, t, cols=None, out=None):
+        if not torch.is_tensor(t):
+            scale = self.scale_np if cols is None else self.scale_np[cols]
+            shift = self.shift_np if cols is None else self.shift_np[cols]
+            return (t - shift) / scale
+        scale, shift = self.get_stats(t.device, t.dtype, cols)
+        if out is None:
+            return (t - shift) / scale
+        return torch.sub(t, shift, out=out).div_(scale)
+
+    def denorm_(self, t, cols=None):
+        return self.denorm(t, cols, out=t)
+
+    def norm_(self, t, cols=None):
+        return self.norm(t, cols, out=t)
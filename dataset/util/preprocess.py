@@ -0,0 +1,122 @@
+import os
+import os.path as osp
+import json
+import hashlib
+import multiprocessing
+import numpy as np
+import tqdm
+
+# config entries that do not change what process_data returns for a file
+RUNTIME_KEYS = ['load_full_data', 'load_cache', 'cache_shard_frames', 'preprocess_workers']
+
+# dataset the pool workers call process_data on, inherited through fork
+_worker_dataset = None
+
+
+def get_config_hash(config_data, class_name):
+    config_data = {k: v for k, v in config_data.items() if k not in RUNTIME_KEYS}
+    key = class_name + json.dumps(config_data, sort_keys=True, default=str)
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def welford_stats(x):
+    # count, mean and sum of squared deviations of [N, D] frames, accumulated in float64
+    x = np.asarray(x, dtype=np.float64)
+    mean = x.mean(axis=0)
+    return len(x), mean, ((x - mean) ** 2).sum(axis=0)
+
+
+def merge_stats(a, b):
+    # parallel variant of Welford's update (Chan et al.), merges the stats of two disjoint sets of frames
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a + n_b
+    if n == 0:
+        return a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * n_b / n
+    m2 = m2_a + m2_b + delta ** 2 * n_a * n_b / n
+    return n, mean, m2
+
+
+def finalize_stats(stats, dtype=np.float64):
+    # same avg and std (ddof=0, zeros replaced by 1) as BaseMotionData.create_norm
+    n, mean, m2 = stats
+    std = np.sqrt(m2 / n)
+    std[std == 0] = 1.0
+    return mean.astype(dtype), std.astype(dtype)
+
+
+def pack_result(ret):
+    # turn the output of process_data into a picklable entry, the motion struct is reduced to the skeleton info
+    if ret is None:
+        return {'valid': False}
+    motion, motion_struct = ret if type(ret) is tuple else (ret, None)
+    n, mean, m2 = welford_stats(motion)
+    entry = {'valid': True, 'motion': motion, 'count': n, 'mean': mean, 'm2': m2}
+    if motion_struct is not None:
+        skeleton = motion_struct._skeleton
+        entry['joint_offset'] = skeleton.get_joint_offset()
+        entry['links'] = np.array(skeleton.get_links())
+        entry['joint_names'] = np.array([x._name for x in skeleton._joint_lst])
+    return entry
+
+
+def _process_file(fname):
+    return pack_result(_worker_dataset.process_data(fname))
+
+
+class FileCache():
+    """Per file cache of process_data outputs, keyed by file path, mtime and config hash.
+
+    A changed or new file misses the cache and is processed again, everything else is read back.
+    """
+    def __init__(self, cache_dir, config_hash):
+        self.cache_dir = cache_dir
+        self.config_hash = config_hash
+
+    def get_cache_path(self, fname):
+        key = '{}:{}:{}'.format(osp.abspath(fname), os.stat(fname).st_mtime_ns, self.config_hash)
+        return osp.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.npz')
+
+    def load(self, fname):
+        cache_path = self.get_cache_path(fname)
+        if not osp.exists(cache_path):
+            return None
+        with np.load(cache_path) as data:
+            return {k: data[k] for k in data.keys()}
+
+    def save(self, fname, entry):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cache_path = self.get_cache_path(fname)
+        np.savez(cache_path + '.tmp.npz', **entry)
+        os.replace(cache_path + '.tmp.npz', cache_path)
+
+
+def process_files(dataset, file_paths, file_cache=None, num_workers=0):
+    """
+    runs dataset.process_data on every file that misses file_cache, over a pool of num_workers processes
+    returns one entry per file (see pack_result), in the order of file_paths
+    """
+    global _worker_dataset
+    entries = [file_cache.load(fname) if file_cache is not None else None for fname in file_paths]
+    missing = [i for i, entry in enumerate(entries) if entry is None]
+    print('preprocess: {} files cached, {} to process'.format(len(file_paths) - len(missing), len(missing)))
+    if len(missing) == 0:
+        return entries
+
+    missing_paths = [file_paths[i] for i in missing]
+    # the pool relies on fork to hand the dataset to the workers, fall back to the main process elsewhere
+    if num_workers > 1 and len(missing) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        _worker_dataset = dataset
+        with multiprocessing.get_context('fork').Pool(min(num_workers, len(missing))) as pool:
+            results = list(tqdm.tqdm(pool.imap(_process_file, missing_paths), total=len(missing)))
+        _worker_dataset = None
+    else:
+        results = [pack_result(dataset.process_data(fname)) for fname in tqdm.tqdm(missing_paths)]
+
+    for i, entry in zip(missing, results):
+        entries[i] = entry
+        if file_cache is not None:
+            file_cache.save(file_paths[i], entry)
+    return entries
@@ -16,6 +16,11 @@ import model.modules.Activation as Activation
 import dataset.util.geo as geo_util
 
 
+def get_param_key(module):
+    # in-place updates (optimizer, load_state_dict) bump _version, EMA swaps / deepcopy change data_ptr
+    return tuple((p.device, p.dtype, p.data_ptr(), p._version) for p in module.parameters())
+
+
 class AMDM(model_base.BaseModel):
     NAME = 'AMDM'
     def __init__(self, config, dataset, device):
@@ -27,6 +32,16 @@ class AMDM(model_base.BaseModel):
         self.T = config["diffusion"]["T"] 
         self.sample_mode = config["diffusion"]["sample_mode"]  
         self.eval_T = config["diffusion"]["eval_T"] if self.sample_mode == 'ddim' else self.T #self.T
+        self.ddim_eta = config["diffusion"].get("ddim_eta", 0.0)
+        # replay each frame's denoising loop as one captured graph in eval_step
+        self.compile_rollout = config["diffusion"].get("compile_rollout", False)
+        self._captured_sampler = None
+        # reproducible per trajectory noise (RolloutNoise) in rollouts and envs, off by default: the samplers
+        # then draw the noise of a frame with one torch.randn, which is faster
+        self.seeded_noise = config["diffusion"].get("seeded_noise", False)
+        # frames of seeded noise pre-drawn at once, fewer when the block would exceed noise_block_mb
+        self.noise_block_size = config["diffusion"].get("noise_block_size", 32)
+        self.noise_block_mb = config["diffusion"].get("noise_block_mb", 256)
 
         self.frame_dim = dataset.frame_dim
         config['frame_dim'] = self.frame_dim
@@ -59,27 +74,56 @@ class AMDM(model_base.BaseModel):
         self.diffusion.to(self.device)
         return
 
-    def eval_step(self, cur_x, extra_dict=None, align_rpr=False, record_process=False): 
+    def eval_step(self, cur_x, extra_dict=None, align_rpr=False, record_process=False, rollout_noise=None): 
         diffusion = self.ema_diffusion if self.use_ema else self.diffusion  
+        noises = None
+        if rollout_noise is not None:
+            noises = rollout_noise.next(diffusion.get_num_noises(self.sample_mode, self.eval_T, self.ddim_eta))
+
         with torch.no_grad():
-            if self.sample_mode == 'ddpm':
-                next_x =  diffusion.sample_ddpm(cur_x, extra_dict, record_process)
-            elif self.sample_mode == 'ddim':
-                next_x = diffusion.sample_ddim(cur_x, self.eval_T, 0.0, extra_dict)
+            if self.compile_rollout and not record_process:
+                next_x = self.get_captured_sampler(diffusion)(cur_x, noises)
             else:
-                assert(False), "Unsupported agent: {}".format(self.estimate_mode)
+                with model_base.get_autocast(self.device, self.inference_dtype):
+                    if self.sample_mode == 'ddpm':
+                        next_x =  diffusion.sample_ddpm(cur_x, extra_dict, record_process, noises)
+                    elif self.sample_mode == 'ddim':
+                        next_x = diffusion.sample_ddim(cur_x, self.eval_T, self.ddim_eta, extra_dict, record_process, noises)
+                    else:
+                        assert(False), "Unsupported agent: {}".format(self.estimate_mode)
+                next_x = next_x.type(cur_x.dtype)
 
         if align_rpr:
             next_x = self.align_frame_with_angle(cur_x, next_x).type(cur_x.dtype)
 
         return next_x
 
-    def rl_step(self, start_x, action_dict, extra_dict):
+    def get_captured_sampler(self, diffusion):
+        sampler = self._captured_sampler
+        num_steps = self.eval_T if self.sample_mode == 'ddim' else None
+        if sampler is None or sampler.diffusion is not diffusion or sampler.sample_mode != self.sample_mode \
+                or sampler.num_steps != num_steps or sampler.eta != self.ddim_eta or sampler.amp_dtype != self.inference_dtype:
+            sampler = CapturedSampler(diffusion, self.sample_mode, num_steps, self.ddim_eta, self.inference_dtype)
+            self._captured_sampler = sampler
+        return sampler
+
+    def get_rollout_noise(self, num_trials, seed=None):
+        # trajectory i draws from seed + i, without a seed the block follows the global torch seed
+        if seed is None:
+            seed = torch.randint(0, 2**31 - num_trials, (1,)).item()
+        return RolloutNoise(range(seed, seed + num_trials), self.frame_dim, self.device, self.noise_block_size, self.noise_block_mb)
+
+    def rl_step(self, start_x, action_dict, extra_dict, rollout_noise=None):
         diffusion = self.ema_diffusion if self.use_ema else self.diffusion 
-        return diffusion.sample_rl_ddpm(start_x, action_dict, extra_dict)
+        noises = None
+        if rollout_noise is not None:
+            noises = rollout_noise.next(diffusion.get_num_noises('rl_ddpm', extra_info=extra_dict))
+        with model_base.get_autocast(self.device, self.inference_dtype):
+            next_x = diffusion.sample_rl_ddpm(start_x, action_dict, extra_dict, noises)
+        return next_x.type(start_x.dtype)
 
     
-    def eval_seq(self, start_x, extra_dict, num_steps, num_trials, align_rpr=False, record_process=False):
+    def eval_seq(self, start_x, extra_dict, num_steps, num_trials, align_rpr=False, record_process=False, seed=None):
 
         if len(start_x.shape)<=1:
             start_x = start_x[None,:]
@@ -91,13 +135,15 @@ class AMDM(model_base.BaseModel):
             num_trials = start_x.shape[0]
         
         if record_process:
-            output_xs = torch.zeros((num_trials, num_steps, self.T, self.frame_dim)).to(self.device)
+            num_sample_steps = len(self.diffusion.get_ddim_coeffs(self.eval_T, self.ddim_eta)) if self.sample_mode == 'ddim' else self.T
+            output_xs = torch.zeros((num_trials, num_steps, num_sample_steps, self.frame_dim)).to(self.device)
         else:
             output_xs = torch.zeros((num_trials, num_steps, self.frame_dim)).to(self.device)
 
+        rollout_noise = self.get_rollout_noise(num_trials, seed) if seed is not None or self.seeded_noise else None
         for j in range(num_steps):
             with torch.no_grad():
-                start_x = self.eval_step(start_x, extra_dict, align_rpr, record_process).detach()
+                start_x = self.eval_step(start_x, extra_dict, align_rpr, record_process, rollout_noise).detach()
             output_xs[:,j,...] = start_x 
             
             if record_process:
@@ -105,28 +151,38 @@ class AMDM(model_base.BaseModel):
 
         return output_xs
 
-    def eval_step_interactive(self, cur_x, edited_mask, edit_data, extra_dict): 
+    def eval_step_interactive(self, cur_x, edited_mask, edit_data, extra_dict, rollout_noise=None): 
         diffusion = self.ema_diffusion if self.use_ema else self.diffusion
+        noises = None
+        if rollout_noise is not None:
+            num_noises = diffusion.get_num_noises(self.sample_mode + '_interactive', self.eval_T, self.ddim_eta, extra_dict)
+            noises = rollout_noise.next(num_noises)
 
-        if self.sample_mode == 'ddpm':
-            return diffusion.sample_ddpm_interactive(cur_x, edited_mask, edit_data, extra_dict)
-        #elif self.sample_mode == 'ddim':
-        #    return self.model.sample_ddim_interactive(cur_x, self.eval_T, edited_data, edited_mask, extra_dict)
-        else:
-            assert(False), "Unsupported agent: {}".format(self.estimate_mode)                
+        with model_base.get_autocast(self.device, self.inference_dtype):
+            if self.sample_mode == 'ddpm':
+                next_x = diffusion.sample_ddpm_interactive(cur_x, edited_mask, edit_data, extra_dict, noises)
+            elif self.sample_mode == 'ddim':
+                next_x = diffusion.sample_ddim_interactive(cur_x, self.eval_T, self.ddim_eta, edited_mask, edit_data, extra_dict, noises)
+            else:
+                assert(False), "Unsupported agent: {}".format(self.estimate_mode)                
+        return next_x.type(cur_x.dtype)
 
-    def eval_seq_interactive(self, start_x, extra_dict, edit_data, edited_mask, num_steps, num_trials):
+    def eval_seq_interactive(self, start_x, extra_dict, edit_data, edited_mask, num_steps, num_trials, seed=None):
         output_xs = torch.zeros((num_trials, num_steps, self.frame_dim)).to(self.device)
         start_x = start_x[None,:].expand(num_trials, -1)
+        rollout_noise = self.get_rollout_noise(num_trials, seed) if seed is not None or self.seeded_noise else None
         for j in range(num_steps):
             with torch.no_grad():
-                start_x = self.eval_step_interactive(start_x, edit_data[j], edited_mask[j], extra_dict).detach()
+                start_x = self.eval_step_interactive(start_x, edit_data[j], edited_mask[j], extra_dict, rollout_noise).detach()
             output_xs[:,j,:] = start_x 
         return output_xs
 
 
     def compute_loss(self, last_x, next_x, ts, extra_dict):
-        estimated, noise, xt, ts = self.diffusion(last_x, next_x, ts, extra_dict)   
+        with model_base.get_autocast(self.device, self.amp_dtype):
+            estimated, noise, xt, ts = self.diffusion(last_x, next_x, ts, extra_dict)   
+        # the loss and x0 are computed in the dtype of the data
+        estimated = estimated.type(next_x.dtype)
         if self.estimate_mode == 'x0':
             target = next_x
             pred_x0 = estimated
@@ -213,6 +269,29 @@ class GaussianDiffusion(nn.Module):
         self.register_buffer("remove_noise_coeff", to_torch(betas / np.sqrt(1. - alphas_cumprod)))
         self.register_buffer("sigma", to_torch(np.sqrt(betas)))
 
+        # per-timestep scalars used by the samplers, indexed by t instead of gathered per step
+        self.sample_coeffs = [
+            {
+                "remove_noise_coeff": rnc,
+                "reciprocal_sqrt_alphas": rsa,
+                "sigma": sig,
+            }
+            for rnc, rsa, sig in zip(self.remove_noise_coeff.tolist(),
+                                     self.reciprocal_sqrt_alphas.tolist(),
+                                     self.sigma.tolist())
+        ]
+
+        # time embedding of every timestep, rebuilt lazily once time_mlp weights change
+        self._time_emb_table = None
+        self._time_emb_table_key = None
+
+        self._ddim_coeffs = {}
+
+        # inference only: run NoiseDecoder with per-layer weights split into hidden/xnext/xcur/latent blocks
+        self.split_decoder = config["diffusion"].get("split_decoder", False)
+        self._latent_proj_table = None
+        self._latent_proj_table_key = None
+
 
     def _generate_diffusion_schedule(self, s=0.008):
         def f(t, T):
@@ -253,6 +332,43 @@ class GaussianDiffusion(nn.Module):
             assert(False), "Unsupported diffusion schedule: {}".format(self.schedule_mode)
     
 
+    @torch.no_grad()
+    def get_time_emb_table(self):
+        key = get_param_key(self.time_mlp)
+        if self._time_emb_table is None or self._time_emb_table_key != key:
+            ts = torch.arange(self.T, device=self.betas.device)
+            # always fp32, the table is shared by calls with and without reduced precision autocast
+            with model_base.get_autocast(self.betas.device, None):
+                self._time_emb_table = self.time_mlp(ts).float()
+            self._time_emb_table_key = key
+        return self._time_emb_table
+
+    @torch.no_grad()
+    def get_latent_proj_table(self):
+        key = (get_param_key(self.time_mlp), get_param_key(self.model))
+        if self._latent_proj_table is None or self._latent_proj_table_key != key:
+            with model_base.get_autocast(self.betas.device, None):
+                self._latent_proj_table = self.model.get_latent_proj(self.get_time_emb_table()).float()
+            self._latent_proj_table_key = key
+        return self._latent_proj_table
+
+    @torch.no_grad()
+    def get_sample_cond(self, last_x):
+        # everything the denoiser needs that stays constant across the T steps of one frame
+        if self.split_decoder:
+            return {'cond_proj': self.model.get_cond_proj(last_x), 
+                    'latent_proj_table': self.get_latent_proj_table(),
+                    'split_weights': self.model.get_split_weights()}
+        return {'last_x': last_x, 'time_emb_table': self.get_time_emb_table()}
+
+    @torch.no_grad()
+    def predict_t(self, sample_cond, x, t):
+        if self.split_decoder:
+            return self.model.forward_split(x, sample_cond['cond_proj'], sample_cond['latent_proj_table'][t], 
+                                            sample_cond['split_weights'])
+        te = sample_cond['time_emb_table'][t].expand(x.shape[0], -1)
+        return self.model(sample_cond['last_x'], x, te)
+
     @torch.no_grad()
     def extract(self, a, ts, x_shape):
         b, *_ = ts.shape
@@ -280,6 +396,20 @@ class GaussianDiffusion(nn.Module):
                 self.extract(self.reciprocal_sqrt_alphas, ts, pred.shape)
         
         return output
+
+    @torch.no_grad()
+    def remove_noise_t(self, xt, pred, t):
+        coeffs = self.sample_coeffs[t]
+        return (xt - coeffs["remove_noise_coeff"] * pred) * coeffs["reciprocal_sqrt_alphas"]
+
+    @torch.no_grad()
+    def add_noise_t(self, x, t, noise=None):
+        noise = torch.randn_like(x) if noise is None else noise
+        return x + self.sample_coeffs[t]["sigma"] * noise
+
+    def draw_noises(self, last_x, num_noises):
+        # all the noise one frame of a sampler consumes, in a single call
+        return torch.randn((num_noises, last_x.shape[0], last_x.shape[-1]), device=last_x.device, dtype=last_x.dtype)
     
     def get_x0_from_xt(self, xt, ts, noise):
         output =  (xt - self.extract(self.sqrt_one_minus_alphas_cumprod, ts, xt.shape) * noise) * \
@@ -300,21 +430,21 @@ class GaussianDiffusion(nn.Module):
 
 
     @torch.no_grad()
-    def sample_ddpm(self, last_x, extra_info, record_process=False):
+    def sample_ddpm(self, last_x, extra_info, record_process=False, noises=None):
+        if noises is None:
+            noises = self.draw_noises(last_x, self.get_num_noises('ddpm'))
         
-        x = torch.randn(last_x.shape[0], last_x.shape[-1]).to(last_x.device)
+        x = noises[0]
         #ce = None if self.use_cond else self.cond_mlp(extra_info['cond'])
         if record_process:
             x0s = torch.zeros(last_x.shape[0], self.T, last_x.shape[-1], device=last_x.device)  
 
+        sample_cond = self.get_sample_cond(last_x)
         for t in range(self.T - 1, -1, -1):
-            ts = torch.tensor([t], device = last_x.device).repeat(last_x.shape[0])
-            te = self.time_mlp(ts)
-
-            pred = self.model(last_x, x, te).detach()
+            pred = self.predict_t(sample_cond, x, t)
             
             if self.estimate_mode == 'epsilon':
-                x = self.remove_noise(x, pred, ts)
+                x = self.remove_noise_t(x, pred, t)
             elif self.estimate_mode == 'x0':
                 x = pred
             
@@ -322,7 +452,7 @@ class GaussianDiffusion(nn.Module):
                 x0s[:,self.T - 1- t,:] = x
                 
             if t > 0:
-                x = self.add_noise(x, ts)
+                x = self.add_noise_t(x, t, noises[self.T - t])
         
         if record_process:
             return x0s
@@ -330,7 +460,7 @@ class GaussianDiffusion(nn.Module):
         return x
 
     
-    def sample_rl_ddpm(self, last_x, action_dict, extra_info):
+    def sample_rl_ddpm(self, last_x, action_dict, extra_info, noises=None):
         
         steps = extra_info['action_step']
         train_rand_scale =  extra_info['rand_scale']
@@ -344,16 +474,17 @@ class GaussianDiffusion(nn.Module):
 
         action_dim_per_step = 8 if action_mode == 'loco' else self.frame_dim
         
+        if noises is None:
+            noises = self.draw_noises(last_x, self.get_num_noises('rl_ddpm', extra_info=extra_info))
+
         x = action_dict[...,:action_dim_per_step] / 3
+        sample_cond = self.get_sample_cond(last_x)
         for t in range(self.T - 1, -1, -1):
             with torch.no_grad():
-                
-                ts = torch.tensor([t], device = last_x.device).repeat(last_x.shape[0])
-                te = self.time_mlp(ts)
-                pred = self.model(last_x, x, te).detach()
+                pred = self.predict_t(sample_cond, x, t)
                 
                 if self.estimate_mode == 'epsilon':
-                    x = self.remove_noise(x, pred, ts)
+                    x = self.remove_noise_t(x, pred, t)
                 elif self.estimate_mode == 'x0':
                     x = pred
             
@@ -362,34 +493,35 @@ class GaussianDiffusion(nn.Module):
                 dx = action_dict[...,i*action_dim_per_step:(i+1)*action_dim_per_step] 
                 rand_scale = train_rand_scale if is_train else test_rand_scale
                 
-                rand_scale *= torch.randn_like(dx) 
+                rand_scale *= noises[self.T + i - 1][...,:dx.shape[-1]]
 
-                x += action_scale * (dx + rand_scale * self.extract(self.sigma, ts, x.shape)[0])
+                x += action_scale * (dx + rand_scale * self.sample_coeffs[t]["sigma"])
                 x = torch.clamp(x, -clip_scale, clip_scale)
                
             if t > 0:
-                x = self.add_noise(x, ts)
+                x = self.add_noise_t(x, t, noises[t])
         return x
 
     
 
     @torch.no_grad()
-    def sample_ddpm_interactive(self, last_x, edited_mask, edited_data, extra_info):
+    def sample_ddpm_interactive(self, last_x, edited_mask, edited_data, extra_info, noises=None):
         repaint_step = extra_info['repaint_step']
         interact_stop_step = extra_info['interact_stop_step']
         edited_mask_inv = 1 - edited_mask
+        if noises is None:
+            noises = self.draw_noises(last_x, self.get_num_noises('ddpm_interactive', extra_info=extra_info))
 
-        x = torch.randn(last_x.shape[0], last_x.shape[-1]).to(last_x.device)
+        x = noises[0]
+        noise_idx = 1
         
+        sample_cond = self.get_sample_cond(last_x)
         for t in range(self.T - 1, -1, -1):
             for t_rp in range(repaint_step):
-                ts = torch.tensor([t], device = last_x.device).repeat(last_x.shape[0])
-
-                te = self.time_mlp(ts)
-                pred = self.model(last_x, x, te).detach()
+                pred = self.predict_t(sample_cond, x, t)
                 
                 if self.estimate_mode == 'epsilon':
-                    x = self.remove_noise(x, pred, ts)
+                    x = self.remove_noise_t(x, pred, t)
                 elif self.estimate_mode == 'x0':
                     x = pred
                 
@@ -401,51 +533,143 @@ class GaussianDiffusion(nn.Module):
                 if t > 0:
                     #if t_rp < repaint_step and t != self.T-1 and t > interact_stop_step:
                     #    ts = torch.tensor([t+1], device = last_x.device).repeat(last_x.shape[0])
-                    x = self.add_noise(x, ts)
+                    x = self.add_noise_t(x, t, noises[noise_idx])
+                    noise_idx += 1
 
         return x
     
 
 
+    def get_ddim_coeffs(self, num_steps, eta):
+        # strided timesteps and their scalar coefficients, cached per (num_steps, eta)
+        key = (num_steps, eta)
+        if key not in self._ddim_coeffs:
+            num_steps = min(num_steps, self.T)
+            timesteps = np.unique(np.linspace(0, self.T - 1, num_steps).round().astype(int))
+            alphas_cumprod = self.alphas_cumprod.tolist()
+            
+            coeffs = []
+            for i in range(len(timesteps) - 1, -1, -1):
+                t = int(timesteps[i])
+                t_prev = int(timesteps[i-1]) if i > 0 else -1
+                alpha_bar = alphas_cumprod[t]
+                alpha_bar_prev = alphas_cumprod[t_prev] if t_prev >= 0 else 1.0
+                # eta = 0.0 deterministic, eta = 1.0 ddpm posterior variance
+                sigma = eta * math.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar) * (1 - alpha_bar / alpha_bar_prev))
+                coeffs.append({
+                    "t": t,
+                    "t_prev": t_prev,
+                    "reciprocal_sqrt_alphas_cumprod": math.sqrt(1. / alpha_bar),
+                    "reciprocal_sqrt_alphas_cumprod_m1": math.sqrt(1. / alpha_bar - 1),
+                    "sqrt_alphas_cumprod_prev": math.sqrt(alpha_bar_prev),
+                    "eps_coeff": math.sqrt(max(1 - alpha_bar_prev - sigma ** 2, 0.0)),
+                    "sigma": sigma,
+                    # q(x_t | x_t_prev), used to renoise when repainting
+                    "sqrt_alphas_ratio": math.sqrt(alpha_bar / alpha_bar_prev),
+                    "sqrt_one_minus_alphas_ratio": math.sqrt(1 - alpha_bar / alpha_bar_prev),
+                })
+            self._ddim_coeffs[key] = coeffs
+        return self._ddim_coeffs[key]
+
+    @torch.no_grad()
+    def ddim_step(self, sample_cond, x, coeffs, noise=None):
+        pred = self.predict_t(sample_cond, x, coeffs["t"])
+        if self.estimate_mode == 'x0':
+            pred_x0 = pred
+            pred_eps = (x * coeffs["reciprocal_sqrt_alphas_cumprod"] - pred_x0) / coeffs["reciprocal_sqrt_alphas_cumprod_m1"]
+        else:
+            pred_eps = pred
+            pred_x0 = x * coeffs["reciprocal_sqrt_alphas_cumprod"] - coeffs["reciprocal_sqrt_alphas_cumprod_m1"] * pred_eps
+        
+        x = coeffs["sqrt_alphas_cumprod_prev"] * pred_x0 + coeffs["eps_coeff"] * pred_eps
+        if coeffs["sigma"] > 0:
+            noise = torch.randn_like(x) if noise is None else noise
+            x = x + coeffs["sigma"] * noise
+        return x
+
+    def get_num_sample_steps(self, sample_mode, num_steps=None, eta=0.0):
+        if sample_mode == 'ddim':
+            return len(self.get_ddim_coeffs(num_steps, eta))
+        return self.T
+
+    def get_num_noises(self, sampler, num_steps=None, eta=0.0, extra_info=None):
+        # number of [B, F] noise draws one frame of the given sampler consumes, see the noises argument of each sampler
+        if sampler in ['ddpm', 'ddim']:
+            return self.get_num_sample_steps(sampler, num_steps, eta) + 1
+        elif sampler == 'rl_ddpm':
+            return self.T + len(extra_info['action_step'])
+        elif sampler == 'ddpm_interactive':
+            return self.T * extra_info['repaint_step'] + 1
+        elif sampler == 'ddim_interactive':
+            return 2 * len(self.get_ddim_coeffs(num_steps, eta)) * extra_info['repaint_step'] + 1
+        else:
+            assert(False), "Unsupported sampler: {}".format(sampler)
+
     @torch.no_grad()
-    def sample_ddim(self, bs, num_steps, device, eta=0.0):
+    def sample_from_noise(self, sample_cond, noises, sample_mode='ddpm', num_steps=None, eta=0.0):
+        # noises: [num_sample_steps + 1, B, F], noises[0] is x_T, noises[k+1] is added after the k-th step
+        x = noises[0]
+        if sample_mode == 'ddim':
+            for k, coeffs in enumerate(self.get_ddim_coeffs(num_steps, eta)):
+                x = self.ddim_step(sample_cond, x, coeffs, noises[k+1])
+            return x
+
+        for k, t in enumerate(range(self.T - 1, -1, -1)):
+            pred = self.predict_t(sample_cond, x, t)
+            if self.estimate_mode == 'epsilon':
+                x = self.remove_noise_t(x, pred, t)
+            elif self.estimate_mode == 'x0':
+                x = pred
+            if t > 0:
+                x = x + self.sample_coeffs[t]["sigma"] * noises[k+1]
+        return x
+
+    @torch.no_grad()
+    def sample_ddim(self, last_x, num_steps, eta=0.0, extra_info=None, record_process=False, noises=None):
+        ddim_coeffs = self.get_ddim_coeffs(num_steps, eta)
+        if noises is None:
+            noises = self.draw_noises(last_x, self.get_num_noises('ddim', num_steps, eta))
+
+        x = noises[0]
+        if record_process:
+            x0s = torch.zeros(last_x.shape[0], len(ddim_coeffs), last_x.shape[-1], device=last_x.device)  
         
-        T_train = self.T - 1
-        timesteps = torch.linspace(0, T_train, num_steps, dtype=torch.long, device = device)
-        timesteps_next = [-1] + list(timesteps[:-1])
+        sample_cond = self.get_sample_cond(last_x)
+        for i, coeffs in enumerate(ddim_coeffs):
+            x = self.ddim_step(sample_cond, x, coeffs, noises[i+1])
+            if record_process:
+                x0s[:,i,:] = x
+
+        if record_process:
+            return x0s
         
-        x = torch.randn(bs, self.action_dim, device = device)
+        return x
+
+    @torch.no_grad()
+    def sample_ddim_interactive(self, last_x, num_steps, eta, edited_mask, edited_data, extra_info, noises=None):
+        repaint_step = extra_info['repaint_step']
+        interact_stop_step = extra_info['interact_stop_step']
+        edited_mask_inv = 1 - edited_mask
+        ddim_coeffs = self.get_ddim_coeffs(num_steps, eta)
+        if noises is None:
+            noises = self.draw_noises(last_x, self.get_num_noises('ddim_interactive', num_steps, eta, extra_info))
+
+        x = noises[0]
+        noise_idx = 1
         
-        for t in range(len(timesteps)-1, -1, -1):
-            
-            ts = torch.tensor([timesteps[t]], device = device).repeat(bs)
-            ts1 = torch.tensor([timesteps_next[t]], device = device).repeat(bs)
-            
-            alpha_bar = self.extract(self.alphas_cumprod, ts, x.shape)
-            alpha_bar_prev = self.extract(self.alphas_cumprod, ts1, x.shape) if t > 0 else torch.ones_like(x)
-            sigma = eta *((1 - alpha_bar_prev)/(1 - alpha_bar) * (1 - alpha_bar / alpha_bar_prev)).sqrt()
-            # eta = 0.0 deterministic
-            te = self.time_mlp(ts)
-            input = torch.cat([x, te],axis=-1)
-            output = self.model(input)
-
-            if self.estimate_mode == 'x0':
-                pred_x0 = output
-                pred_eps = self.get_eps_from_x0(x, ts, pred_x0)
-            else:
-                pred_eps = output
-                pred_x0 = self.get_x0_from_xt(x, ts, pred_eps)
+        sample_cond = self.get_sample_cond(last_x)
+        for coeffs in ddim_coeffs:
+            for t_rp in range(repaint_step):
+                if t_rp > 0:
+                    # go back from t_prev to t before denoising again
+                    x = coeffs["sqrt_alphas_ratio"] * x + coeffs["sqrt_one_minus_alphas_ratio"] * noises[noise_idx]
+                    noise_idx += 1
 
-            mean_pred = (
-                pred_x0 * self.extract(self.sqrt_alphas_cumprod, ts, x.shape)
-                + (1 - alpha_bar_prev- sigma ** 2).sqrt() * pred_eps
-            )
+                x = self.ddim_step(sample_cond, x, coeffs, noises[noise_idx])
+                noise_idx += 1
+                if coeffs["t"] > interact_stop_step:
+                    x = edited_data * edited_mask + x * edited_mask_inv
 
-            nonzero_mask = (
-                (ts != 0).float().view(-1, *([1] * (len(x.shape) - 1))))  
-            
-            x = mean_pred + nonzero_mask * sigma * torch.randn_like(x)            
-    
         return x
     
     def forward(self, cur_x, next_x, ts, extra_info):
@@ -464,6 +688,210 @@ class GaussianDiffusion(nn.Module):
         return estimated, noise, perturbed_x, ts
 
 
+class CapturedSampler():
+    """Runs the whole denoising loop of one frame as a single replayable graph.
+
+    On cuda the loop is captured into a CUDA graph with static input, noise and output buffers.
+    Elsewhere it falls back to torch.compile, or to a TorchScript trace on older torch versions.
+    Graphs are rebuilt whenever the batch size, device, dtype or diffusion weights change.
+    With amp_dtype the network runs under autocast inside the graph.
+    """
+    def __init__(self, diffusion, sample_mode, num_steps=None, eta=0.0, amp_dtype=None):
+        self.diffusion = diffusion
+        self.sample_mode = sample_mode
+        self.num_steps = num_steps
+        self.eta = eta
+        self.amp_dtype = amp_dtype
+        self._reset()
+
+    def _reset(self):
+        self.key = None
+        self.graph = None
+        self.denoise_fn = None
+        self.static_last_x = None
+        self.static_noises = None
+        self.static_out = None
+
+    def __getstate__(self):
+        # graphs and compiled functions are not picklable, they are rebuilt on the next call
+        state = self.__dict__.copy()
+        state.update(key=None, graph=None, denoise_fn=None, static_last_x=None, static_noises=None, static_out=None)
+        return state
+
+    def get_noise_shape(self, last_x):
+        num_sample_steps = self.diffusion.get_num_sample_steps(self.sample_mode, self.num_steps, self.eta)
+        return (num_sample_steps + 1, last_x.shape[0], last_x.shape[-1])
+
+    def _denoise(self, last_x, noises):
+        # casts can not be cached across graph replays
+        with model_base.get_autocast(last_x.device, self.amp_dtype, cache_enabled=False):
+            sample_cond = self.diffusion.get_sample_cond(last_x)
+            next_x = self.diffusion.sample_from_noise(sample_cond, noises, self.sample_mode, self.num_steps, self.eta)
+        return next_x.type(last_x.dtype)
+
+    def _build(self, last_x):
+        self._reset()
+        self.static_last_x = last_x.clone()
+        self.static_noises = torch.randn(self.get_noise_shape(last_x), device=last_x.device, dtype=last_x.dtype)
+        
+        if last_x.is_cuda:
+            # warm up on a side stream so lazily built tables are allocated outside of the capture
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    self._denoise(self.static_last_x, self.static_noises)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            self.graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self.graph):
+                self.static_out = self._denoise(self.static_last_x, self.static_noises)
+
+        elif hasattr(torch, 'compile'):
+            self.denoise_fn = torch.compile(self._denoise, dynamic=False)
+        
+        else:
+            # weights are baked into the trace as constants, which is only allowed for tensors without grad;
+            # the key above already rebuilds the trace whenever they change
+            params = [p for p in self.diffusion.parameters() if p.requires_grad]
+            for p in params:
+                p.requires_grad_(False)
+            try:
+                self.denoise_fn = torch.jit.trace(self._denoise, (self.static_last_x, self.static_noises), check_trace=False)
+            finally:
+                for p in params:
+                    p.requires_grad_(True)
+
+    @torch.no_grad()
+    def __call__(self, last_x, noises=None):
+        key = (last_x.shape, last_x.device, last_x.dtype, get_param_key(self.diffusion))
+        if self.key != key:
+            self._build(last_x)
+            self.key = key
+
+        if self.graph is not None:
+            self.static_last_x.copy_(last_x)
+            if noises is None:
+                self.static_noises.normal_()
+            else:
+                self.static_noises.copy_(noises)
+            self.graph.replay()
+            return self.static_out.clone()
+
+        if noises is None:
+            noises = torch.randn(self.get_noise_shape(last_x), device=last_x.device, dtype=last_x.dtype)
+        return self.denoise_fn(last_x, noises)
+
+
+MASK32 = 0xffffffff
+
+
+def mul32_(x, c):
+    # x = x * c mod 2**32 in place, for x: int64 tensor in [0, 2**32) and a constant c < 2**32, without int64 overflow
+    t = x * (c >> 16)
+    t &= 0xffff
+    t *= 65536
+    x *= c & 0xffff
+    x += t
+    x &= MASK32
+    return x
+
+
+def hash32_(x):
+    # lowbias32 integer hash in place, x: int64 tensor in [0, 2**32)
+    x ^= x >> 16
+    mul32_(x, 0x7feb352d)
+    x ^= x >> 15
+    mul32_(x, 0x846ca68b)
+    x ^= x >> 16
+    return x
+
+
+def counter_normal(seeds, frames, num_noises, frame_dim):
+    """
+    counter based normal noise, value k of frame t of a trajectory only depends on (seed, t, k)
+    seeds, frames: [B, L] int64, returns [B, L, num_noises, frame_dim] float32
+    """
+    num_values = num_noises * frame_dim
+    num_pairs = (num_values + 1) // 2
+    key = hash32_(hash32_(seeds ^ 0x9e3779b9) ^ (frames & MASK32))
+    # the pair index is hashed too, so the streams of two keys never line up as shifted copies
+    index = hash32_(torch.arange(num_pairs, device=seeds.device))
+    h = hash32_(key[..., None] ^ index)
+    # Box-Muller, both outputs of every pair of 24 bit uniforms in (0, 1) are used
+    radius = (h >> 8).float().add_(0.5).mul_(2 ** -24).log_().mul_(-2).sqrt_()
+    h ^= 0x5bd1e995
+    angle = (hash32_(h) >> 8).float().add_(0.5).mul_(2 * math.pi * 2 ** -24)
+    noise = torch.cat([radius * angle.cos(), radius.mul_(angle.sin_())], dim=-1)[..., :num_values]
+    return noise.reshape(*seeds.shape, num_noises, frame_dim)
+
+
+class RolloutNoise():
+    """Pre-draws the sampler noise of the next frames of a batch of trajectories.
+
+    The noise is counter based: value k of frame t of a trajectory is a hash of (seed, t, k), so a
+    trajectory sees the same noise whatever runs in parallel with it, and the block of all trajectories
+    is drawn with a handful of batched ops. The block holds at most block_size frames and is shortened
+    to fit budget_mb, drawing it is split over the trajectories to stay within the same budget.
+    """
+    # bytes per noise value while drawing: the float32 block and the int64 temporaries of the hash
+    DRAW_BYTES = 32
+
+    def __init__(self, seeds, frame_dim, device, block_size=32, budget_mb=256):
+        self.frame_dim = frame_dim
+        self.device = device
+        self.max_block_size = block_size
+        self.budget = budget_mb * 2 ** 20
+        seeds = torch.as_tensor(list(seeds), dtype=torch.long)
+        self.seeds = (seeds & MASK32).to(device)
+        # first frame of the current block of every trajectory
+        self.frames = torch.zeros_like(self.seeds)
+        self.block = None
+        self.block_idx = 0
+
+    def seed(self, seeds, indices=None):
+        indices = range(len(self.seeds)) if indices is None else indices
+        indices = torch.as_tensor(list(indices), dtype=torch.long, device=self.device)
+        # the other trajectories continue from the frame they reached, the reseeded ones start over
+        self.frames += self.block_idx
+        self.seeds[indices] = torch.as_tensor(list(seeds), dtype=torch.long, device=self.device) & MASK32
+        self.frames[indices] = 0
+        self.block = None
+        self.block_idx = 0
+
+    def get_block_size(self, num_noises):
+        frame_bytes = len(self.seeds) * num_noises * self.frame_dim * 4
+        return int(min(max(self.budget // frame_bytes, 1), self.max_block_size))
+
+    def _draw_block(self, num_noises):
+        self.frames += self.block_idx
+        block_size = self.get_block_size(num_noises)
+        num_trajs = len(self.seeds)
+        chunk = max(self.budget // (block_size * num_noises * self.frame_dim * self.DRAW_BYTES), 1)
+        frames = self.frames[:, None] + torch.arange(block_size, device=self.device)
+        self.block = torch.empty((num_trajs, block_size, num_noises, self.frame_dim), device=self.device)
+        for st in range(0, num_trajs, chunk):
+            self.block[st:st + chunk] = counter_normal(self.seeds[st:st + chunk, None].expand(-1, block_size),
+                                                       frames[st:st + chunk], num_noises, self.frame_dim)
+        self.block_idx = 0
+
+    def draw_block_loop(self, num_noises, block_size):
+        # reference, the next block_size frames drawn one trajectory at a time, the block has to match it
+        frames = self.frames + self.block_idx
+        return torch.stack([counter_normal(self.seeds[i].expand(1, block_size),
+                                           frames[i] + torch.arange(block_size, device=self.device)[None],
+                                           num_noises, self.frame_dim)[0]
+                            for i in range(len(self.seeds))])
+
+    def next(self, num_noises):
+        # noise of one frame, [num_noises, B, F]
+        if self.block is None or self.block.shape[2] != num_noises or self.block_idx == self.block.shape[1]:
+            self._draw_block(num_noises)
+        noises = self.block[:, self.block_idx].transpose(0, 1)
+        self.block_idx += 1
+        return noises
+
+
 class NoiseDecoder(nn.Module):
     def __init__(
         self,
@@ -477,6 +905,7 @@ class NoiseDecoder(nn.Module):
         super().__init__()
 
         self.input_size = frame_size
+        self.hidden_size = hidden_size
         layers = []
         for _ in range(layer_num): 
             if act_type == 'ReLU':
@@ -496,6 +925,9 @@ class NoiseDecoder(nn.Module):
         self.fin = nn.Linear(frame_size * 2 + time_emb_size, hidden_size)
         self.fco = nn.Linear(hidden_size + frame_size * 2  + time_emb_size, frame_size)
         self.act = Activation.SiLU()
+
+        self._split_weights = None
+        self._split_weights_key = None
   
     def forward(self, xcur, xnext, latent):
         
@@ -515,4 +947,67 @@ class NoiseDecoder(nn.Module):
         x = torch.cat([x, x0, y0, latent],dim=-1) 
         x = self.fco(x)
         return x 
-   
\ No newline at end of file
+   
+
+    @torch.no_grad()
+    def get_split_weights(self):
+        # fin sees [xcur, xnext, latent], the other linears see [hidden, xnext, xcur, latent]
+        key = get_param_key(self)
+        if self._split_weights is None or self._split_weights_key != key:
+            fs, hs = self.input_size, self.hidden_size
+            linears = [self.fin] + [layer for i, layer in enumerate(self.net) if i % 3 == 2] + [self.fco]
+            w_hidden, w_xnext, w_xcur, w_latent = [], [], [], []
+            for linear in linears:
+                w = linear.weight
+                if linear is self.fin:
+                    w_xcur.append(w[:, :fs])
+                    w_xnext.append(w[:, fs:2*fs])
+                    w_latent.append(w[:, 2*fs:])
+                else:
+                    w_hidden.append(w[:, :hs].t().contiguous())
+                    w_xnext.append(w[:, hs:hs+fs])
+                    w_xcur.append(w[:, hs+fs:hs+2*fs])
+                    w_latent.append(w[:, hs+2*fs:])
+
+            # xnext/xcur/latent blocks of all layers are stacked so each is a single matmul
+            self._split_weights = {
+                'hidden': w_hidden,
+                'xnext': torch.cat(w_xnext, dim=0).t().contiguous(),
+                'xcur': torch.cat(w_xcur, dim=0).t().contiguous(),
+                'latent': torch.cat(w_latent, dim=0).t().contiguous(),
+                'bias': torch.cat([linear.bias for linear in linears], dim=0),
+                'out_sizes': [linear.out_features for linear in linears],
+            }
+            self._split_weights_key = key
+        return self._split_weights
+
+    @torch.no_grad()
+    def get_cond_proj(self, xcur):
+        # xcur contribution (plus biases) of every layer, once per generated frame
+        w = self.get_split_weights()
+        return torch.addmm(w['bias'], xcur, w['xcur'])
+
+    @torch.no_grad()
+    def get_latent_proj(self, latent):
+        # latent contribution of every layer, once per timestep
+        w = self.get_split_weights()
+        return torch.matmul(latent, w['latent'])
+
+    @torch.no_grad()
+    def forward_split(self, xnext, cond_proj, latent_proj, w=None):
+        if w is None:
+            w = self.get_split_weights()
+        proj = torch.addmm(cond_proj + latent_proj, xnext, w['xnext'])
+        proj = proj.split(w['out_sizes'], dim=-1)
+        
+        x = proj[0]
+        idx = 1
+        for i, layer in enumerate(self.net):
+            if i % 3 == 2:
+                x = torch.addmm(proj[idx], x, w['hidden'][idx-1])
+                idx += 1
+            else:
+                x = layer(x)
+        
+        x = torch.addmm(proj[idx], x, w['hidden'][idx-1])
+        return x
@@ -126,7 +126,10 @@ class AMDM(model_base.BaseModel):
 
 
     def compute_loss(self, last_x, next_x, ts, extra_dict):
-        estimated, noise, xt, ts = self.diffusion(last_x, next_x, ts, extra_dict)   
+        with model_base.get_autocast(self.device, self.amp_dtype):
+            estimated, noise, xt, ts = self.diffusion(last_x, next_x, ts, extra_dict)   
+        # the loss and x0 are computed in the dtype of the data
+        estimated = estimated.type(next_x.dtype)
         if self.estimate_mode == 'x0':
             target = next_x
             pred_x0 = estimated
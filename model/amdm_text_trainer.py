@@ -3,11 +3,12 @@ import numpy as np
 import torch
 from tqdm import tqdm
 import model.trainer_base as trainer_base
+import util.mp_util as mp_util
 
 class AMDMTrainer(trainer_base.BaseTrainer):
     NAME = 'AMDM_TEXT'
-    def __init__(self, config, dataset, device):
-        super(AMDMTrainer, self).__init__(config, dataset, device)
+    def __init__(self, config, dataset, device, seed=0):
+        super(AMDMTrainer, self).__init__(config, dataset, device, seed)
         optimizer_config = config['optimizer']
         self.full_T = optimizer_config.get('full_T', False)
         self.consistency_on = optimizer_config.get('consistency_on', False)
@@ -54,8 +55,8 @@ class AMDMTrainer(trainer_base.BaseTrainer):
         diff_loss, pred_frame = model.compute_loss(last_frame,  ground_truth, None, extra_info)
         loss = self.diffusion_loss_weight * diff_loss 
     
-        loss.backward()
-        self.optimizer.step()
+        self._backward(loss)
+        self._step_optimizer(model)
         model.update()
 
         return {"diff_loss":diff_loss.item()}
@@ -109,8 +110,8 @@ class AMDMTrainer(trainer_base.BaseTrainer):
                 loss = self.diffusion_loss_weight * diff_loss
              
 
-            loss.backward()
-            self.optimizer.step()
+            self._backward(loss)
+            self._step_optimizer(model)
             model.update()
 
             loss_diff_sum += diff_loss.item()
@@ -126,7 +127,7 @@ class AMDMTrainer(trainer_base.BaseTrainer):
         self._update_lr_schedule(self.optimizer, ep - 1)
         
         model.train()
-        pbar = tqdm(self.train_dataloader, colour='green')
+        pbar = tqdm(self.train_dataloader, colour='green', disable=not mp_util.is_root_proc())
         cur_samples = 1
         for frames in pbar:
             extra_info = None
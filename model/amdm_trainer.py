@@ -3,11 +3,12 @@ import numpy as np
 import torch
 from tqdm import tqdm
 import model.trainer_base as trainer_base
+import util.mp_util as mp_util
 
 class AMDMTrainer(trainer_base.BaseTrainer):
     NAME = 'AMDM'
-    def __init__(self, config, dataset, device):
-        super(AMDMTrainer, self).__init__(config, dataset, device)
+    def __init__(self, config, dataset, device, seed=0):
+        super(AMDMTrainer, self).__init__(config, dataset, device, seed)
         optimizer_config = config['optimizer']
         self.full_T = optimizer_config.get('full_T', False)
         self.consistency_on = optimizer_config.get('consistency_on', False)
@@ -17,6 +18,11 @@ class AMDMTrainer(trainer_base.BaseTrainer):
         self.recon_loss_weight = optimizer_config.get('recon_loss_weight', 1)
         self.diffusion_loss_weight = optimizer_config.get('diffusion_loss_weight', 1)
         self.detach_step = optimizer_config.get('detach_step',3)
+        # student forcing with the teacher and student inputs in one forward pass of twice the batch
+        self.fused_student = optimizer_config.get('fused_student', False)
+        # "per_step": one optimizer step per rollout step, "per_rollout": gradients of the rollout steps are accumulated into one
+        self.student_update = optimizer_config.get('student_update', 'per_step')
+        assert self.student_update in ['per_step', 'per_rollout'], "Unsupported student_update: {}".format(self.student_update)
 
 
     def compute_rpr_consist_loss(self, last_frame, cur_frame):
@@ -54,15 +60,53 @@ class AMDMTrainer(trainer_base.BaseTrainer):
         diff_loss, pred_frame = model.compute_loss(last_frame,  ground_truth, None, extra_info)
         loss = self.diffusion_loss_weight * diff_loss 
     
-        loss.backward()
-        self.optimizer.step()
+        self._backward(loss)
+        self._step_optimizer(model)
         model.update()
 
         return {"diff_loss":diff_loss.item()}
     
 
+    def compute_student_loss_fused(self, model, sampled_frames, sch_samp_prob, extra_info):
+        loss_diff_sum = 0
+        batch_size = sampled_frames.shape[0]
+        per_step = self.student_update == 'per_step'
+
+        self.optimizer.zero_grad()
+        for st_index in range(self.num_rollout -1):
+            teacher_frame = sampled_frames[:,st_index,:]
+            ground_truth = sampled_frames[:,st_index+1,:]
+            if st_index == 0:
+                last_frame = teacher_frame
+            else:
+                teacher_forcing_mask = torch.rand(batch_size, 1, device=sampled_frames.device) >= sch_samp_prob
+                last_frame = torch.where(teacher_forcing_mask, teacher_frame, pred_frame)
+
+            # teacher half and student half of one batch, twice the batch mean is the sum of both losses
+            diff_loss, pred_frame = model.compute_loss(torch.cat([teacher_frame, last_frame]), ground_truth.repeat(2, 1), None, extra_info)
+            diff_loss = 2 * diff_loss
+            pred_frame = pred_frame[batch_size:].detach()
+            loss = self.diffusion_loss_weight * diff_loss
+
+            if per_step:
+                self._backward(loss)
+                self._step_optimizer(model)
+                model.update()
+                self.optimizer.zero_grad()
+            else:
+                self._backward(loss / (self.num_rollout - 1))
+            loss_diff_sum += diff_loss.item()
+
+        if not per_step:
+            self._step_optimizer(model)
+            model.update()
+        return {"diff_loss": loss_diff_sum}
+
     def compute_student_loss(self, model, sampled_frames, sch_samp_prob, extra_info):
         #print('student forcing')
+        if self.fused_student and not self.full_T:
+            return self.compute_student_loss_fused(model, sampled_frames, sch_samp_prob, extra_info)
+
         loss_diff_sum, loss_consist_sum = 0, 0
         
         batch_size = sampled_frames.shape[0]
@@ -109,8 +153,8 @@ class AMDMTrainer(trainer_base.BaseTrainer):
                 loss = self.diffusion_loss_weight * diff_loss
              
 
-            loss.backward()
-            self.optimizer.step()
+            self._backward(loss)
+            self._step_optimizer(model)
             model.update()
 
             loss_diff_sum += diff_loss.item()
@@ -126,7 +170,7 @@ class AMDMTrainer(trainer_base.BaseTrainer):
         self._update_lr_schedule(self.optimizer, ep - 1)
         
         model.train()
-        pbar = tqdm(self.train_dataloader, colour='green')
+        pbar = tqdm(self.train_dataloader, colour='green', disable=not mp_util.is_root_proc())
         cur_samples = 1
         for frames in pbar:
             extra_info = None
@@ -2,6 +2,16 @@ import numpy as np
 import abc
 import torch
 
+def get_dtype(name):
+    # "bfloat16", "float16", ... from the config, None keeps full precision
+    return getattr(torch, name) if name is not None else None
+
+def get_autocast(device, dtype, cache_enabled=True):
+    # reduced precision matmuls with the weights kept in fp32, a no-op when dtype is None
+    device_type = torch.device(device).type
+    return torch.autocast(device_type=device_type, dtype=dtype if dtype is not None else torch.bfloat16,
+                          enabled=dtype is not None, cache_enabled=cache_enabled)
+
 class BaseModel(torch.nn.Module):
     def __init__(self, config, dataset, device):
         super().__init__()
@@ -9,6 +19,9 @@ class BaseModel(torch.nn.Module):
         self.device = device
         self.joint_parent = dataset.joint_parent
         self.joint_offset = dataset.joint_offset
+        # autocast dtype of the training forward pass and of the samplers
+        self.amp_dtype = get_dtype(config.get("optimizer", {}).get("amp_dtype", None))
+        self.inference_dtype = get_dtype(config.get("diffusion", {}).get("inference_dtype", None))
 
         return
         
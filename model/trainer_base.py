@@ -1,19 +1,37 @@
 import abc
 import copy
+import os
+import multiprocessing
 import numpy as np
 
 import torch
 import torch.optim as optim
 
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 
 import util.vis_util as vis_util
 import util.logging as logging_util
-import util.save as save_util
+import util.checkpoint as checkpoint_util
+import util.mp_util as mp_util
+import dataset.util.device_loader as device_loader_util
 import yaml
 
+# trainer the plot workers convert and plot the evaluation clips with, inherited through fork
+_plot_trainer = None
+
+
+def _init_plot_worker():
+    # the workers only run numpy / matplotlib work, one thread each
+    torch.set_num_threads(1)
+
+
+def _plot_eval_clip(*args):
+    return _plot_trainer.plot_eval_clip(*args)
+
+
 class BaseTrainer():
-    def __init__(self, config, dataset, device):
+    def __init__(self, config, dataset, device, seed=0):
         self.config = config
         self.device = device
         self.dataset = dataset
@@ -24,17 +42,45 @@ class BaseTrainer():
         self.initial_lr = optimizer_config['initial_lr']
         self.final_lr = optimizer_config['final_lr']
         self.peak_student_rate = optimizer_config.get('peak_student_rate',1.0)
+        # the model runs its forward pass under autocast (see BaseModel.amp_dtype), fp16 also needs loss scaling
+        self.amp_dtype = optimizer_config.get('amp_dtype', None)
+        self.grad_scaler = torch.amp.GradScaler(torch.device(device).type, enabled=self.amp_dtype == 'float16')
         self._get_schedule_samp_routines(config['optimizer'])
         
         test_config = config['test']
         self.test_interval = test_config["test_interval"]
         self.test_num_steps = test_config["test_num_steps"]
         self.test_num_trials = test_config["test_num_trials"]
+        # number of intermediate _ep checkpoints to keep, 0 keeps them all
+        self.keep_checkpoints = test_config.get("keep_checkpoints", 0)
+        # long horizon rollouts checked for stability at every evaluation
+        self.test_num_long_steps = test_config.get("test_num_long_steps", 1000)
+        self.test_num_long_trials = test_config.get("test_num_long_trials", 3)
+        # processes converting and plotting the evaluation rollouts in the background, 0 plots in the training process
+        self.plot_workers = test_config.get("plot_workers", 2)
+        self.plot_pool = None
+        self.plot_jobs = []
         
         self.frame_dim = dataset.frame_dim
-        self.train_dataloader = DataLoader(dataset=dataset, batch_size=self.batch_size, shuffle=True, drop_last=True)
+        # mini_batch_size stays the global batch size, every rank draws its share from its own part of the data
+        num_procs = mp_util.get_num_procs()
+        assert self.batch_size % num_procs == 0, "mini_batch_size {} is not divisible by {} processes".format(self.batch_size, num_procs)
+        if optimizer_config.get('device_loader', False):
+            # the motion is kept on the device and batches are gathered there, bypassing the DataLoader
+            self.train_dataloader = device_loader_util.DeviceMotionLoader(dataset.motion_flattened, dataset.valid_idx, dataset.rollout,
+                                        self.batch_size // num_procs, device, replacement=optimizer_config.get('device_loader_replacement', False),
+                                        num_procs=num_procs, rank=mp_util.get_proc_rank(), seed=seed)
+            self.train_sampler = self.train_dataloader
+        elif mp_util.enable_mp():
+            self.train_sampler = DistributedSampler(dataset, shuffle=True, drop_last=True, seed=seed)
+            self.train_dataloader = DataLoader(dataset=dataset, batch_size=self.batch_size // num_procs, sampler=self.train_sampler, drop_last=True)
+        else:
+            self.train_sampler = None
+            self.train_dataloader = DataLoader(dataset=dataset, batch_size=self.batch_size, shuffle=True, drop_last=True)
 
-        self.logger =  logging_util.wandbLogger(proj_name="{}_{}".format(self.NAME, dataset.NAME), run_name=self.NAME)
+        self.logger = None
+        if mp_util.is_root_proc():
+            self.logger =  logging_util.wandbLogger(proj_name="{}_{}".format(self.NAME, dataset.NAME), run_name=self.NAME)
 
         self.plot_jnts_fn = self.dataset.plot_jnts if hasattr(self.dataset, 'plot_jnts') and callable(self.dataset.plot_jnts) \
                                                         else vis_util.vis_skel
@@ -50,6 +96,36 @@ class BaseTrainer():
     def _init_optimizer(self, model):
         self.optimizer = optim.AdamW(filter(lambda p: p.requires_grad, model.parameters()), lr=self.initial_lr)
 
+    def _sync_model(self, model):
+        # every rank starts from the weights (and EMA weights) of the root process
+        for val in model.state_dict().values():
+            if torch.is_tensor(val):
+                mp_util.broadcast_inplace(val)
+
+    def _sync_gradients(self, model):
+        # average the gradients over ranks with one all-reduce, every rank computes grads for the same parameters
+        params = [p for p in model.parameters() if p.grad is not None]
+        grads = torch.cat([p.grad.reshape(-1) for p in params])
+        mp_util.reduce_inplace_mean(grads)
+        offset = 0
+        for p in params:
+            p.grad.copy_(grads[offset:offset + p.numel()].view_as(p.grad))
+            offset += p.numel()
+
+    def _backward(self, loss):
+        self.grad_scaler.scale(loss).backward()
+
+    def _step_optimizer(self, model):
+        # gradients are averaged while still scaled, so every rank sees the same inf checks
+        if mp_util.enable_mp():
+            self._sync_gradients(model)
+        self.grad_scaler.step(self.optimizer)
+        self.grad_scaler.update()
+
+    def _reduce_loss_stats(self, loss_stats):
+        # mean of the per rank losses, so the root logs the loss over the whole batch
+        return {key: mp_util.reduce_mean(val) if isinstance(val, float) else val for key, val in loss_stats.items()}
+
     def _update_lr_schedule(self, optimizer, epoch):
         """Decreases the learning rate linearly"""
         lr = self.initial_lr - (self.initial_lr - self.final_lr) * epoch / float(self.total_epochs)
@@ -82,107 +158,183 @@ class BaseTrainer():
         self.total_epochs = self.sample_schedule.shape[0]
 
 
-    def train_model(self, model, out_model_file, int_output_dir, log_file):
+    def get_resume_state(self, model, ep):
+        return {
+            "epoch": ep,
+            "model": model.state_dict(),
+            "optimizer": self.optimizer.state_dict(),
+            "grad_scaler": self.grad_scaler.state_dict(),
+            "ema_step": getattr(model, "ema_step", None),
+            "rng": checkpoint_util.get_rng_state(),
+        }
+
+    def load_resume_state(self, model, resume_file):
+        state = torch.load(resume_file, map_location="cpu", weights_only=False)
+        model.load_state_dict(state["model"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        if "grad_scaler" in state:
+            self.grad_scaler.load_state_dict(state["grad_scaler"])
+        if state["ema_step"] is not None:
+            model.ema_step = state["ema_step"]
+        checkpoint_util.set_rng_state(state["rng"])
+        print("Resuming from {} after epoch {}".format(resume_file, state["epoch"]))
+        return state["epoch"]
+
+    def start_plot_pool(self):
+        # the pool relies on fork to hand the trainer to the workers, fall back to plotting in place elsewhere
+        global _plot_trainer
+        if self.plot_workers > 0 and 'fork' in multiprocessing.get_all_start_methods():
+            _plot_trainer = self
+            self.plot_pool = multiprocessing.get_context('fork').Pool(self.plot_workers, initializer=_init_plot_worker)
+
+    def wait_plot_jobs(self):
+        # raises any error of a finished plot job, at most one evaluation worth of jobs is kept in flight
+        for job in self.plot_jobs:
+            job.get()
+        self.plot_jobs = []
+
+    def close_plot_pool(self):
+        global _plot_trainer
+        self.wait_plot_jobs()
+        if self.plot_pool is not None:
+            self.plot_pool.close()
+            self.plot_pool.join()
+            self.plot_pool = None
+            _plot_trainer = None
+
+    def train_model(self, model, out_model_file, int_output_dir, log_file, resume_file=""):
         self._init_optimizer(model)
-        for ep in range(self.total_epochs):
+        # forked before any background thread is started
+        self.start_plot_pool()
+        checkpoint_manager = checkpoint_util.CheckpointManager(max_to_keep=self.keep_checkpoints)
+        resume_out_file = os.path.join(os.path.dirname(out_model_file), "resume.ckpt")
+
+        start_ep = 0
+        if resume_file != "":
+            start_ep = self.load_resume_state(model, resume_file) + 1
+        if mp_util.enable_mp():
+            # gradients are averaged every step, so weights and EMA weights stay identical across ranks from here on
+            self._sync_model(model)
+
+        is_root = mp_util.is_root_proc()
+        for ep in range(start_ep, self.total_epochs):
+            if self.train_sampler is not None:
+                self.train_sampler.set_epoch(ep)
             loss_stats = self.train_loop(ep, model)
+            if mp_util.enable_mp():
+                loss_stats = self._reduce_loss_stats(loss_stats)
             if ep == 0:
                 continue
             if ep % self.test_interval == 0:
                 num_nans = self.evaluate(ep, model, int_output_dir)
-                save_util.save_weight(model, int_output_dir+'_ep{}.pth'.format(ep))
-                save_util.save_weight(model, out_model_file)
-                
-            self.logger.log_epoch(loss_stats)
-            self.logger.print_log(loss_stats)
+                if is_root:
+                    checkpoint_manager.save_weight(model, int_output_dir+'_ep{}.pth'.format(ep), tag="epoch")
+                    checkpoint_manager.save_weight(model, out_model_file)
+                    checkpoint_manager.save(self.get_resume_state(model, ep), resume_out_file)
             
-        save_util.save_weight(model, out_model_file)
+            if is_root:
+                self.logger.log_epoch(loss_stats)
+                self.logger.print_log(loss_stats)
+            
+        if is_root:
+            checkpoint_manager.save_weight(model, out_model_file)
+        checkpoint_manager.close()
+        self.close_plot_pool()
 
     def evaluate(self, ep, model, result_ouput_dir):
+        """
+        rolls out every test clip of this rank x trials in one batch per horizon, the NaN statistics stay
+        on the device and the conversion / plotting of every clip goes to the plot pool
+        returns the number of test clips with NaN frames
+        """
         model.eval()
         NaN_clip_num = 0
+        self.wait_plot_jobs()
 
-        for idx, (st_idx, ref_clip) in enumerate(zip(self.dataset.test_valid_idx, self.dataset.test_ref_clips)):
-            print('Eval Index:',st_idx)
-            test_out_lst = []
-            test_local_out_lst = []
+        # test clips are split across ranks
+        num_procs, rank = mp_util.get_num_procs(), mp_util.get_proc_rank()
+        clip_idx = [idx for idx in range(len(self.dataset.test_valid_idx)) if idx % num_procs == rank]
+        if len(clip_idx) > 0:
+            st_idx_lst = [self.dataset.test_valid_idx[idx] for idx in clip_idx]
+            ref_clips = np.stack([self.dataset.test_ref_clips[idx] for idx in clip_idx])
+            num_clips = len(clip_idx)
 
-            start_x = torch.from_numpy(ref_clip[0]).float().to(self.device)
-            
-            if ep == 0:
-                model_lst = self.dataset.data_component           
-                cur_jnts = []
-                for mode in model_lst:
-                    jnts_mode = self.dataset.x_to_jnts(self.dataset.denorm_data(ref_clip), mode=mode)
-                    cur_jnts.append(jnts_mode)
-                cur_jnts = np.array(cur_jnts)
-
-                self.plot_jnts_fn(cur_jnts.squeeze(), result_ouput_dir+'/gt_{}'.format(st_idx))
-                ref_clip = cur_jnts[[0],...]
-            else:
-                ref_clip = self.dataset.x_to_jnts(self.dataset.denorm_data(ref_clip), mode=self.dataset.data_component[0])[None,...]
-            
-            ref_local_clip = ref_clip - ref_clip[:,:,[0],:]
+            start_x = torch.from_numpy(ref_clips[:, 0]).float().to(self.device)
+            test_data = model.eval_seq(start_x.repeat_interleave(self.test_num_trials, dim=0), None, 
+                                       self.test_num_steps, num_clips * self.test_num_trials)
+            test_data_long = model.eval_seq(start_x.repeat_interleave(self.test_num_long_trials, dim=0), None, 
+                                            self.test_num_long_steps, num_clips * self.test_num_long_trials)
+            test_data = test_data.view(num_clips, self.test_num_trials, *test_data.shape[1:])
+            test_data_long = test_data_long.view(num_clips, self.test_num_long_trials, *test_data_long.shape[1:])
+
+            nan_ratio = torch.isnan(test_data).flatten(1).float().mean(dim=1).cpu().numpy()
+            nan_ratio_long = torch.isnan(test_data_long).flatten(1).float().mean(dim=1).cpu().numpy()
+            test_data = test_data.detach().cpu().numpy()
+            test_data_long = test_data_long.detach().cpu().numpy()
 
-            test_out_lst.append(ref_clip.squeeze())
-            test_data = model.eval_seq(start_x, None, self.test_num_steps, self.test_num_trials)
-            test_data_long = model.eval_seq(start_x, None, 1000, 3)
+            for i, st_idx in enumerate(st_idx_lst):
+                print('Eval Index:',st_idx)
+                print('percent of nan frames : {}'.format(nan_ratio[i]))
+                print('percent of nan frames for long horizon gen : {}'.format(nan_ratio_long[i]))
+                should_plot = nan_ratio[i] == 0
+                if not should_plot:
+                    NaN_clip_num += 1
 
-            num_all = torch.numel(test_data)
-            num_nans = torch.sum(torch.isnan(test_data))
+                args = (ep, st_idx, ref_clips[i], test_data[i], test_data_long[i], should_plot, result_ouput_dir)
+                if self.plot_pool is not None:
+                    self.plot_jobs.append(self.plot_pool.apply_async(_plot_eval_clip, args))
+                else:
+                    self.plot_eval_clip(*args)
 
-            num_all_long = torch.numel(test_data_long)
-            num_nans_long = torch.sum(torch.isnan(test_data_long))
-        
-            print('percent of nan frames : {}'.format(num_nans*1.0/num_all))
-            print('percent of nan frames for long horizon gen : {}'.format(num_nans_long*1.0/num_all_long))
-            should_plot = True
-            if num_nans > 0:
-                NaN_clip_num += 1
-                should_plot = False
-                #print('skip calc stats {} to save time'.format(st_idx))
-                #if False:#NaN_clip_num >= len(self.dataset.test_valid_idx)-1:
-                #continue # skip calc stats to save time
-                        
-            test_data = test_data.detach().cpu().numpy()
+        if mp_util.enable_mp():
+            NaN_clip_num = mp_util.reduce_sum(NaN_clip_num)
 
-            for i in range(test_data.shape[0]):
-                cur_denormed_test_data = self.dataset.denorm_data(copy.deepcopy(test_data[i]))
-                cur_jnts = []
-               
-                for mode in self.dataset.data_component:
-                    jnts_mode = self.dataset.x_to_jnts(cur_denormed_test_data, mode = mode)
-                    cur_jnts.append(jnts_mode)
-
-                    if mode == self.dataset.data_component[0]:
-                        test_out_lst.append(jnts_mode)
-                        jnts_mode_local = jnts_mode - jnts_mode[:,[0],:]  
-                        test_local_out_lst.append(jnts_mode_local)
-                cur_jnts = np.array(cur_jnts)
-                if should_plot:
-                    self.plot_jnts_fn(cur_jnts.squeeze(), result_ouput_dir+'/{}_{}'.format(st_idx,i))
-            test_out_lst = np.array(test_out_lst)
-            self.plot_traj_fn(test_out_lst, result_ouput_dir+'/{}'.format(st_idx))
-            
-            test_data_long = test_data_long.detach().cpu().numpy()
-            test_out_long_lst = []
-            for i in range(test_data_long.shape[0]):
-                cur_denormed_test_data = self.dataset.denorm_data(copy.deepcopy(test_data_long[i]))
-                cur_jnts = []
-               
-                for mode in self.dataset.data_component:
-                    jnts_mode = self.dataset.x_to_jnts(cur_denormed_test_data, mode = mode)
-                    cur_jnts.append(jnts_mode)
-
-                    if mode == self.dataset.data_component[0]:
-                        test_out_long_lst.append(jnts_mode)
-                        jnts_mode_local = jnts_mode - jnts_mode[:,[0],:]  
-                cur_jnts = np.array(cur_jnts)
-              
-            test_out_long_lst = np.array(test_out_long_lst)
-            self.plot_traj_fn(test_out_long_lst, result_ouput_dir+'/{}_long'.format(st_idx))
-            
+        return NaN_clip_num
 
+    def plot_eval_clip(self, ep, st_idx, ref_clip, test_data, test_data_long, should_plot, result_ouput_dir):
+        """
+        ref_clip: [T, F], test_data: [trials, T, F], test_data_long: [long trials, long T, F], all normalized
+        plots the joints of every trial and the trajectories of the reference and the trials
+        """
+        test_out_lst = []
+        test_local_out_lst = []
+        if ep == 0:
+            model_lst = self.dataset.data_component           
+            cur_jnts = []
+            for mode in model_lst:
+                jnts_mode = self.dataset.x_to_jnts(self.dataset.denorm_data(ref_clip), mode=mode)
+                cur_jnts.append(jnts_mode)
+            cur_jnts = np.array(cur_jnts)
 
+            self.plot_jnts_fn(cur_jnts.squeeze(), result_ouput_dir+'/gt_{}'.format(st_idx))
+            ref_clip = cur_jnts[[0],...]
+        else:
+            ref_clip = self.dataset.x_to_jnts(self.dataset.denorm_data(ref_clip), mode=self.dataset.data_component[0])[None,...]
+        
+        test_out_lst.append(ref_clip.squeeze())
+        for i in range(test_data.shape[0]):
+            cur_denormed_test_data = self.dataset.denorm_data(copy.deepcopy(test_data[i]))
+            cur_jnts = []
+           
+            for mode in self.dataset.data_component:
+                jnts_mode = self.dataset.x_to_jnts(cur_denormed_test_data, mode = mode)
+                cur_jnts.append(jnts_mode)
 
-        return NaN_clip_num
\ No newline at end of file
+                if mode == self.dataset.data_component[0]:
+                    test_out_lst.append(jnts_mode)
+                    jnts_mode_local = jnts_mode - jnts_mode[:,[0],:]  
+                    test_local_out_lst.append(jnts_mode_local)
+            cur_jnts = np.array(cur_jnts)
+            if should_plot:
+                self.plot_jnts_fn(cur_jnts.squeeze(), result_ouput_dir+'/{}_{}'.format(st_idx,i))
+        test_out_lst = np.array(test_out_lst)
+        self.plot_traj_fn(test_out_lst, result_ouput_dir+'/{}'.format(st_idx))
+        
+        test_out_long_lst = []
+        for i in range(test_data_long.shape[0]):
+            cur_denormed_test_data = self.dataset.denorm_data(copy.deepcopy(test_data_long[i]))
+            jnts_mode = self.dataset.x_to_jnts(cur_denormed_test_data, mode = self.dataset.data_component[0])
+            test_out_long_lst.append(jnts_mode)
+          
+        test_out_long_lst = np.array(test_out_long_lst)
+        self.plot_traj_fn(test_out_long_lst, result_ouput_dir+'/{}_long'.format(st_idx))
\ No newline at end of file
@@ -7,16 +7,16 @@ import model.amdm_text_trainer as amdm_text_trainer
 
 import dataset.dataset_builder as dataset_builder
 
-def build_trainer(config_file, device):
+def build_trainer(config_file, device, seed=0):
     model_config = load_config_file(config_file)
     model_name = model_config["model_name"]
     dataset = dataset_builder.build_dataset(config_file, load_full_dataset=True)
 
     print("Building {} trainer".format(model_name))
     if (model_name == amdm_model.AMDM.NAME):
-        trainer = amdm_trainer.AMDMTrainer(config=model_config, dataset=dataset, device=device)
+        trainer = amdm_trainer.AMDMTrainer(config=model_config, dataset=dataset, device=device, seed=seed)
     elif (model_name == amdm_text_model.AMDM.NAME):
-        trainer = amdm_text_trainer.AMDMTrainer(config=model_config, dataset=dataset, device=device)
+        trainer = amdm_text_trainer.AMDMTrainer(config=model_config, dataset=dataset, device=device, seed=seed)
 
     else:
         assert(False), "Unsupported trainer: {}".format(model_name)
@@ -358,9 +358,11 @@ class SinglePlayerStadiumScene(StadiumScene):
 
 
 class Camera:
-    def __init__(self, bc, fps=60, dist=2.5, yaw=0, pitch=-5):
+    def __init__(self, bc, fps=60, dist=2.5, yaw=0, pitch=-5, headless=False):
 
         self._p = bc
+        # without a window the camera keeps its own state, never sleeps and renders with TinyRenderer
+        self.headless = headless
         self._dist = dist
         self._yaw = yaw
         self._pitch = pitch
@@ -383,6 +385,11 @@ class Camera:
             smooth_coef = self._coef if smooth_coef is None else smooth_coef
             assert (smooth_coef <= 1).all(), "Invalid camera smoothing parameters"
 
+            if self.headless:
+                self.camera_target = (1 - smooth_coef) * np.asarray(self.camera_target) + smooth_coef * pos
+                self.wait()
+                return
+
             yaw, pitch, dist, lookat_ = self._p.getDebugVisualizerCamera()[-4:]
             lookat = (1 - smooth_coef) * lookat_ + smooth_coef * pos
 
@@ -422,6 +429,26 @@ class Camera:
 
         return rgb_array
 
+    def dump_tracking_rgb_array(self, width, height):
+        # view of the tracked target, offscreen with TinyRenderer when headless
+        view_matrix = self._p.computeViewMatrixFromYawPitchRoll(
+            self.camera_target, self._dist, self._yaw, self._pitch, 0, upAxisIndex=2
+        )
+        proj_matrix = self._p.computeProjectionMatrixFOV(
+            fov=60, aspect=width / height, nearVal=0.01, farVal=1000
+        )
+
+        (_, _, rgb_array, _, _) = self._p.getCameraImage(
+            width=width,
+            height=height,
+            viewMatrix=view_matrix,
+            projectionMatrix=proj_matrix,
+            renderer=pybullet.ER_TINY_RENDERER if self.headless else pybullet.ER_BULLET_HARDWARE_OPENGL,
+            flags=pybullet.ER_NO_SEGMENTATION_MASK,
+        )
+
+        return np.reshape(rgb_array, (height, width, 4))[:, :, :3]
+
     def dump_orthographic_rgb_array(self, lookat=[0, 0, 0]):
         distance = 20
         # yaw = 0
@@ -454,7 +481,8 @@ class Camera:
 
     def wait(self):
         delta = time.perf_counter() - self._counter
-        time.sleep(max(self._target_period - delta, 0))
+        if not self.headless:
+            time.sleep(max(self._target_period - delta, 0))
         now = time.perf_counter()
         self._fps = 0.99 * self._fps + 0.01 / (now - self._counter)
         self._counter = now
@@ -3,11 +3,13 @@ import glob
 import inspect
 import math
 import os
+import queue
+import threading
 import time
 import types
 
 import numpy as np
-from imageio import imwrite
+import imageio
 
 if not hasattr(time, "perf_counter_ns"):
     setattr(time, "perf_counter_ns", getattr(time, "perf_counter"))
@@ -84,6 +86,15 @@ POSE_CSV_HEADER = (
 )
 
 
+def get_render_config(config):
+    # headless renders offscreen (pybullet DIRECT + TinyRenderer), record_video streams frames to one video file
+    headless = config.get('headless', False)
+    record_video = config.get('record_video', False)
+    video_fps = config.get('video_fps', 30)
+    video_size = config.get('video_size', [1280, 720])
+    return headless, record_video, video_fps, video_size
+
+
 def rad_to_deg(rad):
     return rad * 180 / np.pi
 
@@ -134,10 +145,121 @@ class FPSController:
         return fps
 
 
+class VideoWriter(object):
+    """Encodes frames into a single video file on a background thread.
+
+    Frames go through a bounded queue, a slow encoder makes put() wait instead of piling frames up in memory.
+    """
+    def __init__(self, filename, fps, max_queue=32):
+        self.writer = imageio.get_writer(filename, fps=fps, macro_block_size=1)
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None
+        self.thread = threading.Thread(target=self._encode, daemon=True)
+        self.thread.start()
+
+    def _encode(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            if self.error is None:
+                try:
+                    self.writer.append_data(frame)
+                except Exception as e:
+                    self.error = e
+        self.writer.close()
+
+    def put(self, frame):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(frame)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+class MotionRecorder(object):
+    """Streams the frames generated by an env to one BVH and trajectory file per character.
+
+    Frames are buffered as they are generated, flush() hands the new ones to a background thread that
+    denormalizes them, continues the root integration from the previous chunk and appends them to the
+    open BVH files, so the cost of a flush only depends on the number of new frames. The trajectories
+    are collected along the way and written once on close().
+    """
+    def __init__(self, dataset, out_dir, num_characters, max_queue=8):
+        self.dataset = dataset
+        self.out_dir = out_dir
+        self.num_characters = num_characters
+        self.num_frames = 0
+        self.pending = []
+        self.error = None
+
+        self.bvh_writers = [dataset.open_bvh_stream(os.path.join(out_dir, "out{}".format(i))) for i in range(num_characters)]
+        self.root_states = [None] * num_characters
+        self.trajs = [[] for _ in range(num_characters)]
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def _write(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            if self.error is None:
+                try:
+                    self._write_chunk(*job)
+                except Exception as e:
+                    self.error = e
+        for writer in self.bvh_writers:
+            writer.close()
+        if self.error is None:
+            for i in range(self.num_characters):
+                if len(self.trajs[i]) > 0:
+                    np.save(os.path.join(self.out_dir, "traj{}".format(i)), np.concatenate(self.trajs[i], axis=0))
+
+    def _write_chunk(self, frames, info):
+        seqs = self.dataset.denorm_data(frames)
+        for i in range(self.num_characters):
+            root_pos, self.root_states[i] = self.dataset.append_bvh_stream(self.bvh_writers[i], seqs[i], self.root_states[i])
+            self.trajs[i].append(root_pos[..., [0, 2]])
+        if info is not None:
+            np.savez(os.path.join(self.out_dir, "out.npz"), **info)
+
+    def append(self, frames):
+        # frames: [num_characters, frame_dim] normalized, torch or numpy
+        if hasattr(frames, "detach"):
+            frames = frames.detach().cpu().numpy()
+        self.pending.append(np.array(frames, dtype=np.float64))
+        self.num_frames += 1
+
+    def flush(self, info=None):
+        # info: optional dict saved to out.npz once the frames are written
+        if self.error is not None:
+            raise self.error
+        if len(self.pending) == 0:
+            return
+        frames = np.stack(self.pending, axis=1)
+        self.pending = []
+        self.queue.put((frames, info))
+
+    def close(self, info=None):
+        self.flush(info)
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
 class EpisodeRunner(object):
-    def __init__(self, env, save=False, dir=None, max_steps=None, csv=None):
+    def __init__(self, env, save=None, dir=None, max_steps=None, csv=None):
         self.env = env
-        self.save = save
+        # by default follow the record_video option of the env
+        self.save = getattr(env, "record_video", False) if save is None else save
         self.done = False
         self.csv = csv
 
@@ -157,19 +279,18 @@ class EpisodeRunner(object):
 
         if self.save:
             self.camera = env.viewer.camera
-            self.buffer = []
             self.max_steps = env.max_timestep if max_steps is None else max_steps
+            self.video_fps = getattr(env, "video_fps", env.data_fps)
+            self.video_size = getattr(env, "video_size", [1280, 720])
+            # video frames are taken on the video clock, independent of the simulation step rate
+            self.steps_per_video_frame = env.data_fps / self.video_fps
+            self.next_video_step = 0.0
 
             now_string = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
             self.filename = os.path.join(self.dump_dir, "{}.mp4".format(now_string))
-            print("\nRecording... Close to terminate recording.")
-
-            try:
-                os.makedirs(self.dump_dir)
-            except OSError:
-                files = glob.glob(os.path.join(self.dump_dir, "*.png"))
-                for f in files:
-                    os.remove(f)
+            os.makedirs(self.dump_dir, exist_ok=True)
+            self.video_writer = VideoWriter(self.filename, self.video_fps)
+            print("\nRecording to {} ... Close to terminate recording.".format(self.filename))
 
         self.pbar = None
         if self.max_steps != env.max_timestep and self.max_steps != float("inf"):
@@ -203,10 +324,11 @@ class EpisodeRunner(object):
         self.env.render = types.MethodType(new_render, self.env)
 
     def store_current_frame(self):
-        if self.save:
-            image = self.camera.dump_rgb_array()
-            # self.buffer.append(image)
-            imwrite("outfile_{:04d}.png".format(self.step), image)
+        if self.save and self.step >= self.next_video_step:
+            image = self.camera.dump_tracking_rgb_array(*self.video_size)
+            while self.step >= self.next_video_step:
+                self.video_writer.put(image)
+                self.next_video_step += self.steps_per_video_frame
 
     def save_csv_render_data(self):
         if self.csv is not None:
@@ -236,11 +358,14 @@ class EpisodeRunner(object):
         return self
 
     def __exit__(self, *args):
-        if self.save and len(self.buffer) >= self.max_steps:
-            import moviepy.editor as mp
+        if self.save:
+            self.video_writer.close()
+            print("Saved video to {}".format(self.filename))
 
-            # clip = mp.ImageSequenceClip(self.buffer, fps=self.env.data_fps)
-            # clip.write_videofile(self.filename)
+        # finish the motion files the env streamed during the episode
+        close_motion_recorder = getattr(self.env, "close_motion_recorder", None)
+        if close_motion_recorder is not None:
+            close_motion_recorder()
 
         if self.csv is not None:
             np.savetxt(
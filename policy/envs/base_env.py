@@ -4,6 +4,7 @@ import gymnasium as gym
 
 import torch
 from render.realtime.mocap_renderer import PBLMocapViewer
+from policy.common.misc_utils import MotionRecorder, get_render_config
 
 coord_table = {'x':0, 'y':2, 'z':1}
 def get_xyz_index(coord_order):
@@ -19,11 +20,13 @@ class EnvBase(gym.Env):
         self.frame_skip = config.get('frame_skip',1)
         self.max_timestep = config.get('max_timestep_test',2000) if self.is_rendered else config.get('max_timestep',1000//self.frame_skip)
         self.camera_tracking = config.get('camera_tracking',True)
+        self.headless, self.record_video, self.video_fps, self.video_size = get_render_config(config)
         
         self.int_output_dir = config['int_output_dir']
 
         self.model = model
         self.dataset = dataset       
+        self.rollout_noise = None
 
         self.frame_dim = dataset.frame_dim
         self.data_fps = dataset.fps
@@ -89,8 +92,9 @@ class EnvBase(gym.Env):
 
         if self.is_rendered:
             self.record_num_frames = np.zeros((self.num_parallel_test,))
-            self.record_motion_seq = np.zeros((self.num_parallel_test, self.max_timestep, self.dataset.frame_dim))
             self.record_timestep = 0
+        # streams recorded frames to int_output_dir, opened on the first recorded frame
+        self.motion_recorder = None
 
         # history size is used to calculate floating as well
         self.history_size = 5
@@ -128,20 +132,32 @@ class EnvBase(gym.Env):
         self.action_space = gym.spaces.Box(-high, high, dtype=np.float32)
 
 
+    def record_motion(self, frames):
+        # frames: [num_parallel, frame_dim] normalized, written out by save_motion
+        if self.motion_recorder is None:
+            self.motion_recorder = MotionRecorder(self.dataset, self.int_output_dir, frames.shape[0])
+        self.motion_recorder.append(frames)
+        self.record_timestep += 1
+
+    def get_motion_info(self):
+        return {'action': None, 'init_frame': self.init_frame.cpu().numpy(), 'nframe': self.record_timestep}
+
     def save_motion(self):
-        seqs = self.dataset.denorm_data(self.record_motion_seq)#.detach().cpu().numpy()
-        for i in range(seqs.shape[0]):
-            seq = seqs[i]
-            xzs = self.dataset.x_to_trajs(seq)
-            self.dataset.save_bvh(osp.join(self.int_output_dir,'out{}'.format(i)),seq)
-            np.save(osp.join(self.int_output_dir,'traj{}'.format(i)),xzs)
+        # appends the frames recorded since the last call to out{i}.bvh on a background thread, traj{i}.npy is written on close
+        if self.motion_recorder is not None:
+            self.motion_recorder.flush(self.get_motion_info())
 
-        np.savez(osp.join(self.int_output_dir,'out.npz'), action=None, init_frame = self.init_frame.cpu().numpy(), nframe=self.record_timestep)
+    def close_motion_recorder(self):
+        if self.motion_recorder is not None:
+            self.motion_recorder.close(self.get_motion_info())
+            self.motion_recorder = None
 
 
 
     def integrate_root_translation(self, pose):
-        pose_denorm = self.dataset.denorm_data(pose, device=pose.device)
+        # only the root columns are needed here
+        root_cols = self.dataset.get_root_cols()
+        pose_denorm = self.dataset.denorm_data(pose[..., root_cols], cols=root_cols)
         dr = self.dataset.get_heading_dr(pose_denorm)[...,None]
         root_xz_vel = self.dataset.get_root_linear_planar_vel(pose_denorm)
 
@@ -181,7 +197,10 @@ class EnvBase(gym.Env):
         extra_info = self.extra_info
         
         with torch.no_grad():
-            output = self.model.rl_step(condition, action, extra_info)
+            if self.rollout_noise is not None:
+                output = self.model.rl_step(condition, action, extra_info, self.rollout_noise)
+            else:
+                output = self.model.rl_step(condition, action, extra_info)
             
         #if self.is_rendered:   
         #    self.record_motion_seq[:,self.record_timestep,:]= output.cpu().detach().numpy()
@@ -308,17 +327,21 @@ class EnvBase(gym.Env):
 
     def seed(self, seed=None):
         self.np_random, seed = gym.utils.seeding.np_random(seed)
+        if getattr(self.model, 'seeded_noise', False):
+            # one noise stream per character, seeded with seed + character index
+            self.rollout_noise = self.model.get_rollout_noise(self.num_parallel, seed % 2**31)
         return [seed]
 
     def close(self):
+        self.close_motion_recorder()
         if self.is_rendered:
             self.viewer.close()
 
     def render(self, mode="human"):
-        frame = self.dataset.denorm_data(self.history[:, 0], device=self.device).detach().cpu().numpy()
         if self.is_rendered:
+            frame = self.dataset.denorm_data(self.history[:, 0].detach(), device=self.device)
             self.viewer.render(
-                torch.tensor(self.dataset.x_to_jnts(frame, mode='angle'),device=self.device,dtype=self.root_facing.dtype),  # 0 is the newest
+                self.dataset.fk_local_frame_pt(frame).type(self.root_facing.dtype),  # 0 is the newest
                 self.root_facing,
                 self.root_xz,
                 0.0,  # No time in this env
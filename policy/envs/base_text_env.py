@@ -4,6 +4,7 @@ import gymnasium as gym
 
 import torch
 from render.realtime.mocap_renderer import PBLMocapViewer
+from policy.common.misc_utils import get_render_config
 
 coord_table = {'x':0, 'y':2, 'z':1}
 def get_xyz_index(coord_order):
@@ -19,6 +20,7 @@ class EnvBase(gym.Env):
         self.frame_skip = config.get('frame_skip',1)
         self.max_timestep = config.get('max_timestep_test',2000) if self.is_rendered else config.get('max_timestep',1000//self.frame_skip)
         self.camera_tracking = config.get('camera_tracking',True)
+        self.headless, self.record_video, self.video_fps, self.video_size = get_render_config(config)
         
         self.int_output_dir = config['int_output_dir']
 
@@ -141,7 +143,9 @@ class EnvBase(gym.Env):
 
 
     def integrate_root_translation(self, pose):
-        pose_denorm = self.dataset.denorm_data(pose, device=pose.device)
+        # only the root columns are needed here
+        root_cols = self.dataset.get_root_cols()
+        pose_denorm = self.dataset.denorm_data(pose[..., root_cols], cols=root_cols)
         dr = self.dataset.get_heading_dr(pose_denorm)[...,None]
         root_xz_vel = self.dataset.get_root_linear_planar_vel(pose_denorm)
 
@@ -315,10 +319,10 @@ class EnvBase(gym.Env):
             self.viewer.close()
 
     def render(self, mode="human"):
-        frame = self.dataset.denorm_data(self.history[:, 0], device=self.device).detach().cpu().numpy()
         if self.is_rendered:
+            frame = self.dataset.denorm_data(self.history[:, 0].detach(), device=self.device)
             self.viewer.render(
-                torch.tensor(self.dataset.x_to_jnts(frame, mode='angle'),device=self.device,dtype=self.root_facing.dtype),  # 0 is the newest
+                self.dataset.fk_local_frame_pt(frame).type(self.root_facing.dtype),  # 0 is the newest
                 self.root_facing,
                 self.root_xz,
                 0.0,  # No time in this env
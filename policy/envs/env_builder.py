@@ -3,8 +3,10 @@ import gymnasium as gym
 from gymnasium.envs.registration import register, registry
 
 
-def build_envs(config_file, int_output_dir, model, dataset, mode, device):
+def build_envs(config_file, int_output_dir, model, dataset, mode, device, overrides=None):
     config = load_yaml_file(config_file)
+    if overrides is not None:
+        config.update(overrides)
     env_module = config["env_module"]
     env_name = config["env_name"]
     config['int_output_dir']  = int_output_dir
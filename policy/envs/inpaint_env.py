@@ -454,14 +454,16 @@ class InpaintEnv(base_env.EnvBase):
             else:
                 cur_extra_info['interact_stop_step'] = 18
             '''
-            output = self.model.eval_step_interactive(condition,  self.mask[:,self.record_timestep], self.content[:,self.record_timestep], cur_extra_info)
+            if self.rollout_noise is not None:
+                output = self.model.eval_step_interactive(condition,  self.mask[:,self.record_timestep], self.content[:,self.record_timestep], cur_extra_info, self.rollout_noise)
+            else:
+                output = self.model.eval_step_interactive(condition,  self.mask[:,self.record_timestep], self.content[:,self.record_timestep], cur_extra_info)
             
         output = output.view(-1,self.frame_dim)
         #output = self.dataset.denorm_data(output.cpu()).to(self.device)
         
         if self.is_rendered:
-            self.record_motion_seq[:,self.record_timestep,:]=output.cpu().detach().numpy()
-            self.record_timestep += 1
+            self.record_motion(output)
             if self.record_timestep % 30 == 0 and self.record_timestep != 0:
                 self.save_motion()
                 if self.waypoints is not None:
@@ -541,10 +543,10 @@ class InpaintEnv(base_env.EnvBase):
         )
     
     def render(self, mode="human"):
-        frame = self.dataset.denorm_data(self.history[:, 0], device=self.device).cpu().numpy()
         if self.is_rendered:
+            frame = self.dataset.denorm_data(self.history[:, 0].detach(), device=self.device)
             self.viewer.render(
-                torch.tensor(self.dataset.x_to_jnts(frame, mode='angle'),device=self.device),  # 0 is the newest
+                self.dataset.fk_local_frame_pt(frame),  # 0 is the newest
                 self.root_facing,
                 self.root_xz,
                 0.0,  # No time in this env
@@ -1,6 +1,7 @@
 
 import policy.envs.base_env as base_env
 from render.realtime.mocap_renderer import PBLMocapViewer
+from policy.common.misc_utils import get_render_config
 import torch
 import numpy as np
 import gymnasium as gym
@@ -31,6 +32,7 @@ class RandomPlayEnv(base_env.EnvBase):
         self.frame_skip = config.get('frame_skip',1)
         self.max_timestep = config.get('max_timestep',10000)
         self.camera_tracking = config.get('camera_tracking',True)
+        self.headless, self.record_video, self.video_fps, self.video_size = get_render_config(config)
         self.int_output_dir = config['int_output_dir']
 
         self.num_condition_frames = 1
@@ -80,7 +82,10 @@ class RandomPlayEnv(base_env.EnvBase):
         condition = self.get_cond_frame()
        
         with torch.no_grad():
-            output = self.model.eval_step(condition, self.cur_extra_info)
+            if self.rollout_noise is not None:
+                output = self.model.eval_step(condition, self.cur_extra_info, rollout_noise=self.rollout_noise)
+            else:
+                output = self.model.eval_step(condition, self.cur_extra_info)
             #output = self.dataset.unify_rpr_within_frame(condition, output)
         
         return output
@@ -139,9 +144,9 @@ class RandomPlayEnv(base_env.EnvBase):
         )
     
     def render(self, mode="human"):
-        frame = self.dataset.denorm_data(self.history[:, 0], device=self.device).cpu().numpy()
+        frame = self.dataset.denorm_data(self.history[:, 0].detach(), device=self.device)
         self.viewer.render(
-            torch.tensor(self.dataset.x_to_jnts(frame, mode='angle'),device=self.device, dtype=self.history.dtype),  # 0 is the newest
+            self.dataset.fk_local_frame_pt(frame),  # 0 is the newest
             self.root_facing,
             self.root_xz,
             0.0,  # No time in this env
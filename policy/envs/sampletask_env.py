@@ -1,6 +1,7 @@
 
 import policy.envs.base_env as base_env
 from render.realtime.mocap_renderer import PBLMocapViewer
+import time
 import torch
 import numpy as np
 import tkinter as tk
@@ -87,6 +88,20 @@ class SampleTaskEnv(base_env.EnvBase):
         self.update_textemb(self.texts)
         self.num_candidate = config['num_candidate']
         self.max_timestep = 10000
+
+        # 'greedy' keeps the candidate closest to the target after one frame, 'mpc' rolls the candidates
+        # plan_horizon frames ahead and commits plan_replan_every frames of the cheapest one
+        self.planner = config.get('planner', 'greedy')
+        self.plan_horizon = config.get('plan_horizon', 8)
+        self.plan_replan_every = config.get('plan_replan_every', 1)
+        self.plan_warm_start = config.get('plan_warm_start', True)
+        self.plan_cost = config.get('plan_cost', {'target': 1.0})
+        self.plan_foot_height = config.get('plan_foot_height', 0.1)
+        self.plan_time_budget = config.get('plan_time_budget', 1.0 / 30)
+        for name in self.plan_cost:
+            assert hasattr(self, 'calc_plan_cost_' + name), "Unsupported plan cost: {}".format(name)
+        self.cur_plan_horizon = self.plan_horizon
+        self.plan = None
         
         self.arena_length = (-15.0, 15.0)
         self.arena_width = (-15.0, 15.0)
@@ -180,7 +195,7 @@ class SampleTaskEnv(base_env.EnvBase):
         print(condition_frames.shape)
         with torch.no_grad():
             frames = self.model.eval_step(condition_frames, self.cur_extra_info)
-        frames = self.dataset.denorm_data(frames.cpu()).to(self.device)
+        frames = self.dataset.denorm_data(frames)
         #frames = frames.view(self.num_parallel, self.num_candidate, -1)
         cur_pos = self.step_candidate(frames)
         dist = self.compute_distance(cur_pos, self.target).reshape(self.num_parallel, self.num_candidate)
@@ -192,6 +207,120 @@ class SampleTaskEnv(base_env.EnvBase):
         return best_frames
 
 
+    def get_plan_extra_info(self, start_slot):
+        # extra info of the candidates from start_slot on, the condition of every character repeated per candidate
+        cond = self.cur_extra_info['cond'] if self.cur_extra_info is not None else None
+        if cond is None:
+            return self.cur_extra_info
+        cond = cond[:, None].expand(-1, self.num_candidate, *cond.shape[1:])[:, start_slot:]
+        return {**self.cur_extra_info, 'cond': cond.reshape(-1, *cond.shape[2:])}
+
+    def rollout_candidates(self, condition, horizon, warm_plan=None):
+        """
+        condition: [N, F] normalized, warm_plan: [N, L, F] frames kept from the last plan, L < horizon
+        returns [N, K, horizon, F] normalized candidate frames, candidate 0 continues warm_plan when given
+        """
+        num_warm = 0 if warm_plan is None else warm_plan.shape[1]
+        cur = condition[:, None].expand(-1, self.num_candidate, -1).clone()
+        frames = cur.new_empty((condition.shape[0], self.num_candidate, horizon, self.frame_dim))
+        for h in range(horizon):
+            # the warm candidate only needs sampling once its kept frames run out
+            start_slot = 1 if h < num_warm else 0
+            with torch.no_grad():
+                nxt = self.model.eval_step(cur[:, start_slot:].reshape(-1, self.frame_dim), self.get_plan_extra_info(start_slot))
+            cur[:, start_slot:] = nxt.view(condition.shape[0], -1, self.frame_dim)
+            if start_slot == 1:
+                cur[:, 0] = warm_plan[:, h]
+            frames[:, :, h] = cur
+        return frames
+
+    def integrate_candidates(self, frames):
+        """
+        frames: [N, K, H, F] denormalized
+        returns the root position [N, K, H, 2] and facing [N, K, H, 1] after each frame, integrated as integrate_root_translation
+        """
+        flat = frames.reshape(-1, self.frame_dim)
+        dr = self.dataset.get_heading_dr(flat).view(*frames.shape[:3], 1)
+        vel = self.dataset.get_root_linear_planar_vel(flat).view(*frames.shape[:3], -1)
+
+        facing = self.root_facing[:, None, None] + dr.cumsum(dim=2)
+        facing_before = facing - dr
+        cos, sin = facing_before.cos(), facing_before.sin()
+        displacement = torch.cat([cos * vel[..., [0]] - sin * vel[..., [1]], sin * vel[..., [0]] + cos * vel[..., [1]]], dim=-1)
+        root_xz = self.root_xz[:, None, None] + displacement.cumsum(dim=2)
+        return root_xz, facing
+
+    def calc_plan_cost_target(self, frames, root_xz, root_facing):
+        return torch.norm(self.target[:, None, None, :2] - root_xz, dim=-1)
+
+    def calc_plan_cost_heading(self, frames, root_xz, root_facing):
+        # 0 when facing the target, same angle convention as get_target_delta_and_angle
+        delta = self.target[:, None, None, :2] - root_xz
+        angle = torch.atan2(delta[..., 1], delta[..., 0]) + root_facing[..., 0]
+        return 1 - angle.cos()
+
+    def calc_plan_cost_foot_contact(self, frames, root_xz, root_facing):
+        # planar speed of the feet close to the ground, i.e. foot skating
+        # the dim lists are [st, ed], left [0, 0] (or empty) when the features hold no joint positions / velocities
+        joint_dim_lst, vel_dim_lst = self.dataset.joint_dim_lst, self.dataset.vel_dim_lst
+        if self.dataset.foot_idx is None or len(joint_dim_lst) < 2 or joint_dim_lst[1] <= joint_dim_lst[0] \
+                or len(vel_dim_lst) < 2 or vel_dim_lst[1] <= vel_dim_lst[0]:
+            return torch.zeros(frames.shape[:3], device=frames.device, dtype=frames.dtype)
+        flat = frames.reshape(-1, self.frame_dim)
+        pos = self.dataset.jnts_frame_pt(flat)[:, self.dataset.foot_idx]
+        vel = flat[:, vel_dim_lst[0]:vel_dim_lst[1]].view(-1, self.num_joint, 3)[:, self.dataset.foot_idx]
+        in_contact = (pos[..., 1] < self.plan_foot_height).type(frames.dtype)
+        skate = (vel[..., [0, 2]].norm(dim=-1) * in_contact).mean(dim=-1)
+        return skate.view(frames.shape[:3])
+
+    def calc_plan_cost(self, frames):
+        # weighted plan_cost terms averaged over the horizon, [N, K]
+        root_xz, root_facing = self.integrate_candidates(frames)
+        cost = 0
+        for name, weight in self.plan_cost.items():
+            if weight != 0:
+                cost = cost + weight * getattr(self, 'calc_plan_cost_' + name)(frames, root_xz, root_facing).mean(dim=-1)
+        return cost
+
+    def update_plan_horizon(self, plan_time):
+        # planning time per committed frame has to fit plan_time_budget, shrink the horizon when it does not
+        if self.plan_time_budget <= 0:
+            return
+        frame_time = plan_time / min(self.plan_replan_every, self.cur_plan_horizon)
+        if frame_time > self.plan_time_budget and self.cur_plan_horizon > 1:
+            self.cur_plan_horizon -= 1
+        elif frame_time < 0.5 * self.plan_time_budget and self.cur_plan_horizon < self.plan_horizon:
+            self.cur_plan_horizon += 1
+
+    def mpc_search(self, condition_frames):
+        """
+        multi-frame lookahead: the candidates are rolled cur_plan_horizon frames ahead in one batch, the
+        cheapest one becomes the plan. Its frames are committed one per call and the candidates are replanned
+        every plan_replan_every frames, with what is left of the plan as the warm start of candidate 0
+        """
+        if self.plan is not None and self.plan.shape[1] > self.cur_plan_horizon - self.plan_replan_every:
+            # the plan is kept normalized for the warm start, frames are returned denormalized as greedy_search does
+            best_frame = self.plan[:, 0]
+            self.plan = self.plan[:, 1:] if self.plan.shape[1] > 1 else None
+            return self.dataset.denorm_data(best_frame)
+
+        sync = torch.device(self.device).type == 'cuda'
+        if sync:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+
+        warm_plan = self.plan if self.plan_warm_start else None
+        frames = self.rollout_candidates(condition_frames, self.cur_plan_horizon, warm_plan)
+        cost = self.calc_plan_cost(self.dataset.denorm_data(frames))
+        best_index = torch.argmin(cost, dim=-1)
+        plan = frames[torch.arange(frames.shape[0], device=frames.device), best_index]
+        self.plan = plan[:, 1:] if plan.shape[1] > 1 else None
+
+        if sync:
+            torch.cuda.synchronize()
+        self.update_plan_horizon(time.perf_counter() - start)
+        return self.dataset.denorm_data(plan[:, 0])
+
     def get_next_frame(self, action=None):
         
         if self.interative_text:
@@ -203,14 +332,16 @@ class SampleTaskEnv(base_env.EnvBase):
         condition = self.get_cond_frame()
         b = condition.shape[0]
         #print(condition.shape)
-        output = self.greedy_search(condition)
+        if self.planner == 'mpc':
+            output = self.mpc_search(condition)
+        else:
+            output = self.greedy_search(condition)
         #print(output.shape)
         #output = output.view(1,-1,self.frame_dim)
         if self.is_rendered:
-            self.record_motion_seq[:,self.record_timestep,:]=output.cpu().detach().numpy()
+            self.record_motion(output)
             if self.record_timestep % 10 == 0:
                 self.save_motion()
-            self.record_timestep += 1
         return output
         
 
@@ -270,6 +401,7 @@ class SampleTaskEnv(base_env.EnvBase):
             self.timestep = 0
             self.substep = 0
             self.done.fill_(False)
+            self.plan = None
             # value bigger than contact_threshold
             #self.foot_pos_history.fill_(1)
 
@@ -296,6 +428,7 @@ class SampleTaskEnv(base_env.EnvBase):
             self.timestep = 0
             self.substep = 0
             self.done.fill_(False)
+            self.plan = None
             # value bigger than contact_threshold
             #self.foot_pos_history.fill_(1)
 
@@ -336,7 +469,7 @@ class SampleTaskEnv(base_env.EnvBase):
 
     def get_target_delta_and_angle(self):
         target_xy_delta = self.target[:,:2] - self.root_xz
-        target_z_delta = self.target[:,2:] - self.root_y
+        target_z_delta = self.target[:,2:] - self.root_y[:,None]
         target_angle = (
             torch.atan2(target_xy_delta[:, 1], target_xy_delta[:, 0]).unsqueeze(1)
             + self.root_facing
@@ -3,6 +3,7 @@ import torch
 import math
 import policy.envs.base_env as base_env
 from render.realtime.mocap_renderer import PBLMocapViewer
+from policy.common.misc_utils import get_render_config
 import gymnasium as gym
 import numpy as np
 
@@ -14,6 +15,7 @@ class DataVisEnv(gym.Env):
         self.max_timestep = config['max_timestep']
         self.num_parallel = config["num_parallel"]
         self.camera_tracking = config.get('camera_tracking',True)
+        self.headless, self.record_video, self.video_fps, self.video_size = get_render_config(config)
         self.device = device
         self.is_rendered = True
 
@@ -175,7 +177,7 @@ class DataVisEnv(gym.Env):
     def render(self, mode="human"):
         
         self.viewer.render(
-            torch.tensor(self.dataset.x_to_jnts(self.history[:, 0].cpu().numpy(), mode='angle'),device=self.device),  # 0 is the newest
+            self.dataset.fk_local_frame_pt(self.history[:, 0]),  # 0 is the newest
             self.root_facing,
             self.root_xz,
             0.0,  # No time in this env
@@ -26,8 +26,8 @@ import torch.optim as optim
 from policy.learning.storage import RolloutStorage
 from policy.common.misc_utils import update_exponential_schedule, update_linear_schedule
 import util.logging as logging_util
-import util.save as save_util
-import copy
+import util.checkpoint as checkpoint_util
+import os
 import yaml
 from policy.common.misc_utils import EpisodeRunner
 
@@ -58,6 +58,8 @@ class PPOAgent(object):
             obs_shape,
             self.actor_critic.actor.action_dim,
             self.actor_critic.state_size,
+            getattr(torch, config.get("rollout_storage_dtype", "float32")),
+            config.get("returns_mode", "auto"),
         )
         
         self.use_gae = config["use_gae"]
@@ -74,6 +76,8 @@ class PPOAgent(object):
         self.lr_decay_type = config["lr_decay_type"]
         self.eps = config["eps"]
         self.save_interval = config["save_interval"]
+        # number of intermediate _ep checkpoints to keep, 0 keeps them all
+        self.keep_checkpoints = config.get("keep_checkpoints", 0)
         
 
         self.action_steps = self.env.config['action_step']
@@ -131,12 +135,37 @@ class PPOAgent(object):
         return action_reg_loss.mean()
 
 
-    def train_controller(self, out_model_file, int_output_dir):
+    def get_resume_state(self, update, num_samples):
+        return {
+            "update": update,
+            "num_samples": num_samples,
+            "actor_critic": self.actor_critic.state_dict(),
+            "optimizer": self.optimizer.state_dict(),
+            "rng": checkpoint_util.get_rng_state(),
+        }
+
+    def load_resume_state(self, resume_file):
+        state = torch.load(resume_file, map_location="cpu", weights_only=False)
+        self.actor_critic.load_state_dict(state["actor_critic"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        checkpoint_util.set_rng_state(state["rng"])
+        print("Resuming from {} after update {}".format(resume_file, state["update"]))
+        return state["update"], state["num_samples"]
+
+    def train_controller(self, out_model_file, int_output_dir, resume_file=""):
+        checkpoint_manager = checkpoint_util.CheckpointManager(max_to_keep=self.keep_checkpoints)
+        resume_out_file = os.path.join(os.path.dirname(out_model_file), "resume.ckpt")
+
+        start_update = 0
+        num_samples = 0
+        if resume_file != "":
+            start_update, num_samples = self.load_resume_state(resume_file)
+            start_update += 1
+
         obs = self.env.reset()
         self.rollouts.observations[0].copy_(obs)
         self.rollouts.to(self.device)
-        num_samples = 0
-        for update in range(self.num_updates):
+        for update in range(start_update, self.num_updates):
 
             ep_info = {"reward": []}
             ep_reward = 0
@@ -154,7 +183,7 @@ class PPOAgent(object):
                 # Sample actions
                 with torch.no_grad():
                     value, action, action_log_prob = self.actor_critic.act(
-                        self.rollouts.observations[step]
+                        self.rollouts.observations[step].float()
                     )
                 
                 obs, reward, done, info = self.env.step(action)
@@ -181,7 +210,7 @@ class PPOAgent(object):
                 
             num_samples += (obs.shape[0]*self.num_steps_per_rollout)
             with torch.no_grad():
-                next_value = self.actor_critic.get_value(self.rollouts.observations[-1]).detach()
+                next_value = self.actor_critic.get_value(self.rollouts.observations[-1].float()).detach()
 
             self.rollouts.compute_returns(next_value, self.use_gae, self.gamma, self.gae_lambda)
 
@@ -189,9 +218,10 @@ class PPOAgent(object):
 
             self.rollouts.after_update()
 
-            save_util.save_weight(copy.deepcopy(self.actor_critic), out_model_file)
+            checkpoint_manager.save_weight(self.actor_critic, out_model_file)
             if update % self.save_interval == 0:
-                save_util.save_weight(copy.deepcopy(self.actor_critic), int_output_dir + '/_ep{}.pth'.format(update))
+                checkpoint_manager.save_weight(self.actor_critic, int_output_dir + '/_ep{}.pth'.format(update), tag="epoch")
+                checkpoint_manager.save(self.get_resume_state(update, num_samples), resume_out_file)
 
             ep_info["reward"] = torch.cat(ep_info["reward"])
             
@@ -207,6 +237,8 @@ class PPOAgent(object):
                 }
             self.logger.log_epoch(stats, step=int(num_samples))
             self.logger.print_log(stats)
+
+        checkpoint_manager.close()
     
 
 
@@ -1,10 +1,52 @@
+import math
 import torch
-from torch.utils.data.sampler import BatchSampler, SubsetRandomSampler
+
+
+def linear_scan(a, b, x_last):
+    """
+    solves x[t] = a[t] * x[t+1] + b[t] backwards from x[T] = x_last, for a, b: [T, ...]
+    the steps are split into ~sqrt(T) blocks: every block is reduced to one affine map in a loop
+    vectorized over blocks, the maps are chained across blocks, then every step is fixed up at once,
+    so about 2 * sqrt(T) small ops replace the T of a plain loop, with the same O(T) work and no division
+    """
+    num_steps = a.size(0)
+    block_size = max(int(math.ceil(math.sqrt(num_steps))), 1)
+    num_blocks = int(math.ceil(num_steps / block_size))
+    pad = num_blocks * block_size - num_steps
+    if pad > 0:
+        # identity steps at the end, x[t] = 1 * x[t+1] + 0
+        a = torch.cat([a, a.new_ones((pad,) + a.shape[1:])])
+        b = torch.cat([b, b.new_zeros((pad,) + b.shape[1:])])
+    a = a.view(num_blocks, block_size, *a.shape[1:])
+    b = b.view(num_blocks, block_size, *b.shape[1:])
+
+    # map from every step to the end of its block, x[t] = block_a[t] * x_end + block_b[t]
+    block_a = torch.empty_like(a)
+    block_b = torch.empty_like(b)
+    block_a[:, -1] = a[:, -1]
+    block_b[:, -1] = b[:, -1]
+    for i in reversed(range(block_size - 1)):
+        block_a[:, i] = a[:, i] * block_a[:, i + 1]
+        block_b[:, i] = b[:, i] + a[:, i] * block_b[:, i + 1]
+
+    # value right after every block, chained backwards from x_last
+    x_end = b.new_empty((num_blocks + 1,) + b.shape[2:])
+    x_end[-1] = x_last
+    for j in reversed(range(num_blocks)):
+        x_end[j] = block_b[j, 0] + block_a[j, 0] * x_end[j + 1]
+
+    x = block_b + block_a * x_end[1:].unsqueeze(1)
+    return x.view(num_blocks * block_size, *x.shape[2:])[:num_steps]
 
 
 class RolloutStorage(object):
-    def __init__(self, num_steps, num_processes, obs_shape, action_dim, state_size):
-        self.observations = torch.zeros(num_steps + 1, num_processes, *obs_shape)
+    # on the cpu the scan wins while the loop is overhead bound, at a few thousand envs it is memory bound and loses
+    CPU_SCAN_MAX_PROCESSES = 1024
+
+    def __init__(self, num_steps, num_processes, obs_shape, action_dim, state_size, storage_dtype=torch.float32, returns_mode='auto'):
+        # observations may be kept in a lower precision, the policy acts on the stored (rounded) observations
+        # and minibatches are cast back to float32. Actions stay float32, old_action_log_probs are of the exact actions
+        self.observations = torch.zeros(num_steps + 1, num_processes, *obs_shape, dtype=storage_dtype)
         self.rewards = torch.zeros(num_steps, num_processes, 1)
         self.value_preds = torch.zeros(num_steps + 1, num_processes, 1)
         self.returns = torch.zeros(num_steps + 1, num_processes, 1)
@@ -14,6 +56,9 @@ class RolloutStorage(object):
         self.bad_masks = torch.ones(num_steps + 1, num_processes, 1)
         self.num_steps = num_steps
         self.step = 0
+        # 'scan', 'loop', or 'auto': the scan on cuda, on the cpu only up to CPU_SCAN_MAX_PROCESSES envs
+        assert returns_mode in ['auto', 'scan', 'loop'], "Unsupported returns_mode: {}".format(returns_mode)
+        self.returns_mode = returns_mode
 
     def to(self, device):
         self.observations = self.observations.to(device)
@@ -45,6 +90,38 @@ class RolloutStorage(object):
         self.bad_masks[0].copy_(self.bad_masks[-1])
 
     def compute_returns(self, next_value, use_gae, gamma, gae_lambda):
+        if self.returns_mode == 'auto':
+            num_processes = self.rewards.shape[1]
+            use_scan = self.rewards.device.type == 'cuda' or num_processes <= self.CPU_SCAN_MAX_PROCESSES
+        else:
+            use_scan = self.returns_mode == 'scan'
+        if use_scan:
+            self.compute_returns_scan(next_value, use_gae, gamma, gae_lambda)
+        else:
+            self.compute_returns_loop(next_value, use_gae, gamma, gae_lambda)
+
+    def compute_returns_scan(self, next_value, use_gae, gamma, gae_lambda):
+        # both branches are the backward recurrence x[t] = a[t] * x[t+1] + b[t], solved with a parallel scan
+        masks = self.masks[1:] * self.bad_masks[1:]
+        if use_gae:
+            self.value_preds[-1] = next_value
+            delta = (
+                self.rewards
+                + gamma * self.value_preds[1:] * self.masks[1:]
+                - self.value_preds[:-1]
+            )
+            gae = linear_scan(gamma * gae_lambda * masks, delta * self.bad_masks[1:], torch.zeros_like(next_value))
+            self.returns[:-1] = gae + self.value_preds[:-1]
+        else:
+            self.returns[-1] = next_value
+            self.returns[:-1] = linear_scan(
+                gamma * masks,
+                self.rewards * self.bad_masks[1:] + (1 - self.bad_masks[1:]) * self.value_preds[:-1],
+                next_value,
+            )
+
+    def compute_returns_loop(self, next_value, use_gae, gamma, gae_lambda):
+        # per step loop, the reference compute_returns_scan has to match
         if use_gae:
             self.value_preds[-1] = next_value
             gae = 0
@@ -73,17 +150,17 @@ class RolloutStorage(object):
         num_steps, num_processes = self.rewards.size()[0:2]
         batch_size = num_processes * num_steps
         mini_batch_size = batch_size // num_mini_batch
-        sampler = BatchSampler(
-            SubsetRandomSampler(range(batch_size)), mini_batch_size, drop_last=False
-        )
-        for indices in sampler:
-            observations_batch = self.observations[:-1].view(
-                -1, *self.observations.size()[2:]
-            )[indices]
-            actions_batch = self.actions.view(-1, self.actions.size(-1))[indices]
-            return_batch = self.returns[:-1].view(-1, 1)[indices]
-            masks_batch = self.masks[:-1].view(-1, 1)[indices]
-            old_action_log_probs_batch = self.action_log_probs.view(-1, 1)[indices]
-            adv_targ = advantages.view(-1, 1)[indices]
-
-            yield observations_batch, actions_batch, return_batch, masks_batch, old_action_log_probs_batch, adv_targ
+
+        # one permutation per epoch drawn on the storage device, every buffer is gathered once
+        # and the minibatches are contiguous slices of the permuted copies
+        perm = torch.randperm(batch_size, device=self.rewards.device)
+        observations = self.observations[:-1].reshape(-1, *self.observations.size()[2:])[perm]
+        actions = self.actions.reshape(-1, self.actions.size(-1))[perm]
+        returns = self.returns[:-1].reshape(-1, 1)[perm]
+        masks = self.masks[:-1].reshape(-1, 1)[perm]
+        old_action_log_probs = self.action_log_probs.reshape(-1, 1)[perm]
+        advantages = advantages.reshape(-1, 1)[perm]
+
+        for start in range(0, batch_size, mini_batch_size):
+            end = start + mini_batch_size
+            yield observations[start:end].float(), actions[start:end], returns[start:end], masks[start:end], old_action_log_probs[start:end], advantages[start:end]
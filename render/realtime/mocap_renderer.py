@@ -16,6 +16,10 @@ from policy.common.bullet_utils import BulletClient, Camera, SinglePlayerStadium
 FOOT2METER = 1.3
 DEG2RAD = np.pi / 180
 FADED_ALPHA = 1.0
+# link capsules are pooled in buckets of this length when the skeleton rest lengths are not known
+CAPSULE_BUCKET = 0.05
+# spare capsules wait out of sight
+HIDDEN_POS = (0, 0, -100)
 
 def extract_joints_xyz(xyzs):
     x = xyzs[...,0]
@@ -32,6 +36,7 @@ class PBLMocapViewer:
         use_params=True,
         target_fps = 0,
         camera_tracking=True,
+        lod_num_characters=16,
     ):
         self.device = env.device
         target_fps = env.dataset.fps
@@ -40,7 +45,12 @@ class PBLMocapViewer:
 
         self.env = env
         self.num_characters = num_characters
-        self.use_params = use_params
+        self.headless = getattr(env, 'headless', False)
+        # debug sliders need the GUI
+        self.use_params = use_params and not self.headless
+        # above this many characters only the joints are drawn
+        self.draw_links = num_characters <= lod_num_characters
+        self.link_lengths = self.get_link_lengths(env.dataset, sk_dict)
 
         
         self.character_index = 0
@@ -54,7 +64,7 @@ class PBLMocapViewer:
         self.camera_distance = 6 if self.camera_tracking else 12
         self.camera_smooth = np.array([1, 1, 1])
 
-        connection_mode = pb.GUI if env.is_rendered else pb.DIRECT
+        connection_mode = pb.GUI if env.is_rendered and not self.headless else pb.DIRECT
         self._p = BulletClient(connection_mode=connection_mode)
         self._p.configureDebugVisualizer(pb.COV_ENABLE_GUI, 0)
         self._p.configureDebugVisualizer(pb.COV_ENABLE_KEYBOARD_SHORTCUTS, 0)
@@ -67,7 +77,7 @@ class PBLMocapViewer:
         self._p.configureDebugVisualizer(pb.COV_ENABLE_RENDERING, 0)
 
         self.camera = Camera(
-            self._p, fps=target_fps, dist=self.camera_distance, pitch=-10, yaw=45
+            self._p, fps=target_fps, dist=self.camera_distance, pitch=-10, yaw=45, headless=self.headless
         )
         scene = SinglePlayerStadiumScene(
             self._p, gravity=9.8, timestep=1 / target_fps, frame_skip=1
@@ -82,7 +92,7 @@ class PBLMocapViewer:
 
         # here order is important for some reason ?
         # self.targets = MultiTargets(self._p, num_characters, self.colours)
-        self.characters = MultiMocapCharacters(self._p, num_characters,  sk_dict, self.colours)
+        self.characters = MultiMocapCharacters(self._p, num_characters,  sk_dict, self.colours, self.draw_links, self.link_lengths)
         
         # Re-enable rendering
         self._p.configureDebugVisualizer(pb.COV_ENABLE_RENDERING, 1)
@@ -92,6 +102,16 @@ class PBLMocapViewer:
         if self.use_params:
             self._setup_debug_parameters()
 
+    @staticmethod
+    def get_link_lengths(dataset, sk_dict):
+        # rendered length of every link from the rest offsets, None when the skeleton changes from clip to clip
+        if dataset.use_offset or len(np.asarray(dataset.joint_offset)) == 0:
+            return None
+        joint_offset = np.asarray(dataset.joint_offset).reshape(-1, sk_dict['num_joint'], 3)[0]
+        # links are stored as (child, parent) or (parent, child), the child is always the larger index
+        child = np.max(np.array(sk_dict['links']), axis=1)
+        return np.linalg.norm(joint_offset[child], axis=-1) * FOOT2METER
+
     def reset(self):
         # self._p.restoreState(self.state_id)
         self.env.reset()
@@ -160,7 +180,7 @@ class PBLMocapViewer:
                 characters.heads[index].set_color(faded_colour)
                 characters.links[index] = []
 
-        self.characters = MultiMocapCharacters(bc, num_characters, self.env.sk_dict, colours)
+        self.characters = MultiMocapCharacters(bc, num_characters, self.env.sk_dict, colours, self.draw_links, self.link_lengths)
     
         if hasattr(self, "targets") and self.targets.marker == Arrow:
             self.targets = MultiTargets(
@@ -170,26 +190,26 @@ class PBLMocapViewer:
         bc.configureDebugVisualizer(pb.COV_ENABLE_RENDERING, 1)
 
     def render(self, xyzs, facings, root_xzs, time_remain, action):
+        # xyzs: [num_characters, num_jnt, 3] joint positions in the heading frame, on the env device
         x, z, y = extract_joints_xyz(xyzs)
-        num_jnt = x.shape[-1]
         
-        mat = self.env.get_rotation_matrix(facings).to(self.device)
+        mat = self.env.get_rotation_matrix(facings).to(xyzs.device).type(xyzs.dtype)
 
-        rotated_xy = torch.matmul(mat[...,None,:,:].expand(-1,num_jnt,-1,-1), torch.stack((x, y), dim=-1)[...,None])[...,0]
-        #rotated_xy *= 0
+        rotated_xy = torch.matmul(mat[...,None,:,:], torch.stack((x, y), dim=-1)[...,None])[...,0]
         
-        poses = torch.cat((rotated_xy, z[...,None]), dim=-1).permute(0, 2, 1)
-        root_xyzs = F.pad(root_xzs, pad=[0, 1])
-        #root_xyzs *= 0
-        joint_xyzs = ((poses + root_xyzs.unsqueeze(dim=-1)) * FOOT2METER).cpu().numpy()
-        self.root_xyzs = (
-            (F.pad(root_xzs, pad=[0, 1], value=3) * FOOT2METER).cpu().numpy()
-        )
+        poses = torch.cat((rotated_xy, z[...,None]), dim=-1)
+        root_xyzs = F.pad(root_xzs, pad=[0, 1]).type(xyzs.dtype)
+        camera_xyzs = F.pad(root_xzs, pad=[0, 1], value=3).type(xyzs.dtype)
+        
+        # joints and camera targets of every character leave the device in one copy
+        xyzs_host = self.copy_to_host(torch.cat((poses + root_xyzs[:,None], camera_xyzs[:,None]), dim=1) * FOOT2METER)
+        joint_xyzs = xyzs_host[:, :-1]
+        self.root_xyzs = xyzs_host[:, -1].copy()
         self.joint_xyzs = joint_xyzs
 
-        for index in range(self.num_characters):
-            self.characters.set_joint_positions(joint_xyzs[index], index)
+        self.characters.set_all_joint_positions(joint_xyzs)
 
+        for index in range(self.num_characters):
             if self.debug and index == self.character_index:
                 target_dist = (
                     -float(self.env.linear_potential[index])
@@ -221,6 +241,15 @@ class PBLMocapViewer:
         else:
             self.camera.wait()
 
+    def copy_to_host(self, xyzs):
+        # reuses a pinned host buffer so the device to host copy does not go through pageable memory
+        if not xyzs.is_cuda:
+            return xyzs.detach().numpy()
+        if getattr(self, '_host_buffer', None) is None or self._host_buffer.shape != xyzs.shape or self._host_buffer.dtype != xyzs.dtype:
+            self._host_buffer = torch.empty(xyzs.shape, dtype=xyzs.dtype, pin_memory=True)
+        self._host_buffer.copy_(xyzs.detach())
+        return self._host_buffer.numpy()
+
     def close(self):
         self._p.disconnect()
         sys.exit(0)
@@ -421,27 +450,32 @@ class PBLMocapViewer:
 
 
 class MultiMocapCharacters:
-    def __init__(self, bc, num_characters, sk_dict, colours=None, links=True):
+    def __init__(self, bc, num_characters, sk_dict, colours=None, links=True, link_lengths=None):
         self._p = bc
         self.has_links = links
+        self.num_characters = num_characters
 
         #self.dir_link  = 
         #            VCapsule(self._p, radius=0.06, height=0.1, rgba=colours[i])
         #            for i in range(num_characters)
         
-        if links:
-            self.linked_joints = np.array(sk_dict['links'])
-            
-            self.head_idx =  sk_dict['head_idx']
-            self.num_joint =   sk_dict['num_joint']
+        self.linked_joints = np.array(sk_dict['links'])
+        self.head_idx =  sk_dict['head_idx']
+        self.num_joint =   sk_dict['num_joint']
 
-            total_parts = num_characters * self.num_joint
-            joints = VSphere(bc, radius=0.07, max=True, replica=total_parts)
-            self.ids = joints.ids
+        total_parts = num_characters * self.num_joint
+        joints = VSphere(bc, radius=0.07, max=True, replica=total_parts)
+        self.ids = joints.ids
+
+        if links:
+            # with the rest lengths of the skeleton every capsule is built once with its final height,
+            # otherwise capsules follow the rendered lengths and are recycled through a pool of height buckets
+            self.link_lengths = link_lengths
+            self.capsule_pool = dict()
             self.links = {
                 i: [
-                    VCapsule(self._p, radius=0.03, height=0.1, rgba=colours[i])
-                    for _ in range(self.linked_joints.shape[0])
+                    VCapsule(self._p, radius=0.06, height=link_lengths[lid] if link_lengths is not None else 0.1, rgba=colours[i])
+                    for lid in range(self.linked_joints.shape[0])
                 ]
                 for i in range(num_characters)
             }
@@ -466,42 +500,64 @@ class MultiMocapCharacters:
         for id in joint_ids:
             self._p.changeVisualShape(id, -1, rgbaColor=colour)
 
+    def get_link_transforms(self, xyzs):
+        # xyzs: [..., num_joint, 3], returns capsule centers, orientations and lengths of every link
+        deltas = xyzs[..., self.linked_joints[:, 1], :] - xyzs[..., self.linked_joints[:, 0], :]
+        heights = np.linalg.norm(deltas, axis=-1)
+        positions = 0.5 * (xyzs[..., self.linked_joints[:, 0], :] + xyzs[..., self.linked_joints[:, 1], :])
+
+        a = np.cross(deltas, self.z_axes)
+        b = heights + (deltas * self.z_axes).sum(-1)
+        orientations = np.concatenate((a, b[..., None]), axis=-1)
+        orientations[..., [0, 1]] *= -1
+        return positions, orientations, heights
+
+    def get_capsule(self, index, height):
+        # a spare capsule of this character and height bucket, built only when the pool has none
+        bucket = int(round(height / CAPSULE_BUCKET))
+        pool = self.capsule_pool.setdefault((index, bucket), [])
+        if len(pool) > 0:
+            return pool.pop()
+        rgba = self.colours[index].copy()
+        rgba[-1] = FADED_ALPHA
+        return VCapsule(self._p, radius=0.06, height=max(bucket, 1) * CAPSULE_BUCKET, rgba=rgba)
+
+    def release_capsule(self, index, link):
+        link.set_position(HIDDEN_POS, (0, 0, 0, 1))
+        bucket = int(round(link.height / CAPSULE_BUCKET))
+        self.capsule_pool.setdefault((index, bucket), []).append(link)
+
+    def update_links(self, index, positions, orientations, heights):
+        for lid, (height, pos, orn) in enumerate(zip(heights, positions, orientations)):
+            link = self.links[index][lid]
+            # 0.05 feet is about 1.5 cm
+            if self.link_lengths is None and abs(link.height - height) > CAPSULE_BUCKET:
+                self.release_capsule(index, link)
+                link = self.get_capsule(index, height)
+                self.links[index][lid] = link
+
+            link.set_position(pos, orn)
+
     def set_joint_positions(self, xyzs, index):
-        
+        # xyzs: [num_joint, 3]
+        self.set_all_joint_positions(xyzs[None], [index])
+
+    def set_all_joint_positions(self, xyzs, indices=None):
+        # xyzs: [num_characters, num_joint, 3], rendering is paused once for the whole update
+        indices = range(self.num_characters) if indices is None else indices
         self._p.configureDebugVisualizer(pb.COV_ENABLE_RENDERING, 0)
 
-        start = index * self.num_joint
-        joint_ids = self.ids[start : start + self.num_joint]
-        
-        xyzs = xyzs.transpose()
-        for i, id in enumerate(joint_ids):
-            self._p.resetBasePositionAndOrientation(id, posObj=xyzs[i], ornObj=(0, 0, 0, 1))
+        for xyz, index in zip(xyzs, indices):
+            start = index * self.num_joint
+            for id, pos in zip(self.ids[start : start + self.num_joint], xyz):
+                self._p.resetBasePositionAndOrientation(id, posObj=pos, ornObj=(0, 0, 0, 1))
 
-        
         if self.has_links:
-            rgba = self.colours[index].copy()
-            rgba[-1] = FADED_ALPHA
-            deltas = xyzs[self.linked_joints[:, 1]] - xyzs[self.linked_joints[:, 0]]
-            heights = np.linalg.norm(deltas, axis=-1)
-            positions = xyzs[self.linked_joints].mean(axis=1)
-
-            a = np.cross(deltas, self.z_axes)
-            b = np.linalg.norm(deltas, axis=-1) + (deltas * self.z_axes).sum(-1)
-            orientations = np.concatenate((a, b[:, None]), axis=-1)
-            orientations[:, [0, 1]] *= -1
-
-            for lid, (delta, height, pos, orn, link) in enumerate(
-                zip(deltas, heights, positions, orientations, self.links[index])
-            ):
-                # 0.05 feet is about 1.5 cm
-                if abs(link.height - height) > 0.05:
-                    self._p.removeBody(link.id[0])
-                    link = VCapsule(self._p, radius=0.06, height=height, rgba=rgba)
-                    self.links[index][lid] = link
-
-                link.set_position(pos, orn)
-
-            self.heads[index].set_position(0.5 * (xyzs[self.head_idx[1]] - xyzs[self.head_idx[0]]) + xyzs[self.head_idx[1]])
+            positions, orientations, heights = self.get_link_transforms(xyzs)
+            heads = 0.5 * (xyzs[:, self.head_idx[1]] - xyzs[:, self.head_idx[0]]) + xyzs[:, self.head_idx[1]]
+            for i, index in enumerate(indices):
+                self.update_links(index, positions[i], orientations[i], heights[i])
+                self.heads[index].set_position(heads[i])
             #self.dir_link.set_position 
         self._p.configureDebugVisualizer(pb.COV_ENABLE_RENDERING, 1)
 
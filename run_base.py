@@ -45,13 +45,13 @@ def build_model(config, dataset, device):
     model = model_builder.build_model(config, dataset, device)
     return model
 
-def build_trainer(config, device):
-    trainer = trainer_builder.build_trainer(config,device)
+def build_trainer(config, device, seed=0):
+    trainer = trainer_builder.build_trainer(config, device, seed)
     return trainer
 
-def train(trainer, model, out_model_file, int_output_dir, log_file):
+def train(trainer, model, out_model_file, int_output_dir, log_file, resume_file=""):
     trainer.train_model(model, out_model_file=out_model_file, 
-                      int_output_dir=int_output_dir, log_file=log_file)
+                      int_output_dir=int_output_dir, log_file=log_file, resume_file=resume_file)
     return
 
 def build_dataset(config, load_full_dataset):
@@ -83,18 +83,32 @@ def run(rank, num_procs, args):
     log_file = args.parse_string("log_file", "")
     out_model_file = args.parse_string("out_model_file", "")
     trained_model_path = args.parse_string("model_path", "")
+    resume_path = args.parse_string("resume_path", "")
     
     int_output_dir = args.parse_string("int_output_dir", "")
     master_port = args.parse_string("master_port", "")
     model_config_file = args.parse_string("model_config", "")
 
+    if (num_procs > 1 and "cuda" in device):
+        # one gpu per process
+        device = "cuda:{}".format(rank)
+        torch.cuda.set_device(device)
     mp_util.init(rank, num_procs, device, master_port)
+    if (num_procs > 1 and args.has_key("rand_seed")):
+        # different noise and teacher forcing draws on every rank, the weights are synced from the root
+        rand_util.set_rand_seed(int(args.parse_string("rand_seed")) + rank)
 
     set_np_formatting()
     create_output_dirs(out_model_file, int_output_dir)
     out_model_dir = os.path.dirname(out_model_file)
     
-    trainer = build_trainer(model_config_file, device)
+    # the root builds the dataset caches first, the other ranks then load them
+    if (not mp_util.is_root_proc()):
+        mp_util.barrier()
+    # the seed of the batch order, the same on every rank
+    trainer = build_trainer(model_config_file, device, int(args.parse_string("rand_seed", "0")))
+    if (mp_util.is_root_proc() and mp_util.enable_mp()):
+        mp_util.barrier()
     model = build_model(model_config_file, trainer.dataset, device)
     dataset = build_dataset(model_config_file, load_full_dataset = True)
     if (trained_model_path != ""):
@@ -109,9 +123,10 @@ def run(rank, num_procs, args):
         model.eval()
         
     if (mode == "train"):
-        copy_config_file(model_config_file, out_model_dir)
+        if (mp_util.is_root_proc()):
+            copy_config_file(model_config_file, out_model_dir)
         train(trainer, model, out_model_file=out_model_file, 
-              int_output_dir=int_output_dir, log_file=log_file)
+              int_output_dir=int_output_dir, log_file=log_file, resume_file=resume_path)
             
     elif (mode == "eval"):
         stats = evaluate(trainer, model, device=device)
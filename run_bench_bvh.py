@@ -0,0 +1,78 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+import sys
+import glob
+import time
+import json
+import os.path as osp
+import numpy as np
+
+import dataset.util.bvh as bvh_util
+import util.arg_parser as arg_parser
+
+def load_args(argv):
+    args = arg_parser.ArgParser()
+    args.load_args(argv[1:])
+
+    arg_file = args.parse_string("arg_file", "")
+    if (arg_file != ""):
+        succ = args.load_file(arg_file)
+        assert succ, print("Failed to load args from: " + arg_file)
+    return args
+
+def check_parity(fname):
+    # the vectorized parser has to give the same Motion as the per frame, per joint reference loop
+    fast = bvh_util.import_bvh(fname, vectorized=True)
+    ref = bvh_util.import_bvh(fname, vectorized=False)
+    assert fast._fps == ref._fps, "fps mismatch in {}".format(fname)
+    assert [j._name for j in fast._skeleton._joint_lst] == [j._name for j in ref._skeleton._joint_lst], "skeleton mismatch in {}".format(fname)
+    return max(np.abs(fast._rotations - ref._rotations).max(), np.abs(fast._positions - ref._positions).max())
+
+def bench_parser(file_lst, vectorized):
+    start = time.time()
+    num_frames = 0
+    for fname in file_lst:
+        motion = bvh_util.import_bvh(fname, vectorized=vectorized)
+        num_frames += motion._rotations.shape[0]
+    elapsed = time.time() - start
+    return {
+        "num_files": len(file_lst),
+        "files_per_sec": len(file_lst) / elapsed,
+        "frames_per_sec": num_frames / elapsed,
+    }
+
+def run(args):
+    data_dirs = args.parse_strings("data_dir", ["./data/LAFAN1", "./data/100STYLE"])
+    num_files = args.parse_int("num_files", 20)
+    out_file = args.parse_string("out_file", "")
+    parity_tol = args.parse_float("parity_tol", 1e-9)
+
+    results = dict()
+    for data_dir in data_dirs:
+        file_lst = sorted(glob.glob(osp.join(data_dir, '**/*.bvh'), recursive=True))[:num_files]
+        if len(file_lst) == 0:
+            print('no bvh file in {}'.format(data_dir))
+            continue
+
+        max_err = max([check_parity(fname) for fname in file_lst])
+        assert max_err <= parity_tol, "vectorized parser differs from the reference loop by {} in {}".format(max_err, data_dir)
+        loop = bench_parser(file_lst, vectorized=False)
+        fast = bench_parser(file_lst, vectorized=True)
+        fast['speedup'] = fast['files_per_sec'] / loop['files_per_sec']
+        fast['max_abs_err'] = max_err
+
+        name = osp.basename(osp.normpath(data_dir))
+        results['{}_loop'.format(name)] = loop
+        results['{}_vectorized'.format(name)] = fast
+
+    for key, val in results.items():
+        print('{}: {}'.format(key, ' '.join(['{}:{:.4f}'.format(k, v) for k, v in val.items()])))
+
+    if out_file != "":
+        with open(out_file, 'w') as f:
+            json.dump(results, f, indent=4)
+    return results
+
+if __name__ == "__main__":
+    run(load_args(sys.argv))
@@ -0,0 +1,81 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+import sys
+import time
+import json
+import torch
+
+import policy.learning.storage as storage
+import util.arg_parser as arg_parser
+import util.rand_util as rand_util
+
+def load_args(argv):
+    args = arg_parser.ArgParser()
+    args.load_args(argv[1:])
+
+    arg_file = args.parse_string("arg_file", "")
+    if (arg_file != ""):
+        succ = args.load_file(arg_file)
+        assert succ, print("Failed to load args from: " + arg_file)
+
+    rand_util.set_rand_seed(args.parse_int("rand_seed", 0))
+    return args
+
+def sync(device):
+    if "cuda" in str(device):
+        torch.cuda.synchronize()
+
+def build_rollouts(num_steps, num_parallel, device):
+    # random rewards and values, with episode ends and timeouts sprinkled in
+    rollouts = storage.RolloutStorage(num_steps, num_parallel, (1,), 1, 0)
+    rollouts.to(device)
+    rollouts.rewards.normal_()
+    rollouts.value_preds.normal_()
+    rollouts.masks.bernoulli_(0.99)
+    rollouts.bad_masks.bernoulli_(0.995)
+    return rollouts
+
+def bench_returns(rollouts, next_value, use_gae, gamma, gae_lambda, num_trials, loop, device):
+    compute_returns = rollouts.compute_returns_loop if loop else rollouts.compute_returns_scan
+    compute_returns(next_value, use_gae, gamma, gae_lambda)
+    sync(device)
+    start = time.time()
+    for _ in range(num_trials):
+        compute_returns(next_value, use_gae, gamma, gae_lambda)
+    sync(device)
+    return (time.time() - start) / num_trials * 1000, rollouts.returns.clone()
+
+def run(args):
+    num_steps = args.parse_int("num_steps", 1000)
+    num_parallel = args.parse_int("num_parallel", 4096)
+    num_trials = args.parse_int("num_trials", 5)
+    gamma = args.parse_float("gamma", 0.99)
+    gae_lambda = args.parse_float("gae_lambda", 0.95)
+    device = args.parse_string("device", "cuda" if torch.cuda.is_available() else "cpu")
+    out_file = args.parse_string("out_file", "")
+
+    rollouts = build_rollouts(num_steps, num_parallel, device)
+    next_value = torch.randn(num_parallel, 1, device=device)
+
+    results = dict()
+    for use_gae in [True, False]:
+        loop_ms, loop_returns = bench_returns(rollouts, next_value, use_gae, gamma, gae_lambda, num_trials, True, device)
+        scan_ms, scan_returns = bench_returns(rollouts, next_value, use_gae, gamma, gae_lambda, num_trials, False, device)
+        results['gae' if use_gae else 'discounted'] = {
+            "loop_ms": loop_ms,
+            "scan_ms": scan_ms,
+            "speedup": loop_ms / scan_ms,
+            "max_abs_err": (loop_returns - scan_returns).abs().max().item(),
+        }
+
+    for key, val in results.items():
+        print('{}: {}'.format(key, ' '.join(['{}:{:.6f}'.format(k, v) for k, v in val.items()])))
+
+    if out_file != "":
+        with open(out_file, 'w') as f:
+            json.dump(results, f, indent=4)
+    return results
+
+if __name__ == "__main__":
+    run(load_args(sys.argv))
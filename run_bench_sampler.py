@@ -0,0 +1,234 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+import sys
+import time
+import json
+import torch
+import numpy as np
+
+import dataset.dataset_builder as dataset_builder
+import model.model_builder as model_builder
+
+import util.arg_parser as arg_parser
+import util.rand_util as rand_util
+
+def load_args(argv):
+    args = arg_parser.ArgParser()
+    args.load_args(argv[1:])
+
+    arg_file = args.parse_string("arg_file", "")
+    if (arg_file != ""):
+        succ = args.load_file(arg_file)
+        assert succ, print("Failed to load args from: " + arg_file)
+
+    rand_util.set_rand_seed(args.parse_int("rand_seed", 0))
+    return args
+
+def sync(device):
+    if "cuda" in str(device):
+        torch.cuda.synchronize()
+
+def set_sampler(model, sample_mode, eval_T):
+    model.sample_mode = sample_mode
+    model.eval_T = eval_T if sample_mode == 'ddim' else model.T
+
+def bench_sampler(model, dataset, num_steps, num_trials, device):
+    # one step error: condition on every ground-truth frame of the cached test clips, predict the next one
+    ref_clips = torch.tensor(dataset.test_ref_clips, device=device, dtype=torch.float32)
+    cur_x = ref_clips[:, :-1].reshape(-1, ref_clips.shape[-1])
+    next_x = ref_clips[:, 1:].reshape(-1, ref_clips.shape[-1])
+    pred_x = model.eval_step(cur_x)
+    one_step_err = (pred_x - next_x).abs().mean().item()
+
+    # rollout from every test clip start frame, in one batch
+    start_x = ref_clips[:, 0].repeat_interleave(num_trials, dim=0)
+    model.eval_step(start_x)
+    sync(device)
+    start = time.time()
+    rollout = model.eval_seq(start_x, None, num_steps, start_x.shape[0])
+    sync(device)
+    elapsed = time.time() - start
+
+    nan_ratio = torch.isnan(rollout).any(dim=-1).float().mean().item()
+    return {
+        "one_step_l1": one_step_err,
+        "rollout_nan_ratio": nan_ratio,
+        "rollout_abs_mean": rollout.nan_to_num().abs().mean().item(),
+        "batch_size": start_x.shape[0],
+        "ms_per_frame": elapsed / num_steps * 1000,
+        "frames_per_sec": start_x.shape[0] * num_steps / elapsed,
+    }
+
+def bench_rollout(model, dataset, batch_sizes, num_steps, device):
+    # frames/sec of the autoregressive rollout, eager loop vs captured graph
+    results = dict()
+    for batch_size in batch_sizes:
+        start_x = torch.zeros((batch_size, dataset.frame_dim), device=device, dtype=torch.float32)
+        for compile_rollout in [False, True]:
+            model.compile_rollout = compile_rollout
+            model.eval_seq(start_x, None, 2, batch_size) #warm up, builds the graph
+            sync(device)
+            start = time.time()
+            model.eval_seq(start_x, None, num_steps, batch_size)
+            sync(device)
+            elapsed = time.time() - start
+            results['{}_B{}'.format('compiled' if compile_rollout else 'eager', batch_size)] = {
+                "batch_size": batch_size,
+                "ms_per_frame": elapsed / num_steps * 1000,
+                "frames_per_sec": batch_size * num_steps / elapsed,
+            }
+    return results
+
+def run_rollout(args, model, dataset, device):
+    batch_sizes = args.parse_ints("batch_sizes", [1, 16, 256])
+    num_steps = args.parse_int("num_steps", 300)
+    with torch.no_grad():
+        results = bench_rollout(model, dataset, batch_sizes, num_steps, device)
+
+    for batch_size in batch_sizes:
+        results['compiled_B{}'.format(batch_size)]['speedup'] = \
+            results['eager_B{}'.format(batch_size)]['ms_per_frame'] / results['compiled_B{}'.format(batch_size)]['ms_per_frame']
+    for key, val in results.items():
+        print('{}: {}'.format(key, ' '.join(['{}:{:.4f}'.format(k, v) for k, v in val.items()])))
+    return results
+
+def bench_noise(model, batch_sizes, num_steps, device):
+    # rollout noise: the batched block draw against the reference per trajectory loop, same values and time per frame
+    diffusion = model.ema_diffusion if model.use_ema else model.diffusion
+    num_noises = diffusion.get_num_noises(model.sample_mode, model.eval_T, model.ddim_eta)
+    results = dict()
+    for batch_size in batch_sizes:
+        noise = model.get_rollout_noise(batch_size, 0)
+        block_size = noise.get_block_size(num_noises)
+        ref = noise.draw_block_loop(num_noises, block_size)
+        sync(device)
+        start = time.time()
+        for _ in range(num_steps):
+            noise.draw_block_loop(num_noises, block_size)
+        sync(device)
+        loop_time = (time.time() - start) / (num_steps * block_size)
+
+        noise = model.get_rollout_noise(batch_size, 0)
+        block = torch.stack([noise.next(num_noises) for _ in range(block_size)], dim=0).permute(2, 0, 1, 3)
+        sync(device)
+        start = time.time()
+        for _ in range(num_steps * block_size):
+            noise.next(num_noises)
+        sync(device)
+        block_time = (time.time() - start) / (num_steps * block_size)
+        results['B{}'.format(batch_size)] = {
+            "block_size": block_size,
+            "max_diff": (block - ref).abs().max().item(),
+            "loop_ms_per_frame": loop_time * 1000,
+            "block_ms_per_frame": block_time * 1000,
+            "speedup": loop_time / block_time,
+        }
+    return results
+
+def run_noise(args, model, dataset, device):
+    batch_sizes = args.parse_ints("batch_sizes", [1, 256, 4096])
+    num_steps = args.parse_int("num_steps", 4)
+    results = bench_noise(model, batch_sizes, num_steps, device)
+    for key, val in results.items():
+        print('{}: {}'.format(key, ' '.join(['{}:{:.4f}'.format(k, v) for k, v in val.items()])))
+    return results
+
+def bench_precision(model, dataset, inference_dtype, num_steps, batch_size, seed, device):
+    # the same rollout in fp32 and in reduced precision, from the test clip start frames and with the same noise,
+    # so drift, NaNs or an exploding pose come from the precision alone
+    ref_clips = torch.tensor(dataset.test_ref_clips, device=device, dtype=torch.float32)
+    start_x = ref_clips[torch.arange(batch_size) % ref_clips.shape[0], 0]
+
+    results = dict()
+    rollouts = dict()
+    for dtype in [None, inference_dtype]:
+        model.inference_dtype = dtype
+        model.eval_seq(start_x, None, 2, batch_size, seed=seed) #warm up
+        sync(device)
+        start = time.time()
+        rollout = model.eval_seq(start_x, None, num_steps, batch_size, seed=seed)
+        sync(device)
+        elapsed = time.time() - start
+
+        name = 'float32' if dtype is None else str(dtype).split('.')[-1]
+        rollouts[name] = rollout
+        results[name] = {
+            "nan_ratio": torch.isnan(rollout).any(dim=-1).float().mean().item(),
+            "max_abs": rollout.nan_to_num().abs().max().item(),
+            "ms_per_frame": elapsed / num_steps * 1000,
+            "frames_per_sec": batch_size * num_steps / elapsed,
+        }
+
+    ref_name, name = list(rollouts.keys())
+    diff = (rollouts[name] - rollouts[ref_name]).abs().nanmean(dim=(0, 2))
+    for frac in [0.1, 0.5, 1.0]:
+        frame = max(int(num_steps * frac) - 1, 0)
+        results[name]['drift_l1_f{}'.format(frame + 1)] = diff[frame].item()
+    results[name]['speedup'] = results[ref_name]['ms_per_frame'] / results[name]['ms_per_frame']
+    return results
+
+def run_precision(args, model, dataset, device):
+    inference_dtype = getattr(torch, args.parse_string("inference_dtype", "bfloat16"))
+    num_steps = args.parse_int("num_steps", 1000)
+    batch_size = args.parse_int("batch_size", 64)
+    seed = args.parse_int("rand_seed", 0)
+    explode_ratio = args.parse_float("explode_ratio", 2.0)
+    with torch.no_grad():
+        results = bench_precision(model, dataset, inference_dtype, num_steps, batch_size, seed, device)
+
+    ref, reduced = results.values()
+    # the reduced precision rollout fails if it produces NaNs the fp32 one does not, or leaves its range
+    reduced['passed'] = float(reduced['nan_ratio'] <= ref['nan_ratio'] and reduced['max_abs'] <= explode_ratio * ref['max_abs'])
+    for key, val in results.items():
+        print('{}: {}'.format(key, ' '.join(['{}:{:.4f}'.format(k, v) for k, v in val.items()])))
+    return results
+
+def run(args):
+    device = args.parse_string("device", "cuda:0")
+    model_config_file = args.parse_string("model_config", "")
+    trained_model_path = args.parse_string("model_path", "")
+    out_file = args.parse_string("out_file", "")
+    eval_T_lst = args.parse_ints("eval_T", [5, 10])
+    eta = args.parse_float("ddim_eta", 0.0)
+    num_steps = args.parse_int("num_steps", 300)
+    num_trials = args.parse_int("num_trials", 4)
+    bench = args.parse_string("bench", "sampler")
+
+    dataset = dataset_builder.build_dataset(model_config_file, load_full_dataset=(bench not in ["rollout", "noise"]))
+    model = model_builder.build_model(model_config_file, dataset, device)
+    if trained_model_path != "":
+        model.load_state_dict(torch.load(trained_model_path))
+    model.to(device)
+    model.eval()
+    model.ddim_eta = eta
+
+    if bench in ["rollout", "precision", "noise"]:
+        run_fn = {"rollout": run_rollout, "precision": run_precision, "noise": run_noise}[bench]
+        results = run_fn(args, model, dataset, device)
+        if out_file != "":
+            with open(out_file, 'w') as f:
+                json.dump(results, f, indent=4)
+        return results
+
+    results = dict()
+    with torch.no_grad():
+        set_sampler(model, 'ddpm', model.T)
+        results['ddpm_T{}'.format(model.T)] = bench_sampler(model, dataset, num_steps, num_trials, device)
+
+        for eval_T in eval_T_lst:
+            set_sampler(model, 'ddim', eval_T)
+            results['ddim_T{}'.format(eval_T)] = bench_sampler(model, dataset, num_steps, num_trials, device)
+
+    base_ms = results['ddpm_T{}'.format(model.T)]['ms_per_frame']
+    for key, val in results.items():
+        val['speedup'] = base_ms / val['ms_per_frame']
+        print('{}: {}'.format(key, ' '.join(['{}:{:.4f}'.format(k, v) for k, v in val.items()])))
+
+    if out_file != "":
+        with open(out_file, 'w') as f:
+            json.dump(results, f, indent=4)
+    return results
+
+if __name__ == "__main__":
+    run(load_args(sys.argv))
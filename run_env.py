@@ -3,7 +3,11 @@ warnings.filterwarnings("ignore")
 
 import os
 import sys
+import time
+import json
 import shutil
+import resource
+import traceback
 import torch
 import numpy as np
 
@@ -57,13 +61,13 @@ def build_agent(config, model, env, device):
     agent = agent_builder.build_agent(config, model, env, device)
     return agent
 
-def build_env(config, int_output_dir, model, dataset, mode, device):
-    env = env_builder.build_envs(config, int_output_dir, model, dataset, mode, device)
+def build_env(config, int_output_dir, model, dataset, mode, device, overrides=None):
+    env = env_builder.build_envs(config, int_output_dir, model, dataset, mode, device, overrides)
     return env
 
-def train(agent, out_model_file, int_output_dir):
+def train(agent, out_model_file, int_output_dir, resume_file=""):
     agent.train_controller(out_model_file=out_model_file, 
-                      int_output_dir=int_output_dir)
+                      int_output_dir=int_output_dir, resume_file=resume_file)
     return
 
 
@@ -98,6 +102,123 @@ def test_no_agent(env):
     return      
 
 
+class StageTimer():
+    """Accumulates the wall time spent in methods of one env instance.
+
+    The methods are wrapped on the instance only, the env classes are left untouched. On cuda the
+    device is synchronized around every call so the time lands in the stage that launched the work.
+    """
+    def __init__(self, env, stages, device):
+        self.env = env
+        self.sync = torch.device(device).type == 'cuda'
+        self.times = {name: 0.0 for name in stages}
+        self.counts = {name: 0 for name in stages}
+        for name, method_name in stages.items():
+            setattr(env, method_name, self._wrap(name, getattr(env, method_name)))
+
+    def _wrap(self, name, fn):
+        def timed(*args, **kwargs):
+            if self.sync:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            out = fn(*args, **kwargs)
+            if self.sync:
+                torch.cuda.synchronize()
+            self.times[name] += time.perf_counter() - start
+            self.counts[name] += 1
+            return out
+        return timed
+
+    def clear(self):
+        for name in self.times:
+            self.times[name] = 0.0
+            self.counts[name] = 0
+
+
+def get_peak_mem_mb(device):
+    # peak device memory since the last reset on cuda, the process peak rss (never decreases) on cpu
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def bench_env(env, num_steps, num_warmup, action_mode, device):
+    """
+    steps env headless with random (normal) or fixed (zero) actions, done characters are reset as in training
+    returns steps/sec and the time per step of each stage: model sampling, root integration, reward and reset
+    """
+    base_env = env.unwrapped
+    timer = StageTimer(base_env, {'model': 'get_next_frame', 'integrate': 'integrate_root_translation',
+                                  'env_state': 'calc_env_state', 'reset': 'reset_index'}, device)
+    num_parallel = base_env.num_parallel
+    action_dim = base_env.action_space.shape[0]
+    action = torch.zeros((num_parallel, action_dim), device=device)
+
+    env.reset()
+    for i in range(num_warmup + num_steps):
+        if i == num_warmup:
+            timer.clear()
+            if torch.device(device).type == 'cuda':
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats(device)
+            start = time.perf_counter()
+
+        if action_mode == 'random':
+            action.normal_(0, 1)
+        _, _, done, _ = env.step(action)
+        if done.any():
+            reset_indices = base_env.parallel_ind_buf.masked_select(done.squeeze(-1))
+            base_env.reset_index(reset_indices)
+
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+
+    times = timer.times
+    result = {
+        'num_parallel': num_parallel,
+        'steps_per_sec': num_steps / elapsed,
+        'frames_per_sec': num_steps * num_parallel / elapsed,
+        'step_ms': elapsed / num_steps * 1e3,
+        'model_ms': times['model'] / num_steps * 1e3,
+        'integrate_ms': times['integrate'] / num_steps * 1e3,
+        # calc_env_state calls integrate_root_translation, the reward stage is what is left of it
+        'reward_ms': (times['env_state'] - times['integrate']) / num_steps * 1e3,
+        'reset_ms': times['reset'] / num_steps * 1e3,
+        'num_resets': timer.counts['reset'],
+        'peak_mem_mb': get_peak_mem_mb(device),
+    }
+    return result
+
+
+def bench(env_config_file, int_output_dir, model, dataset, device, num_parallel_lst, num_steps, num_warmup, action_mode, out_file):
+    # one env per num_parallel, smallest first so the cpu peak rss reads as the peak of each setting
+    results = dict()
+    for num_parallel in sorted(num_parallel_lst):
+        env = None
+        try:
+            env = build_env(env_config_file, int_output_dir, model, dataset, 'bench', device,
+                            overrides={'num_parallel': num_parallel})
+            results[str(num_parallel)] = bench_env(env, num_steps, num_warmup, action_mode, device)
+        except Exception as e:
+            # envs that only run rendered or with a single character, keep sweeping the other settings
+            traceback.print_exc()
+            results[str(num_parallel)] = {'num_parallel': num_parallel, 'error': repr(e)}
+        if env is not None:
+            env.close()
+        del env
+        if torch.device(device).type == 'cuda':
+            torch.cuda.empty_cache()
+
+    for key, val in results.items():
+        print('num_parallel {}: {}'.format(key, ' '.join(['{}:{:.4f}'.format(k, v) if isinstance(v, float) else '{}:{}'.format(k, v) for k, v in val.items()])))
+
+    if out_file != "":
+        with open(out_file, 'w') as f:
+            json.dump(results, f, indent=4)
+    return results
+
+
 def create_output_dirs(out_model_file, int_output_dir):
     if (mp_util.is_root_proc()):
         output_dir = os.path.dirname(out_model_file)
@@ -130,6 +251,12 @@ def run(rank, num_procs, args):
     model_config_file = args.parse_string("model_config", "")
     agent_config_file = args.parse_string("agent_config", "")
     trained_controller_path = args.parse_string("controller_path", "")
+    resume_path = args.parse_string("resume_path", "")
+    bench_num_parallel = args.parse_ints("bench_num_parallel", [1, 16, 256, 4096])
+    bench_steps = args.parse_int("bench_steps", 50)
+    bench_warmup = args.parse_int("bench_warmup", 5)
+    bench_action = args.parse_string("bench_action", "random")
+    bench_out_file = args.parse_string("bench_out_file", "")
     mp_util.init(rank, num_procs, device, master_port)
 
     set_np_formatting()
@@ -170,9 +297,19 @@ def run(rank, num_procs, args):
         
         model.to(device)
         model.eval()
+    elif mode == "bench":
+        # throughput does not depend on the weights, an untrained model is enough
+        print('Building untrained model for bench:{}'.format(model_config_file))
+        model = build_model(model_config_file, dataset, device)
+        model.eval()
     else:
         model = None
 
+    if (mode == "bench"):
+        bench(env_config_file, int_output_dir, model, dataset, device, bench_num_parallel,
+              bench_steps, bench_warmup, bench_action, bench_out_file)
+        return
+
     if agent_config_file:
         env = build_env(env_config_file, int_output_dir, model, dataset, mode, device)
         agent = build_agent(agent_config_file, model, env, device)
@@ -198,7 +335,7 @@ def run(rank, num_procs, args):
         copy_config_file(agent_config_file, out_model_dir)
         copy_config_file(env_config_file, out_model_dir)
         copy_config_file(model_config_file, out_model_dir)
-        train(agent, out_model_file=out_model_file, int_output_dir=int_output_dir)
+        train(agent, out_model_file=out_model_file, int_output_dir=int_output_dir, resume_file=resume_path)
    
     elif (mode == "test"):
         if agent is None:
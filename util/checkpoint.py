@@ -0,0 +1,119 @@
+import os
+import queue
+import random
+import threading
+import numpy as np
+import torch
+
+
+def snapshot(obj):
+    # detached copy of every tensor in a nested state on the cpu, training can keep updating the originals
+    if torch.is_tensor(obj):
+        obj = obj.detach()
+        return obj.clone() if obj.device.type == 'cpu' else obj.to('cpu')
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def get_rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available() and len(state['cuda']) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class CheckpointManager():
+    """Writes checkpoints on a background thread.
+
+    save() snapshots the state to the cpu in the calling thread and returns, the writer thread
+    saves it to a temporary file and renames it into place, so a crash never leaves a partial
+    checkpoint behind. Checkpoints saved under the same tag are pruned to the last max_to_keep.
+    At most max_pending snapshots wait for the writer, save() blocks when the disk falls further behind.
+    """
+    def __init__(self, max_to_keep=0, async_save=True, max_pending=2):
+        self.max_to_keep = max_to_keep
+        self.async_save = async_save
+        self.history = dict()
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = None
+        if self.async_save:
+            self.thread = threading.Thread(target=self._write_loop, daemon=True)
+            self.thread.start()
+
+    def _write_loop(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                break
+            try:
+                self._write(*job)
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def _write(self, state, path, removed):
+        tmp_path = path + '.tmp'
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+        for old_path in removed:
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+    def save(self, state, path, tag=None):
+        if self.error is not None:
+            raise self.error
+
+        removed = []
+        if tag is not None and self.max_to_keep > 0:
+            history = self.history.setdefault(tag, [])
+            if path in history:
+                history.remove(path)
+            history.append(path)
+            while len(history) > self.max_to_keep:
+                removed.append(history.pop(0))
+
+        job = (snapshot(state), path, removed)
+        if self.async_save:
+            self.queue.put(job)
+        else:
+            self._write(*job)
+
+    def save_weight(self, model, model_path, tag=None):
+        # same file formats as util.save.save_weight, a whole pickled model is written in place
+        wtype = model_path.split('.')[-1].strip()
+        if wtype == 'pth':
+            self.save(model.state_dict(), model_path, tag)
+        else:
+            self.wait()
+            torch.save(model, model_path)
+
+    def wait(self):
+        if self.async_save:
+            self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            raise self.error
@@ -28,6 +28,7 @@ class wandbLogger(object):
     def __init__(self, run_name, proj_name):
         wandb.init(project=proj_name, name=run_name)
         self.run_name = wandb.run.name
+        self._need_update = False
 
     def is_root(self):
         return mp_util.is_root_proc()
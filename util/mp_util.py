@@ -33,9 +33,13 @@ def init(rank, num_procs, device, master_port):
     return
 
 def get_num_procs():
+    if (not torch.distributed.is_initialized()):
+        return 1
     return torch.distributed.get_world_size()
 
 def get_proc_rank():
+    if (not torch.distributed.is_initialized()):
+        return ROOT_PROC_RANK
     return torch.distributed.get_rank()
 
 def is_root_proc():
@@ -49,11 +53,19 @@ def enable_mp():
 def get_device():
     return global_mp_device
 
+def barrier():
+    torch.distributed.barrier()
+    return
+
 def broadcast(x):
     buffer = x.clone()
     torch.distributed.broadcast(buffer, src=ROOT_PROC_RANK)
     return buffer
 
+def broadcast_inplace(x):
+    torch.distributed.broadcast(x, src=ROOT_PROC_RANK)
+    return
+
 def reduce_sum(x):
     return reduce_all(x, torch.distributed.ReduceOp.SUM)
 
@@ -8,6 +8,8 @@ import numpy as np
 import copy 
 import torch
 
+import dataset.util.kinematics as kinematics_util
+
 def rot(yaw):
     cs = np.cos(yaw)
     sn = np.sin(yaw)
@@ -29,18 +31,8 @@ def vis_skel(x, links, save_path=None):
         dxdy = x[...,:2] 
         dr = x[...,2]
         x = np.reshape(x[...,3:69],(-1,22,3))
-        dpm = np.array([[0.0,0.0,0.0]])
-        dpm_lst = np.zeros((dxdy.shape[0],3))
-        yaws = np.cumsum(dr)
-        yaws = yaws - (yaws//(np.pi*2))*(np.pi*2)
-
-        for i in range(1,x.shape[0]):
-           cur_pos = np.zeros((1,3))
-           cur_pos[0,0] = dxdy[i,0]
-           cur_pos[0,2] = dxdy[i,1]
-           dpm += np.dot(cur_pos,rot(yaws[i]))
-           dpm_lst[i,:] = copy.deepcopy(dpm)
-           x[i,:,:] = np.dot(x[i,:,:],rot(yaws[i])) + copy.deepcopy(dpm)
+        yaws, root_pos = kinematics_util.integrate_root(dxdy, dr)
+        x[1:] = kinematics_util.rotate_yaw(x[1:], yaws[1:,None]) + root_pos[1:,None,:]
 
     elif x.shape[-1] == 66:
         x = np.reshape(x,(-1,22,3))
@@ -130,19 +122,8 @@ def vis_traj_from_norm(clips, save_path=None):
         dr = clip[...,2]
         #x = np.reshape(clips[...,3:3+3*self.num_joint],(-1,self.num_joint,3))
         
-        dpm = np.array([[0.0,0.0,0.0]])
-        dpm_lst = np.zeros((dxdy.shape[0],2))
-        yaws = np.cumsum(dr)
-        yaws = yaws - (yaws//(np.pi*2))*(np.pi*2)
-
-        for i in range(1,clip.shape[0]):
-            
-            cur_pos = np.zeros((1,3))
-            cur_pos[0,0] = dxdy[i,0]
-            cur_pos[0,2] = dxdy[i,1]
-            dpm += np.dot(cur_pos,rot(yaws[i]))
-            dpm_lst[i,0] = copy.deepcopy(dpm[0,0])
-            dpm_lst[i,1] = copy.deepcopy(dpm[0,2])
+        _, root_pos = kinematics_util.integrate_root(dxdy, dr)
+        dpm_lst = root_pos[...,[0,2]]
         
         # Plot the data
         ax.plot(dpm_lst[:,0], dpm_lst[:,1], 'b-', linewidth=2, c=cmap(map_idxs[ic]))